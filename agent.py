@@ -1,13 +1,28 @@
-from typing import List, Dict, Any, TypedDict, Annotated
+from typing import List, Dict, Any, TypedDict, Annotated, Optional, Tuple
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.messages import BaseMessage, HumanMessage, ToolMessage, AIMessage
 from langgraph.graph import StateGraph, END
 from langgraph.prebuilt import ToolNode
+import os
+import asyncio
 import operator
+import re
 import json
+import threading
+from langchain_core.runnables import RunnableLambda
 
 
-from utils.tools import classify_image, extract_info_from_image, save_data_to_db, get_llm, get_vlm, google_search
+from utils.tools import classify_image, extract_info_from_image, classify_and_extract, save_data_to_db, get_llm, get_vlm, google_search
+from utils.resilience import guarded_call, aguarded_call
+from utils.clients import get_llm_with_tools
+from utils.history import compact_messages
+from utils.search import best_match
+from utils.validators import validate_tool_output, record_decision, is_placeholder, OK, SEARCH, RETRY
+from utils.config_loader import config
+from utils.tracing import span, traced, trace_run, record, record_usage
+from utils.checkpoint import get_checkpointer, thread_id_for
+
+_SAVED_RECORD = re.compile(r"saved to table '([^']+)' \(id=(\d+)\)")
 
 # --- Agent State ---
 class AgentState(TypedDict):
@@ -18,13 +33,17 @@ class AgentState(TypedDict):
     """
     messages: Annotated[List[BaseMessage], operator.add]
 
+AGENT_TOOLS = [classify_image, extract_info_from_image, classify_and_extract, save_data_to_db, google_search]
+
 # --- Agent Nodes ---
 #节点以最近的state为输入，并返回新增的状态字典
+@traced()
 def llm_agent(state: AgentState):
     """Primary agent node that invokes the LLM with tools.
 
-    This node receives the current state, binds a set of tools to the LLM,
-    and invokes the model with the current message history. The model's
+    This node receives the current state, takes the shared tool-bound LLM
+    from the client registry, and invokes it with a compacted copy of the
+    message history (see `utils.history.compact_messages`). The model's
     response, which may include tool calls, is then added to the state.
 
     Args:
@@ -33,44 +52,59 @@ def llm_agent(state: AgentState):
     Returns:
         A dictionary with the new message from the LLM to be added to the state.
     """
-    llm = get_llm()
-    tools = [classify_image, extract_info_from_image, save_data_to_db,google_search]
-    llm_with_tools = llm.bind_tools(tools)
-    response = llm_with_tools.invoke(state['messages']) #会不会太多，全部对话历史？
+    # 客户端和bind_tools的结果都由utils.clients缓存，不会每一步重新创建
+    llm_with_tools = get_llm_with_tools(AGENT_TOOLS)
+    # 不再发送全部对话历史：旧的工具结果和反思意见按token预算压缩
+    messages = compact_messages(state['messages'])
+    with span('llm', kind='model'):
+        response = guarded_call('llm', lambda: llm_with_tools.invoke(messages))
+        record_usage(response)
     return {"messages": [response]}
 
-def reflection_node(state: AgentState):
-    """Reflects on the output of a tool call to ensure quality and correctness.
+@traced('llm_agent')
+async def allm_agent(state: AgentState):
+    """Async counterpart of `llm_agent`."""
+    llm_with_tools = get_llm_with_tools(AGENT_TOOLS)
+    messages = compact_messages(state['messages'])
+    with span('llm', kind='model'):
+        response = await aguarded_call('llm', lambda: llm_with_tools.ainvoke(messages))
+        record_usage(response)
+    return {"messages": [response]}
 
-    This node examines the last tool message. If the tool was 'extract_info_from_image'
-    and the abstract is missing, it suggests a web search. For other tools, it uses
-    an LLM to check if the tool's output is satisfactory. If not, it injects a
-    corrective message back into the graph.
+def _tool_call_args(state: AgentState, tool_message: ToolMessage) -> Dict[str, Any]:
+    """Finds the arguments of the tool call that produced `tool_message`."""
+    for message in reversed(state['messages']):
+        if isinstance(message, AIMessage) and message.tool_calls:
+            for call in message.tool_calls:
+                if call['id'] == tool_message.tool_call_id:
+                    return call['args']
+            break
+    return {}
 
-    Args:
-        state: The current state of the graph.
+def _reflect_by_rules(state: AgentState):
+    """Checks the last tool message with the rule-based validators.
 
     Returns:
-        An optional dictionary containing a new message to guide the next step,
-        or None if the tool output is satisfactory.
+        (update, prompt): `update` is the node's result when the rules decide,
+        otherwise `prompt` is the reflection prompt for the LLM.
     """
     tool_message = state['messages'][-1]
     tool_request_message = state['messages'][-2]
 
     if not isinstance(tool_message, ToolMessage) or not isinstance(tool_request_message, AIMessage):
-        return
+        return None, None
     print(tool_message)
-    if tool_message.name == "extract_info_from_image":
-        try:
-            data = json.loads(tool_message.content)
-            if data.get('paper_title') and (data.get('abstract') == '无明确描述' or not data.get('abstract')):
-                print(f"--- Reflection: Abstract is missing for '{data['paper_title']}'. Suggesting search. ---")
-                # 返回一条消息，明确建议LLM进行搜索
-                suggestion = f"The information extraction for the paper '{data['paper_title']}' was successful, but the abstract is missing. Please use the google_search tool to find a summary for this paper."
-                return {"messages": [AIMessage(content=suggestion)]}
-        except (json.JSONDecodeError, AttributeError):
-            pass # 解析失败则忽略，走默认路径
-
+    # 规则能判断的情况（缺摘要、缺字段、报错）直接给出建议，不调用LLM
+    verdict = validate_tool_output(tool_message.name, tool_message.content, _tool_call_args(state, tool_message))
+    if verdict.decision == SEARCH:
+        print("--- Reflection: Abstract is missing. Suggesting search. ---")
+        return {"messages": [AIMessage(content=verdict.message)]}, None
+    if verdict.decision == RETRY:
+        print(f"--- Reflection (rule) ---\n{verdict.message}\n---------------------")
+        record(retries=1)
+        return {"messages": [AIMessage(content=verdict.message)]}, None
+    if verdict.decision == OK:
+        return None, None
 
     reflection_prompt = f"""
     You are a quality assurance expert. Please review the result from a previous tool call.
@@ -81,26 +115,68 @@ def reflection_node(state: AgentState):
     If the result is good, respond with just the word 'CONTINUE'.
     If there is an error or the result is unsatisfactory, briefly explain the issue and suggest a correction.
     """
-    llm = get_llm()
-    response = llm.invoke(reflection_prompt)
-    
+    return None, reflection_prompt
+
+def _reflect_by_llm(response: BaseMessage):
+    """Turns the reflection LLM's answer into the node's result."""
     print(f"--- Reflection ---\n{response.content}\n---------------------")
 
     if "CONTINUE" in response.content:
+        record_decision('llm:continue')
         return
     else:
+        record_decision('llm:correction')
+        record(retries=1)
         return {"messages": [AIMessage(content=f"Reflection on last action: {response.content}")]}
 
-# --- Graph Definition (remains the same) ---
+@traced('reflection')
+def reflection_node(state: AgentState):
+    """Reflects on the output of a tool call to ensure quality and correctness.
+
+    This node examines the last tool message with the rule-based validators in
+    `utils.validators`. If a paper's abstract is missing, it suggests a web
+    search; if the rules find the output wrong, it injects their correction.
+    Only when the rules cannot decide does it ask an LLM whether the tool's
+    output is satisfactory, and if not, it injects a corrective message back
+    into the graph.
 
-workflow = StateGraph(AgentState)
-workflow.add_node("llm_agent", llm_agent)
-#工具节点，可能需要定义不同类型的工具节点？
-vlm_expert_node = ToolNode([classify_image, extract_info_from_image, save_data_to_db,google_search])
-workflow.add_node("vlm_expert", vlm_expert_node)
-workflow.add_node("reflection", reflection_node)
-#定义为起点
-workflow.set_entry_point("llm_agent")
+    Args:
+        state: The current state of the graph.
+
+    Returns:
+        An optional dictionary containing a new message to guide the next step,
+        or None if the tool output is satisfactory.
+    """
+    update, reflection_prompt = _reflect_by_rules(state)
+    if reflection_prompt is None:
+        return update
+    llm = get_llm()
+    with span('llm', kind='model'):
+        response = guarded_call('llm', lambda: llm.invoke(reflection_prompt))
+        record_usage(response)
+    return _reflect_by_llm(response)
+
+@traced('reflection')
+async def areflection_node(state: AgentState):
+    """Async counterpart of `reflection_node`."""
+    update, reflection_prompt = _reflect_by_rules(state)
+    if reflection_prompt is None:
+        return update
+    llm = get_llm()
+    with span('llm', kind='model'):
+        response = await aguarded_call('llm', lambda: llm.ainvoke(reflection_prompt))
+        record_usage(response)
+    return _reflect_by_llm(response)
+
+# --- Graph Definition ---
+
+def _node(func, afunc):
+    """Wraps a node's sync and async implementations into one runnable.
+
+    `invoke`/`stream` run `func` and `ainvoke`/`astream` run `afunc`, so the
+    same compiled graph serves both the thread pool and the asyncio paths.
+    """
+    return RunnableLambda(func, afunc, name=func.__name__)
 
 def route_after_llm(state: AgentState):
     """Routes the workflow after the main LLM agent has run.
@@ -122,9 +198,10 @@ def route_after_llm(state: AgentState):
 def route_after_tool(state: AgentState):
     """Routes the workflow after a tool has been executed.
 
-    If the tool execution resulted in an error or a specific condition (like a
-    missing abstract), it routes to the 'reflection' node for quality control.
-    Otherwise, it routes back to the 'llm_agent' to continue the process.
+    The tool output is checked by the rule-based validators. If it passes,
+    the workflow goes straight back to the 'llm_agent'. If the output has an
+    error, a missing abstract or cannot be judged by the rules, it routes to
+    the 'reflection' node for quality control.
 
     Args:
         state: The current state of the graph.
@@ -133,40 +210,294 @@ def route_after_tool(state: AgentState):
         A string indicating the next node to execute ('reflection' or 'llm_agent').
     """
     last_message = state['messages'][-1]
-    if isinstance(last_message, ToolMessage) and ("error" in last_message.content.lower() or "failed" in last_message.content.lower() or "abstract" in last_message.content.lower()):
-        return "reflection"
-    else:
+    if not isinstance(last_message, ToolMessage):
         return "llm_agent"
+    verdict = validate_tool_output(last_message.name, last_message.content, _tool_call_args(state, last_message))
+    record_decision(f"rule:{verdict.decision}")
+    return "llm_agent" if verdict.decision == OK else "reflection"
 
+def build_agent_graph():
+    """Builds and compiles the agentic graph driven by the LLM orchestrator.
 
+    Called once by `get_app`; importing this module does not compile anything.
+    """
+    workflow = StateGraph(AgentState)
+    workflow.add_node("llm_agent", _node(llm_agent, allm_agent))
+    #工具节点，可能需要定义不同类型的工具节点？
+    tool_node = ToolNode(AGENT_TOOLS)
+
+    @traced('vlm_expert')
+    def vlm_expert(state: AgentState, config):
+        """Runs the requested tool calls with the `ToolNode`, inside a tracing span."""
+        return tool_node.invoke(state, config)
+
+    @traced('vlm_expert')
+    async def avlm_expert(state: AgentState, config):
+        return await tool_node.ainvoke(state, config)
+
+    workflow.add_node("vlm_expert", _node(vlm_expert, avlm_expert))
+    workflow.add_node("reflection", _node(reflection_node, areflection_node))
+    #定义为起点
+    workflow.set_entry_point("llm_agent")
+    workflow.add_conditional_edges(
+        "llm_agent",
+        route_after_llm,  # 这个是返回一个信号，下面的dict根据信号去执行下个节点的链接
+        {"vlm_expert": "vlm_expert", END: END}
+    )
+    workflow.add_conditional_edges(
+        "vlm_expert",
+        route_after_tool,
+        {"reflection": "reflection", "llm_agent": "llm_agent"}
+    )
+    workflow.add_edge('reflection', 'llm_agent')
+
+    #把定义好的图编译
+    return workflow.compile()
+
+# --- Pipeline Graph ---
+# 分类→提取→(缺摘要时搜索)→保存 的顺序是固定的，不需要LLM每一步来做决定。
+# 只有某一步失败时，才交给上面的agent图继续处理。
+
+class PipelineState(TypedDict, total=False):
+    """Represents the state of the deterministic pipeline.
 
-workflow.add_conditional_edges(
-    "llm_agent",
-    route_after_llm,  # 这个是返回一个信号，下面的dict根据信号去执行下个节点的链接
-    {"vlm_expert": "vlm_expert", END: END}
-)
-workflow.add_conditional_edges(
-    "vlm_expert",
-    route_after_tool,
-    {"reflection": "reflection", "llm_agent": "llm_agent"}
-)
-workflow.add_edge('reflection', 'llm_agent')
-
-#把定义好的图编译
-app = workflow.compile()
-
-# --- Graph Invocation (remains the same) ---
-def run_agent(image_path: str):
-    """Runs the agent workflow for a given image.
-
-    This function initializes the agent with a prompt to analyze the specified
-    image. It then streams the execution of the graph, printing each step's
-    output to the console.
-
-    Args:
-        image_path: The local file path to the image to be analyzed.
+    Attributes:
+        image_path: The image being processed.
+        image_type: The category returned by `classify_image`.
+        data: The structured information returned by `extract_info_from_image`.
+        search_result: The `google_search` output used to fill a missing abstract.
+        save_result: The status string returned by `save_data_to_db`.
+        failed_step: The name of the step that failed, if any.
+        error: The error of the failed step, if any.
+        fallback_messages: The messages of the agentic run used as a fallback.
+    """
+    image_path: str
+    image_type: str
+    data: Dict[str, Any]
+    search_result: str
+    save_result: str
+    failed_step: str
+    error: str
+    fallback_messages: List[BaseMessage]
+
+# 每个步骤都有同步和异步两个实现，结果的处理逻辑共用，见 _node
+def _classify_update(image_type: str):
+    if image_type not in config['database_tables']:
+        return {"failed_step": "classify_image", "error": f"Unknown image type: {image_type}"}
+    return {"image_type": image_type}
+
+@traced('classify')
+def classify_step(state: PipelineState):
+    """Classifies the image by calling `classify_image` directly."""
+    try:
+        image_type = classify_image.invoke({"image_path": state['image_path']})
+    except Exception as e:
+        return {"failed_step": "classify_image", "error": str(e)}
+    return _classify_update(image_type)
+
+@traced('classify')
+async def aclassify_step(state: PipelineState):
+    try:
+        image_type = await classify_image.ainvoke({"image_path": state['image_path']})
+    except Exception as e:
+        return {"failed_step": "classify_image", "error": str(e)}
+    return _classify_update(image_type)
+
+def _extract_update(data: Dict[str, Any]):
+    if 'error' in data:
+        return {"failed_step": "extract_info_from_image", "error": json.dumps(data, ensure_ascii=False)}
+    return {"data": data}
+
+@traced('extract')
+def extract_step(state: PipelineState):
+    """Extracts structured information by calling `extract_info_from_image` directly."""
+    try:
+        data = extract_info_from_image.invoke({"image_path": state['image_path'], "image_type": state['image_type']})
+    except Exception as e:
+        return {"failed_step": "extract_info_from_image", "error": str(e)}
+    return _extract_update(data)
+
+@traced('extract')
+async def aextract_step(state: PipelineState):
+    try:
+        data = await extract_info_from_image.ainvoke({"image_path": state['image_path'], "image_type": state['image_type']})
+    except Exception as e:
+        return {"failed_step": "extract_info_from_image", "error": str(e)}
+    return _extract_update(data)
+
+def _classify_extract_update(result: Dict[str, Any]):
+    if result['image_type'] not in config['database_tables']:
+        return {"failed_step": "classify_image", "error": f"Unknown image type: {result['image_type']}"}
+    if 'error' in result['data']:
+        return {"failed_step": "extract_info_from_image", "image_type": result['image_type'],
+                "error": json.dumps(result['data'], ensure_ascii=False)}
+    return {"image_type": result['image_type'], "data": result['data']}
+
+@traced('classify_extract')
+def classify_extract_step(state: PipelineState):
+    """Classifies the image and extracts its information with one `classify_and_extract` call."""
+    try:
+        result = classify_and_extract.invoke({"image_path": state['image_path']})
+    except Exception as e:
+        return {"failed_step": "classify_and_extract", "error": str(e)}
+    return _classify_extract_update(result)
+
+@traced('classify_extract')
+async def aclassify_extract_step(state: PipelineState):
+    try:
+        result = await classify_and_extract.ainvoke({"image_path": state['image_path']})
+    except Exception as e:
+        return {"failed_step": "classify_and_extract", "error": str(e)}
+    return _classify_extract_update(result)
+
+def _search_update(state: PipelineState, search_result: str):
+    # 只采用标题与论文标题相符的那条结果的摘要；没有相符的结果不算失败，保留原始的提取结果
+    match = best_match(state['data']['paper_title'], search_result or "")
+    if match is None:
+        return {"search_result": search_result or ""}
+    data = dict(state['data'])
+    data['abstract'] = match['snippet']
+    return {"search_result": search_result, "data": data}
+
+@traced('search')
+def search_step(state: PipelineState):
+    """Fills a missing paper abstract with the snippet of the search result matching its title.
+
+    If no result title matches the paper title, the placeholder abstract is kept.
+    """
+    try:
+        search_result = google_search.invoke({"query": state['data']['paper_title']})
+    except Exception as e:
+        return {"failed_step": "google_search", "error": str(e)}
+    return _search_update(state, search_result)
+
+@traced('search')
+async def asearch_step(state: PipelineState):
+    try:
+        search_result = await google_search.ainvoke({"query": state['data']['paper_title']})
+    except Exception as e:
+        return {"failed_step": "google_search", "error": str(e)}
+    return _search_update(state, search_result)
+
+def _save_update(save_result: str):
+    if not save_result.startswith("Data successfully saved"):
+        return {"failed_step": "save_data_to_db", "error": save_result, "save_result": save_result}
+    return {"save_result": save_result}
+
+@traced('save')
+def save_step(state: PipelineState):
+    """Saves the extracted data by calling `save_data_to_db` directly."""
+    return _save_update(save_data_to_db.invoke({"data": state['data'], "image_type": state['image_type']}))
+
+@traced('save')
+async def asave_step(state: PipelineState):
+    return _save_update(await save_data_to_db.ainvoke({"data": state['data'], "image_type": state['image_type']}))
+
+def _fallback_prompt(state: PipelineState) -> str:
+    print(f"--- Pipeline step '{state['failed_step']}' failed: {state['error']}. Falling back to agent mode. ---")
+    record(retries=1)
+    completed = []
+    if state.get('image_type'):
+        completed.append(f"- classify_image returned: {state['image_type']}")
+    if state.get('data'):
+        completed.append(f"- extract_info_from_image returned: {json.dumps(state['data'], ensure_ascii=False)}")
+    prompt = build_initial_prompt(state['image_path'])
+    if completed:
+        prompt += "\nThe following steps have already been completed, do not repeat them:\n" + "\n".join(completed)
+    prompt += f"\nThe step `{state['failed_step']}` failed with: {state['error']}\nPlease continue from that step."
+    return prompt
+
+@traced('agent_fallback')
+def agent_fallback_step(state: PipelineState):
+    """Hands a failed pipeline run over to the agentic graph.
+
+    The LLM orchestrator receives the original task together with the results
+    of the steps that already succeeded, so it only has to redo the rest.
     """
-    initial_prompt = f"""
+    final_state = get_app().invoke({"messages": [HumanMessage(content=_fallback_prompt(state))]})
+    return {"fallback_messages": final_state['messages']}
+
+@traced('agent_fallback')
+async def aagent_fallback_step(state: PipelineState):
+    final_state = await get_app().ainvoke({"messages": [HumanMessage(content=_fallback_prompt(state))]})
+    return {"fallback_messages": final_state['messages']}
+
+def route_after_step(next_step: str):
+    """Builds a router that continues to `next_step` or falls back on failure."""
+    def route(state: PipelineState):
+        return "agent_fallback" if state.get('failed_step') else next_step
+    return route
+
+def route_entry(state: PipelineState):
+    """Starts with the fused single-call step when `agent.fused_extraction` is enabled."""
+    return "classify_extract" if config.get('agent', {}).get('fused_extraction', False) else "classify"
+
+def route_after_extract(state: PipelineState):
+    """Routes to the search step when a paper's abstract is missing."""
+    if state.get('failed_step'):
+        return "agent_fallback"
+    data = state['data']
+    if state['image_type'] == '论文' and data.get('paper_title') and is_placeholder(data.get('abstract')):
+        return "search"
+    return "save"
+
+def build_pipeline_graph():
+    """Builds and compiles the deterministic pipeline graph. Called once by `get_pipeline_app`."""
+    pipeline_workflow = StateGraph(PipelineState)
+    pipeline_workflow.add_node("classify", _node(classify_step, aclassify_step))
+    pipeline_workflow.add_node("extract", _node(extract_step, aextract_step))
+    pipeline_workflow.add_node("classify_extract", _node(classify_extract_step, aclassify_extract_step))
+    pipeline_workflow.add_node("search", _node(search_step, asearch_step))
+    pipeline_workflow.add_node("save", _node(save_step, asave_step))
+    pipeline_workflow.add_node("agent_fallback", _node(agent_fallback_step, aagent_fallback_step))
+    pipeline_workflow.set_conditional_entry_point(route_entry, {"classify": "classify", "classify_extract": "classify_extract"})
+    pipeline_workflow.add_conditional_edges("classify", route_after_step("extract"),
+                                            {"extract": "extract", "agent_fallback": "agent_fallback"})
+    pipeline_workflow.add_conditional_edges("extract", route_after_extract,
+                                            {"search": "search", "save": "save", "agent_fallback": "agent_fallback"})
+    pipeline_workflow.add_conditional_edges("classify_extract", route_after_extract,
+                                            {"search": "search", "save": "save", "agent_fallback": "agent_fallback"})
+    pipeline_workflow.add_conditional_edges("search", route_after_step("save"),
+                                            {"save": "save", "agent_fallback": "agent_fallback"})
+    pipeline_workflow.add_conditional_edges("save", route_after_step(END),
+                                            {END: END, "agent_fallback": "agent_fallback"})
+    pipeline_workflow.add_edge("agent_fallback", END)
+
+    return pipeline_workflow.compile()
+
+
+_graphs: Dict[str, Any] = {}
+_graphs_lock = threading.Lock()
+
+def _get_graph(name: str, build):
+    graph = _graphs.get(name)
+    if graph is None:
+        with _graphs_lock:
+            graph = _graphs.get(name)
+            if graph is None:
+                graph = _graphs[name] = build()
+    return graph
+
+def get_app():
+    """Returns the compiled agentic graph, compiling it on first use."""
+    return _get_graph('agent', build_agent_graph)
+
+def get_pipeline_app():
+    """Returns the compiled pipeline graph, compiling it on first use."""
+    return _get_graph('pipeline', build_pipeline_graph)
+
+def __getattr__(name: str):
+    # 兼容直接使用 agent.app / agent.pipeline_app 的旧代码，图在第一次访问时才编译
+    if name == 'app':
+        return get_app()
+    if name == 'pipeline_app':
+        return get_pipeline_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# --- Graph Invocation ---
+def build_initial_prompt(image_path: str) -> str:
+    """Builds the task prompt given to the LLM orchestrator for an image."""
+    return f"""
     Please analyze the image at the following path: {image_path}
     1. First, classify the image to determine its type.
     2. Second, based on the type, extract the relevant information. 
@@ -175,10 +506,164 @@ def run_agent(image_path: str):
     3. Finally, save the extracted information to the database 
     Let me know when you are done.
     """
-    
-    inputs = {"messages": [HumanMessage(content=initial_prompt)]}
-    
-    #以流的方式运行，就是每个节点完成就会有当前的state的结果，可以实时观察
-    for event in app.stream(inputs, stream_mode="values"):
-        event["messages"][-1].pretty_print()
 
+def saved_record(final_state: Dict[str, Any]) -> Optional[Tuple[str, int]]:
+    """Finds the table and row id written by `save_data_to_db` in a final graph state.
+
+    Works for both run modes: the pipeline keeps the status in 'save_result',
+    the agentic graph in the last `save_data_to_db` tool message.
+    """
+    texts = [final_state.get('save_result') or '']
+    for message in reversed(final_state.get('messages', []) + final_state.get('fallback_messages', [])):
+        if isinstance(message, ToolMessage) and message.name == 'save_data_to_db':
+            texts.append(message.content)
+    for text in texts:
+        match = _SAVED_RECORD.search(text)
+        if match:
+            return match.group(1), int(match.group(2))
+    return None
+
+def _resolve_mode(mode: Optional[str]) -> str:
+    mode = mode or config.get('agent', {}).get('mode', 'pipeline')
+    if mode not in ('pipeline', 'agent'):
+        raise ValueError(f"Unsupported run mode: {mode}")
+    return mode
+
+def _initial_input(image_path: str, mode: str) -> Dict[str, Any]:
+    if mode == 'pipeline':
+        return {"image_path": image_path}
+    return {"messages": [HumanMessage(content=build_initial_prompt(image_path))]}
+
+def _checkpointed_graph(image_path: str, mode: str):
+    """Returns the graph of `mode` bound to the checkpointer, and the run config of the image's thread.
+
+    Without checkpointing the plain graph and a None config are returned.
+    """
+    graph = get_pipeline_app() if mode == 'pipeline' else get_app()
+    saver = get_checkpointer()
+    if saver is None:
+        return graph, None
+    # 编译好的图不带checkpointer，只在这里绑定；agent_fallback里调用的agent图作为子图共用同一个checkpointer
+    return graph.copy(update={'checkpointer': saver}), {"configurable": {"thread_id": thread_id_for(image_path, mode)}}
+
+def _plan_run(snapshot, image_path: str, mode: str, resume: bool):
+    """Decides how a run starts from the last checkpoint of its thread.
+
+    A run that completed without saving a record (e.g. the orchestrator gave
+    up after a database error) is started over rather than skipped.
+
+    Returns:
+        (action, state): action is 'start', 'restart' (drop the old checkpoints
+        first), 'resume' (continue at `snapshot.next`) or 'skip' (already
+        completed); state is the graph input for a (re)start, else the saved state.
+    """
+    if snapshot is None or not snapshot.values:
+        return 'start', _initial_input(image_path, mode)
+    if not resume or (not snapshot.next and saved_record(snapshot.values) is None):
+        return 'restart', _initial_input(image_path, mode)
+    if not snapshot.next:
+        return 'skip', dict(snapshot.values)
+    return 'resume', dict(snapshot.values)
+
+def _announce(action: str, snapshot, image_path: str, mode: str):
+    if action == 'skip':
+        print(f"--- {image_path} was already processed in {mode} mode, skipping. ---")
+    elif action == 'resume':
+        print(f"--- Resuming {image_path} at step {', '.join(snapshot.next)} ---")
+    elif action == 'restart':
+        print(f"--- Discarding the previous run of {image_path} and starting over ---")
+
+def run_agent(image_path: str, mode: Optional[str] = None, resume: bool = True) -> Dict[str, Any]:
+    """Runs the agent workflow for a given image.
+
+    In "pipeline" mode the fixed classify → extract → (search) → save steps run
+    directly and the LLM orchestrator is only used when a step fails. In
+    "agent" mode the LLM orchestrator drives every step. Both modes stream the
+    execution of the graph, printing each step's output to the console. With
+    tracing enabled (see `utils.tracing`) the run is recorded as one trace.
+
+    With checkpointing enabled (see `utils.checkpoint`) the state is saved
+    after every step, on one thread per image content and mode. A run that
+    failed earlier resumes at the failed step and a completed run is returned
+    without running again.
+
+    Args:
+        image_path: The local file path to the image to be analyzed.
+        mode: "pipeline" or "agent". Defaults to `agent.mode` in config.yaml.
+        resume: If False, earlier checkpoints of the image are discarded and
+            the run starts over.
+
+    Returns:
+        The final state of the graph that was run.
+    """
+    mode = _resolve_mode(mode)
+    graph, run_config = _checkpointed_graph(image_path, mode)
+    # 开启tracing时，本次运行的所有节点、工具和模型调用都记录在同一个run下
+    with trace_run(os.path.basename(image_path), mode=mode, image_path=image_path) as run:
+        snapshot = graph.get_state(run_config) if run_config else None
+        action, state = _plan_run(snapshot, image_path, mode, resume)
+        run.set(checkpoint=action)
+        _announce(action, snapshot, image_path, mode)
+        if action == 'skip':
+            return state
+        if action == 'restart':
+            graph.checkpointer.delete_thread(run_config['configurable']['thread_id'])
+        inputs = None if action == 'resume' else state
+
+        if mode == 'pipeline':
+            final_state = dict(state)
+            for event in graph.stream(inputs, run_config, stream_mode="updates"):
+                for node, update in event.items():
+                    print(f"--- Pipeline step '{node}': {update} ---")
+                    final_state.update(update or {})
+            return final_state
+
+        #以流的方式运行，就是每个节点完成就会有当前的state的结果，可以实时观察
+        final_state = state
+        for event in graph.stream(inputs, run_config, stream_mode="values"):
+            event["messages"][-1].pretty_print()
+            final_state = event
+        return final_state
+
+async def arun_agent(image_path: str, mode: Optional[str] = None, resume: bool = True) -> Dict[str, Any]:
+    """Async counterpart of `run_agent`.
+
+    The graph runs with `astream`, so the tools and model calls await their
+    providers instead of blocking a thread, and many images can be processed
+    concurrently from one event loop (see `utils.batch.arun_batch`).
+
+    Args:
+        image_path: The local file path to the image to be analyzed.
+        mode: "pipeline" or "agent". Defaults to `agent.mode` in config.yaml.
+        resume: If False, earlier checkpoints of the image are discarded and
+            the run starts over.
+
+    Returns:
+        The final state of the graph that was run.
+    """
+    mode = _resolve_mode(mode)
+    graph, run_config = await asyncio.to_thread(_checkpointed_graph, image_path, mode)
+    with trace_run(os.path.basename(image_path), mode=mode, image_path=image_path) as run:
+        snapshot = await graph.aget_state(run_config) if run_config else None
+        action, state = _plan_run(snapshot, image_path, mode, resume)
+        run.set(checkpoint=action)
+        _announce(action, snapshot, image_path, mode)
+        if action == 'skip':
+            return state
+        if action == 'restart':
+            await graph.checkpointer.adelete_thread(run_config['configurable']['thread_id'])
+        inputs = None if action == 'resume' else state
+
+        if mode == 'pipeline':
+            final_state = dict(state)
+            async for event in graph.astream(inputs, run_config, stream_mode="updates"):
+                for node, update in event.items():
+                    print(f"--- Pipeline step '{node}': {update} ---")
+                    final_state.update(update or {})
+            return final_state
+
+        final_state = state
+        async for event in graph.astream(inputs, run_config, stream_mode="values"):
+            event["messages"][-1].pretty_print()
+            final_state = event
+        return final_state
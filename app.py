@@ -3,73 +3,147 @@ import os
 from dotenv import load_dotenv
 
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), 'utils', '.env'))
-import traceback
-from agent import run_agent
-from utils.tools import check_upcoming_events
+from utils.batch import list_images, arun_batch
+from utils.manifest import get_manifest
+from utils.config_loader import config
 
 # Define the directory where images are stored
 IMAGE_DIR = os.path.join(os.path.dirname(__file__), "images")
 if not os.path.exists(IMAGE_DIR):
     os.makedirs(IMAGE_DIR)
 
-def analyze_images_wrapper():
+async def analyze_images_wrapper():
     """Analyzes all images in the designated image directory.
 
-    This function iterates through all image files (PNG, JPG, JPEG) in the
-    `IMAGE_DIR`, processes each one using the `run_agent` function, and yields
-    progress updates and logs to the Gradio interface.
+    This function processes all image files (PNG, JPG, JPEG) in the
+    `IMAGE_DIR` that are new or changed since the last run, according to the
+    ingest manifest, concurrently on Gradio's event loop using `arun_batch`
+    and `aingest_image`, which skips near-duplicates of already ingested
+    images, and yields progress updates and logs to the Gradio interface in
+    the original file order.
 
     Yields:
         A string containing the log of the analysis process.
     """
-    image_files = [f for f in os.listdir(IMAGE_DIR) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-    if not image_files:
-        return "No images found in the 'images' folder."
-
-    full_log = ""
-    for filename in image_files:
-        image_path = os.path.join(IMAGE_DIR, filename)
-        try:
-            yield f"Processing {filename}...\n"
-            run_agent(image_path)
-            log_message = f"Successfully processed {filename}.\n"
-            print(log_message) # For server-side logging
-            full_log += log_message
-            yield full_log
-        except Exception as e:
-            error_message = f"Error processing {filename}: {traceback.format_exc()}\n"
-            print(error_message)
-            full_log += error_message
-            yield full_log
+    all_images = list_images(IMAGE_DIR)
+    if not all_images:
+        yield "No images found in the 'images' folder."
+        return
+    image_paths = get_manifest().pending(all_images)
+    if not image_paths:
+        yield f"All {len(all_images)} images have already been analyzed."
+        return
+    from ingest import aingest_image, aclassify_ahead  # 第一次分析时才导入agent，界面启动更快
+
+    full_log = f"Processing {len(image_paths)} images...\n"
+    yield full_log
+    await aclassify_ahead(image_paths)
+    done = 0
+    async for result in arun_batch(image_paths, aingest_image):
+        done += 1
+        filename = os.path.basename(result.image_path)
+        if result.ok and result.value.status == 'duplicate':
+            log_message = f"[{done}/{len(image_paths)}] Skipped {filename}: near-duplicate of {os.path.basename(result.value.duplicate_of)}.\n"
+        elif result.ok:
+            log_message = f"[{done}/{len(image_paths)}] Successfully processed {filename} ({result.elapsed:.1f}s).\n"
+        else:
+            log_message = f"[{done}/{len(image_paths)}] Error processing {filename}: {result.error}\n"
+        print(log_message) # For server-side logging
+        full_log += log_message
+        yield full_log
     yield full_log + "\nAnalysis complete."
 
-def query_events_wrapper():
+def enqueue_images_wrapper():
+    """Adds the new or changed images of `IMAGE_DIR` to the ingest job queue.
+
+    The images are processed by `worker.py` processes instead of this
+    Gradio process.
+
+    Returns:
+        A string with the number of enqueued images and the job counts per status.
+    """
+    from utils.job_queue import get_job_queue
+
+    image_paths = get_manifest().pending(list_images(IMAGE_DIR))
+    try:
+        queue = get_job_queue()
+        added = queue.enqueue(image_paths)
+        stats = queue.stats()
+    except Exception as e:
+        return f"Error enqueuing images: {e}"
+    return (f"Enqueued {added} of {len(image_paths)} new or changed images. Start workers with `python worker.py -n 4`.\n"
+            f"Jobs: {stats['queued']} queued, {stats['leased']} running, {stats['done']} done, {stats['dead']} dead.")
+
+def query_events_wrapper(days=10, location="", page=1):
     """Queries and returns upcoming events from the database.
 
     This function acts as a wrapper for `check_upcoming_events` to be used
     within the Gradio interface. It handles any exceptions that occur during
     the query.
 
+    Args:
+        days: How many days ahead to look.
+        location: Optional text the activity location must contain.
+        page: The 1-based page of results.
+
     Returns:
         A string containing the list of upcoming events or an error message.
     """
+    from utils.tools import check_upcoming_events
+
     try:
-        return check_upcoming_events()
+        return check_upcoming_events(days=int(days), location=location, page=int(page))
     except Exception as e:
         return f"Error querying events: {e}"
 
+def search_records_wrapper(query="", category="全部", page=1):
+    """Searches the archived records for the Gradio search box.
+
+    Args:
+        query: The keywords.
+        category: A category name, or '全部' to search every category.
+        page: The 1-based page of results.
+
+    Returns:
+        A string with the ranked matches or an error message.
+    """
+    from utils.tools import search_records
+
+    if not query.strip():
+        return "Please enter keywords to search for."
+    try:
+        return search_records(query, image_type="" if category == "全部" else category, page=int(page))
+    except Exception as e:
+        return f"Error searching records: {e}"
+
 with gr.Blocks() as demo:
     gr.Markdown("## Image Analysis and Event Query")
-    gr.Markdown("Place images in the 'images' folder next to this application, then click 'Analyze Images'.")
+    gr.Markdown("Place images in the 'images' folder next to this application, then click 'Analyze Images', "
+                "or 'Enqueue Images' to have them processed by `worker.py` processes.")
 
     with gr.Row():
         analyze_btn = gr.Button("Analyze Images")
+        enqueue_btn = gr.Button("Enqueue Images")
         query_btn = gr.Button("Query Upcoming Events")
+    with gr.Row():
+        days_input = gr.Number(label="Days ahead", value=10, precision=0, minimum=1)
+        location_input = gr.Textbox(label="Location contains", value="")
+        page_input = gr.Number(label="Page", value=1, precision=0, minimum=1)
     
+    with gr.Row():
+        search_input = gr.Textbox(label="Search records", placeholder="e.g. diffusion 扩散模型", scale=3)
+        category_input = gr.Dropdown(label="Category", choices=["全部"] + [c for c in config['database_tables'] if c != 'default'], value="全部")
+        search_page_input = gr.Number(label="Page", value=1, precision=0, minimum=1)
+        search_btn = gr.Button("Search")
+
     output_textbox = gr.Textbox(label="Output", lines=15, interactive=False)
 
     analyze_btn.click(fn=analyze_images_wrapper, inputs=[], outputs=output_textbox)
-    query_btn.click(fn=query_events_wrapper, inputs=[], outputs=output_textbox)
+    enqueue_btn.click(fn=enqueue_images_wrapper, inputs=[], outputs=output_textbox)
+    query_btn.click(fn=query_events_wrapper, inputs=[days_input, location_input, page_input], outputs=output_textbox)
+    search_inputs = [search_input, category_input, search_page_input]
+    search_btn.click(fn=search_records_wrapper, inputs=search_inputs, outputs=output_textbox)
+    search_input.submit(fn=search_records_wrapper, inputs=search_inputs, outputs=output_textbox)
 
 if __name__ == "__main__":
     # It's a good practice to set up your API keys via environment variables
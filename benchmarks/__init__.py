@@ -0,0 +1 @@
+"""Offline benchmarks with fake model and search providers; see `benchmarks/run.py`."""
@@ -0,0 +1,48 @@
+"""Synthetic image corpora for the benchmarks.
+
+Each image is a random low-resolution pattern scaled up to screenshot size,
+so images of one corpus are far apart in perceptual hash and none of them is
+skipped as a near-duplicate.
+"""
+import os
+import random
+import shutil
+from typing import List
+
+
+def make_corpus(directory: str, n: int, size=(1080, 1920), seed: int = 0) -> List[str]:
+    """Writes `n` distinct JPEG images to `directory` and returns their paths.
+
+    Images that already exist are reused, so a corpus is only generated once.
+
+    Args:
+        directory: The output directory.
+        n: The number of images.
+        size: The (width, height) of each image.
+        seed: Seed of the random patterns; the same seed gives the same corpus.
+    """
+    from PIL import Image
+
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    paths = []
+    for i in range(n):
+        pixels = bytes(rng.randrange(256) for _ in range(16 * 16 * 3))
+        path = os.path.join(directory, f"bench_{seed}_{i:05d}.jpg")
+        if not os.path.exists(path):
+            Image.frombytes('RGB', (16, 16), pixels).resize(size, Image.BICUBIC).save(path, 'JPEG', quality=90)
+        paths.append(path)
+    return paths
+
+
+def copy_corpus(source_dir: str, directory: str) -> List[str]:
+    """Copies the images of `source_dir` to `directory` and returns the copies' paths."""
+    from utils.batch import list_images
+
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for path in list_images(source_dir):
+        target = os.path.join(directory, os.path.basename(path))
+        shutil.copyfile(path, target)
+        paths.append(target)
+    return paths
@@ -0,0 +1,332 @@
+"""Deterministic stand-ins for the VLM, the orchestrator LLM and web search.
+
+The fakes sleep for a configurable latency and answer from the prompt alone,
+so a benchmark measures the agent, the tools and the database instead of the
+providers. Every call is counted in `STATS` per image. `TURBULENCE` injects
+transient errors and slow calls into all of them.
+"""
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import zlib
+import threading
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from utils.search import SearchBackend, SearchCache, SearchService, format_results, use_search_service
+from utils import clients
+
+IMAGE_TYPES = ['活动', '经验', '论文']
+
+# 默认的工具调用脚本，和build_initial_prompt里描述的步骤一致
+DEFAULT_SCRIPT = ['classify_image', 'extract_info_from_image', 'save_data_to_db']
+
+
+class CallStats:
+    """Thread-safe call counters of the fakes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls: Dict[str, int] = defaultdict(int)
+            self.per_image: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+    def count(self, kind: str, image: Optional[str] = None):
+        with self._lock:
+            self.calls[kind] += 1
+            if image:
+                self.per_image[image][kind] += 1
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.calls)
+
+
+STATS = CallStats()
+
+
+class FakeProviderError(Exception):
+    """A transient provider failure with an HTTP status, as raised by the provider SDKs."""
+
+    def __init__(self, status_code: int):
+        super().__init__(f"fake provider error {status_code}")
+        self.status_code = status_code
+
+
+class Turbulence:
+    """Injected provider trouble shared by all fakes: transient errors and slow calls.
+
+    Attributes:
+        error_rate: Fraction of calls failing with a 503, or a 429 for every third failure.
+        slow_rate: Fraction of calls taking `slow_factor` times their latency.
+        slow_factor: How much slower the slow calls are.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.configure()
+
+    def configure(self, error_rate: float = 0.0, slow_rate: float = 0.0, slow_factor: float = 20.0, seed: int = 0):
+        with self._lock:
+            self.error_rate, self.slow_rate, self.slow_factor = error_rate, slow_rate, slow_factor
+            self._random = random.Random(seed)
+            self._failures = 0
+
+    def latency(self, latency: float) -> float:
+        """Returns the latency of the next call."""
+        with self._lock:
+            slow = self._random.random() < self.slow_rate
+        return latency * self.slow_factor if slow else latency
+
+    def maybe_fail(self):
+        """Raises a `FakeProviderError` for a fraction `error_rate` of the calls."""
+        with self._lock:
+            if self._random.random() >= self.error_rate:
+                return
+            self._failures += 1
+            status = 429 if self._failures % 3 == 0 else 503
+        raise FakeProviderError(status)
+
+
+TURBULENCE = Turbulence()
+
+
+def _usage(prompt: str, completion: str) -> Dict[str, int]:
+    # 粗略估计token数，只为让tracing里的token统计有数据
+    input_tokens, output_tokens = len(prompt) // 2 + 4, len(completion) // 2 + 4
+    return {'input_tokens': input_tokens, 'output_tokens': output_tokens, 'total_tokens': input_tokens + output_tokens}
+
+
+def fake_record(image_type: str, seed: int, missing_abstract: bool = False) -> Dict[str, Any]:
+    """Returns a valid record of `image_type` whose content depends on `seed`."""
+    if image_type == '活动':
+        day = seed % 28 + 1
+        return {"activity_name": f"技术分享会{seed}", "activity_date": f"{day:02d}/{seed % 12 + 1:02d}/26",
+                "activity_location": f"{seed % 9 + 1}号楼报告厅", "activity_content": "嘉宾演讲与交流"}
+    if image_type == '经验':
+        return {"experience_type": "学习", "experience_content": f"坚持每天复盘第{seed}条笔记", "reason": ""}
+    return {"paper_title": f"Benchmark Paper {seed}",
+            "abstract": "无明确内容" if missing_abstract else f"A study of topic {seed}."}
+
+
+def _image_seed(image: str) -> int:
+    # 预处理后的文件名是"<内容哈希>_<设置指纹>.jpg"，只用哈希部分，不同尺寸的副本类别相同
+    name = os.path.basename(image)
+    match = re.fullmatch(r'([0-9a-f]{64})_[0-9a-f]{8}\.jpg', name)
+    return zlib.crc32((match.group(1) if match else image).encode('utf-8'))
+
+
+class FakeVLM(BaseChatModel):
+    """A VLM that answers classification, extraction and fused prompts.
+
+    The category of an image is derived from the content hash in its
+    preprocessed file name, so it is stable across runs and image sizes.
+    Batched classification prompts get one label per image.
+
+    Attributes:
+        latency: Seconds slept per call.
+        missing_abstract_every: Every n-th paper has no abstract (0 disables),
+            which makes the pipeline run its search step.
+        chunk_size: Characters per streamed chunk; streamed answers end with
+            some chatter after the JSON and spread `latency` over the chunks.
+    """
+    latency: float = 0.0
+    missing_abstract_every: int = 2
+    chunk_size: int = 16
+
+    @property
+    def _llm_type(self) -> str:
+        return 'fake-vlm'
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        time.sleep(TURBULENCE.latency(self.latency))
+        TURBULENCE.maybe_fail()
+        return self._answer(messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        await asyncio.sleep(TURBULENCE.latency(self.latency))
+        TURBULENCE.maybe_fail()
+        return self._answer(messages)
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        pieces, delay = self._pieces(messages)
+        for piece in pieces:
+            time.sleep(delay)
+            yield piece
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        pieces, delay = self._pieces(messages)
+        for piece in pieces:
+            await asyncio.sleep(delay)
+            yield piece
+
+    def _pieces(self, messages):
+        TURBULENCE.maybe_fail()
+        prompt, text = self._answer_text(messages)
+        text += '\n\n以上是根据图片内容整理的结果，如有遗漏请补充说明。' * 3
+        parts = [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)]
+        pieces = []
+        for i, part in enumerate(parts):
+            usage = _usage(prompt if i == 0 else '', part)
+            if i:
+                usage['total_tokens'] -= usage['input_tokens']
+                usage['input_tokens'] = 0
+            pieces.append(ChatGenerationChunk(message=AIMessageChunk(content=[{'text': part}], usage_metadata=usage)))
+        return pieces, TURBULENCE.latency(self.latency) / len(parts)
+
+    def _answer(self, messages) -> ChatResult:
+        prompt, text = self._answer_text(messages)
+        message = AIMessage(content=[{'text': text}], usage_metadata=_usage(prompt, text))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _answer_text(self, messages):
+        content = messages[-1].content
+        prompt = content[0]['text']
+        images = [part['image'] for part in content if part.get('type') == 'image']
+        if '"结果"' in prompt:
+            STATS.count('vlm')
+            answer = {"结果": [{"图片": number, "类型": IMAGE_TYPES[_image_seed(image) % len(IMAGE_TYPES)]}
+                             for number, image in enumerate(images, 1)]}
+            return prompt, '```json\n' + json.dumps(answer, ensure_ascii=False) + '\n```'
+        image = images[0]
+        STATS.count('vlm', image)
+
+        seed = _image_seed(image)
+        image_type = IMAGE_TYPES[seed % len(IMAGE_TYPES)]
+        missing = bool(self.missing_abstract_every) and (seed // 3) % self.missing_abstract_every == 0
+        record = fake_record(image_type, seed, missing)
+        if '"数据"' in prompt:
+            answer = {"类型": image_type, "数据": record}
+        elif '"分析"' in prompt:
+            answer = {"分析": "benchmark", "类型": image_type}
+        else:
+            # 提取prompt只包含一个类型的字段，按字段名判断
+            requested = next((t for t in IMAGE_TYPES if next(iter(fake_record(t, 0))) in prompt), image_type)
+            answer = fake_record(requested, seed, missing)
+        return prompt, '```json\n' + json.dumps(answer, ensure_ascii=False) + '\n```'
+
+
+class FakeLLM(BaseChatModel):
+    """An orchestrator LLM that replays a fixed tool-call script.
+
+    The n-th response calls the n-th tool of `script`, with arguments taken
+    from the task prompt and the previous tool results; after the script it
+    answers without tool calls. Reflection prompts are answered with CONTINUE.
+
+    Attributes:
+        latency: Seconds slept per call.
+        script: Tool names called in order.
+    """
+    latency: float = 0.0
+    script: List[str] = DEFAULT_SCRIPT
+
+    @property
+    def _llm_type(self) -> str:
+        return 'fake-llm'
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        time.sleep(TURBULENCE.latency(self.latency))
+        TURBULENCE.maybe_fail()
+        return self._answer(messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        await asyncio.sleep(TURBULENCE.latency(self.latency))
+        TURBULENCE.maybe_fail()
+        return self._answer(messages)
+
+    def _answer(self, messages) -> ChatResult:
+        first = messages[0].content if isinstance(messages[0], HumanMessage) else ''
+        if 'quality assurance expert' in first:
+            STATS.count('llm_reflection')
+            message = AIMessage(content='CONTINUE', usage_metadata=_usage(first, 'CONTINUE'))
+            return ChatResult(generations=[ChatGeneration(message=message)])
+
+        match = re.search(r'path: (\S+)', first)
+        image = match.group(1) if match else None
+        STATS.count('llm', image)
+        step = sum(1 for m in messages if isinstance(m, AIMessage) and m.tool_calls)
+        if step >= len(self.script):
+            message = AIMessage(content='All steps are done.', usage_metadata=_usage(first, 'done'))
+        else:
+            name = self.script[step]
+            call = {'name': name, 'args': self._arguments(name, image, messages), 'id': f'call_{step}'}
+            message = AIMessage(content='', tool_calls=[call], usage_metadata=_usage(first, json.dumps(call)))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    @staticmethod
+    def _arguments(name: str, image: Optional[str], messages) -> Dict[str, Any]:
+        results = {m.name: m.content for m in messages if isinstance(m, ToolMessage)}
+        image_type, data = results.get('classify_image', '论文'), {}
+        if 'classify_and_extract' in results:
+            fused = json.loads(results['classify_and_extract'])
+            image_type, data = fused['image_type'], fused['data']
+        if 'extract_info_from_image' in results:
+            data = json.loads(results['extract_info_from_image'])
+        if name in ('classify_image', 'classify_and_extract'):
+            return {'image_path': image}
+        if name == 'extract_info_from_image':
+            return {'image_path': image, 'image_type': image_type}
+        if name == 'google_search':
+            return {'query': data.get('paper_title', 'benchmark')}
+        return {'data': data, 'image_type': image_type}
+
+
+class FakeSearchBackend(SearchBackend):
+    """A search backend that returns a canned result after `latency` seconds."""
+    name = 'fake'
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+
+    def search(self, query: str) -> str:
+        time.sleep(TURBULENCE.latency(self.latency))
+        TURBULENCE.maybe_fail()
+        STATS.count('search')
+        return self._results(query)
+
+    async def asearch(self, query: str) -> str:
+        await asyncio.sleep(TURBULENCE.latency(self.latency))
+        TURBULENCE.maybe_fail()
+        STATS.count('search')
+        return self._results(query)
+
+    @staticmethod
+    def _results(query: str) -> str:
+        return format_results([
+            {'title': query, 'snippet': "An abstract returned by the fake search backend.",
+             'link': 'https://example.org/paper'},
+            {'title': "An unrelated paper", 'snippet': "Not the abstract.", 'link': 'https://example.org/other'},
+        ])
+
+
+def install_fakes(vlm_latency: float = 0.0, llm_latency: float = 0.0, search_latency: float = 0.0,
+                  script: Optional[List[str]] = None, search_cache_path: str = ':memory:'):
+    """Routes every VLM, LLM and search call of this process to the fakes.
+
+    Args:
+        vlm_latency: Seconds per VLM call.
+        llm_latency: Seconds per LLM call.
+        search_latency: Seconds per search backend call.
+        script: The orchestrator's tool-call script; defaults to `DEFAULT_SCRIPT`.
+        search_cache_path: SQLite file of the search cache; in-memory by default.
+    """
+    llm_kwargs = {'latency': llm_latency}
+    if script is not None:
+        llm_kwargs['script'] = script
+    clients.register_factory('vlm', lambda cfg: FakeVLM(latency=vlm_latency))
+    clients.register_factory('llm', lambda cfg: FakeLLM(**llm_kwargs))
+    use_search_service(SearchService(FakeSearchBackend(search_latency), SearchCache(search_cache_path)))
+    STATS.reset()
@@ -0,0 +1,315 @@
+"""Offline throughput benchmarks of the ingest loop and the database writer.
+
+Every model and search call goes to the fakes in `benchmarks.fakes`, so no API
+keys or network access are needed. Results are written to
+`benchmarks/results/` as JSON, tagged with the current git commit, and
+`--compare` prints the change against the previous result of each scenario.
+
+Scenarios:
+    pipeline  ingest a corpus in pipeline mode (classify → extract → search → save)
+    agent     ingest a corpus in agent mode, the fake LLM replaying a tool-call script
+    pipeline-async, agent-async
+              the same on one asyncio event loop with `arun_batch`
+    db        concurrent `save_data_to_db` calls
+    startup   cold `python main.py` with no new images, checked against a time budget
+
+Usage:
+    python -m benchmarks.run --scenario all --images 100 --compare
+"""
+import os
+import sys
+import glob
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(PROJECT_ROOT, 'benchmarks', 'results')
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+# 基准测试不能命中之前运行留下的VLM缓存
+os.environ['VLM_CACHE_BYPASS'] = '1'
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Returns the nearest-rank q-th percentile of `values` (0 if empty)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def git_commit() -> str:
+    """Returns the short hash of HEAD, with '-dirty' if the tree has changes."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=PROJECT_ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=PROJECT_ROOT,
+                               capture_output=True, text=True).stdout.strip()
+        return f"{commit}-dirty" if dirty else commit
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def _use_database(work_dir: str, name: str):
+    os.environ['DB_PATH'] = os.path.join(work_dir, f'{name}.db')
+
+
+def bench_ingest(mode: str, image_paths: List[str], concurrency: int, work_dir: str,
+                 use_async: bool = False) -> Dict[str, Any]:
+    """Ingests `image_paths` with `run_batch` (or `arun_batch` if `use_async`) in the given run mode."""
+    from utils.config_loader import config
+    from utils.batch import run_batch, arun_batch
+    from utils.db_writer import get_db_writer
+    from utils.resilience import reset_guards, provider_metrics
+    from utils.validators import reset_decision_counts, decision_counts
+    from utils.preclassifier import reset_gate_stats, gate_stats
+    from utils.vlm_cache import get_vlm_cache
+    from benchmarks.fakes import STATS
+
+    config.setdefault('agent', {})['mode'] = mode
+    _use_database(work_dir, f"{mode}-async" if use_async else mode)
+    from ingest import ingest_image, aingest_image, classify_ahead, aclassify_ahead
+
+    async def _run_async():
+        await aclassify_ahead(image_paths)
+        return [result async for result in arun_batch(image_paths, aingest_image, max_concurrency=concurrency)]
+
+    STATS.reset()
+    reset_guards()
+    reset_decision_counts()
+    reset_gate_stats()
+    get_vlm_cache().reset_stats()
+    start = time.perf_counter()
+    if use_async:
+        results = asyncio.run(_run_async())
+    else:
+        classify_ahead(image_paths)
+        results = list(run_batch(image_paths, ingest_image, max_concurrency=concurrency))
+    get_db_writer().flush()
+    wall = time.perf_counter() - start
+
+    ok = [r for r in results if r.ok]
+    saved = [r for r in ok if r.value.record_id is not None]
+    latencies = [r.elapsed * 1000 for r in ok]
+    calls = STATS.snapshot()
+    guards = provider_metrics().values()
+    decisions = decision_counts()
+    gate = gate_stats()
+    cache = get_vlm_cache()
+    n = len(image_paths) or 1
+    return {
+        'images': len(image_paths),
+        'ok': len(ok),
+        'errors': len(results) - len(ok),
+        'wall_seconds': round(wall, 3),
+        'images_per_sec': round(len(ok) / wall, 2),
+        'p50_ms': round(percentile(latencies, 50), 1),
+        'p99_ms': round(percentile(latencies, 99), 1),
+        'orchestrator_steps_per_image': round(calls.get('llm', 0) / n, 2),
+        'reflection_calls_per_image': round(calls.get('llm_reflection', 0) / n, 2),
+        'vlm_calls_per_image': round(calls.get('vlm', 0) / n, 2),
+        'search_calls': calls.get('search', 0),
+        'db_inserts_per_sec': round(len(saved) / wall, 2),
+        'provider_retries': sum(g['retries'] for g in guards),
+        'hedged_calls': sum(g['hedges'] for g in guards),
+        'circuit_rejections': sum(g['rejected'] for g in guards),
+        'rule_decisions_per_image': round(sum(v for k, v in decisions.items() if k.startswith('rule:')) / n, 2),
+        'llm_decisions_per_image': round(sum(v for k, v in decisions.items() if k.startswith('llm:')) / n, 2),
+        'preclassifier_hits_per_image': round(gate['hits'] / n, 2),
+        'vlm_cache_hits': cache.hits,
+        'vlm_cache_misses': cache.misses,
+    }
+
+
+def bench_db(records: int, threads: int, work_dir: str) -> Dict[str, Any]:
+    """Saves `records` records through `save_data_to_db` from `threads` threads."""
+    from utils.tools import save_data_to_db
+    from utils.db_writer import get_db_writer
+    from benchmarks.fakes import IMAGE_TYPES, fake_record
+
+    _use_database(work_dir, 'db')
+    latencies: List[float] = []
+    failures: List[str] = []
+    lock = threading.Lock()
+
+    def worker(offset: int):
+        for i in range(offset, records, threads):
+            image_type = IMAGE_TYPES[i % len(IMAGE_TYPES)]
+            t0 = time.perf_counter()
+            result = save_data_to_db.invoke({"data": fake_record(image_type, i), "image_type": image_type})
+            elapsed = (time.perf_counter() - t0) * 1000
+            with lock:
+                latencies.append(elapsed)
+                if not result.startswith("Data successfully saved"):
+                    failures.append(result)
+
+    # 先写一条，建表和迁移的开销不计入吞吐
+    save_data_to_db.invoke({"data": fake_record('活动', 0), "image_type": '活动'})
+    start = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    get_db_writer().flush()
+    wall = time.perf_counter() - start
+    return {
+        'records': records,
+        'threads': threads,
+        'errors': len(failures),
+        'wall_seconds': round(wall, 3),
+        'db_inserts_per_sec': round((records - len(failures)) / wall, 1),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+    }
+
+
+# main.py在没有新图片时不应该导入这些模块
+HEAVY_MODULES = ('agent', 'langgraph', 'langchain_core', 'langchain_openai', 'langchain_community', 'gradio')
+
+
+def bench_startup(work_dir: str, runs: int = 5, budget: float = 1.0) -> Dict[str, Any]:
+    """Times cold `python main.py` runs on an empty image folder.
+
+    Also lists the heavy modules that importing `main` pulls in; there should
+    be none.
+    """
+    empty_dir = os.path.join(work_dir, 'empty')
+    os.makedirs(empty_dir, exist_ok=True)
+    env = dict(os.environ, DB_PATH=os.path.join(work_dir, 'startup.db'))
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(PROJECT_ROOT, 'main.py'), '--image-dir', empty_dir],
+                       cwd=work_dir, env=env, check=True, capture_output=True)
+        timings.append((time.perf_counter() - start) * 1000)
+    probe = (f"import sys, json; sys.path.insert(0, {PROJECT_ROOT!r}); import main; "
+             f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))")
+    heavy = json.loads(subprocess.run([sys.executable, '-c', probe], cwd=work_dir, env=env, check=True,
+                                      capture_output=True, text=True).stdout.strip().splitlines()[-1])
+    return {
+        'runs': runs,
+        'cold_start_min_ms': round(min(timings), 1),
+        'cold_start_p50_ms': round(percentile(timings, 50), 1),
+        'budget_ms': round(budget * 1000, 1),
+        'heavy_modules_imported': heavy,
+        'within_budget': percentile(timings, 50) <= budget * 1000 and not heavy,
+    }
+
+
+def save_result(scenario: str, params: Dict[str, Any], metrics: Dict[str, Any]) -> str:
+    """Writes one benchmark result to `benchmarks/results/` and returns its path."""
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    commit = git_commit()
+    timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    path = os.path.join(RESULTS_DIR, f"{timestamp}_{commit}_{scenario}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'scenario': scenario, 'commit': commit, 'timestamp': timestamp,
+                   'params': params, 'metrics': metrics}, f, ensure_ascii=False, indent=2)
+    return path
+
+
+def previous_result(scenario: str, exclude: str) -> Optional[Dict[str, Any]]:
+    """Returns the most recent saved result of a scenario other than `exclude`."""
+    paths = sorted(p for p in glob.glob(os.path.join(RESULTS_DIR, f'*_{scenario}.json')) if p != exclude)
+    if not paths:
+        return None
+    with open(paths[-1], 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def format_metrics(scenario: str, metrics: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None) -> str:
+    """Formats metrics as a table, with the change against `baseline` if given."""
+    lines = [f"--- {scenario} ---" + (f" (vs {baseline['commit']} {baseline['timestamp']})" if baseline else "")]
+    width = max(len(k) for k in metrics)
+    for key, value in metrics.items():
+        line = f"{key.ljust(width)}  {value}"
+        old = baseline['metrics'].get(key) if baseline else None
+        if isinstance(value, (int, float)) and isinstance(old, (int, float)):
+            change = f" ({(value - old) / old * 100:+.1f}%)" if old else ""
+            line += f"  was {old}{change}"
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks with fake LLM/VLM/search providers.")
+    parser.add_argument('--scenario', choices=['pipeline', 'agent', 'pipeline-async', 'agent-async', 'db', 'startup', 'all'], default='all')
+    parser.add_argument('--images', type=int, default=50, help="size of the synthetic corpus")
+    parser.add_argument('--corpus', help="replay the images of this directory instead of a synthetic corpus")
+    parser.add_argument('--concurrency', type=int, default=4, help="images in flight at the same time")
+    parser.add_argument('--async-concurrency', type=int, default=200,
+                        help="images in flight at the same time in the async scenarios")
+    parser.add_argument('--records', type=int, default=5000, help="records written by the db scenario")
+    parser.add_argument('--threads', type=int, default=4, help="writer threads of the db scenario")
+    parser.add_argument('--startup-budget', type=float, default=1.0,
+                        help="seconds a cold main.py with no new images may take")
+    parser.add_argument('--vlm-latency', type=float, default=0.05, help="seconds per fake VLM call")
+    parser.add_argument('--llm-latency', type=float, default=0.02, help="seconds per fake LLM call")
+    parser.add_argument('--search-latency', type=float, default=0.02, help="seconds per fake search call")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="fraction of fake provider calls failing with a transient 503/429")
+    parser.add_argument('--slow-rate', type=float, default=0.0,
+                        help="fraction of fake provider calls that are --slow-factor times slower")
+    parser.add_argument('--slow-factor', type=float, default=20.0, help="slowdown of the slow calls")
+    parser.add_argument('--script', default=None,
+                        help="comma-separated tool calls of the fake orchestrator in agent mode")
+    parser.add_argument('--no-save', action='store_true', help="do not write the results to benchmarks/results/")
+    parser.add_argument('--compare', action='store_true', help="compare with the previous result of each scenario")
+    args = parser.parse_args(argv)
+
+    from benchmarks.fakes import install_fakes, TURBULENCE
+    from benchmarks.corpus import make_corpus, copy_corpus
+    from utils.config_loader import config
+
+    work_dir = tempfile.mkdtemp(prefix='agent-bench-')
+    script = args.script.split(',') if args.script else None
+    install_fakes(args.vlm_latency, args.llm_latency, args.search_latency, script=script)
+    TURBULENCE.configure(args.error_rate, args.slow_rate, args.slow_factor)
+    # 假VLM按文件名决定类别，本地训练的预分类器会和它不一致
+    config.setdefault('preclassifier', {})['enabled'] = False
+
+    params = {k: v for k, v in vars(args).items() if k not in ('no_save', 'compare', 'scenario')}
+    scenarios = ['pipeline', 'agent', 'pipeline-async', 'agent-async', 'db', 'startup'] if args.scenario == 'all' else [args.scenario]
+    reports = []
+    failed = False
+    for scenario in scenarios:
+        print(f"--- Running benchmark '{scenario}' ---")
+        if scenario == 'db':
+            metrics = bench_db(args.records, args.threads, work_dir)
+        elif scenario == 'startup':
+            metrics = bench_startup(work_dir, budget=args.startup_budget)
+            failed = failed or not metrics['within_budget']
+        else:
+            # 每个场景使用自己的图片副本和预处理缓存，哈希和预处理的开销不会被前一个场景预热
+            scenario_dir = os.path.join(work_dir, scenario)
+            config.setdefault('image_preprocessing', {})['cache_dir'] = os.path.join(scenario_dir, 'image_cache')
+            image_paths = copy_corpus(args.corpus, os.path.join(scenario_dir, 'images')) if args.corpus \
+                else make_corpus(os.path.join(scenario_dir, 'images'), args.images)
+            if scenario.endswith('-async'):
+                metrics = bench_ingest(scenario[:-len('-async')], image_paths, args.async_concurrency, work_dir,
+                                       use_async=True)
+            else:
+                metrics = bench_ingest(scenario, image_paths, args.concurrency, work_dir)
+        path = None if args.no_save else save_result(scenario, params, metrics)
+        baseline = previous_result(scenario, exclude=path) if args.compare else None
+        reports.append(format_metrics(scenario, metrics, baseline))
+        if path:
+            reports.append(f"saved to {os.path.relpath(path, PROJECT_ROOT)}")
+    print('\n' + '\n'.join(reports))
+    if failed:
+        print(f"Startup is over its budget of {args.startup_budget}s.")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
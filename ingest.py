@@ -0,0 +1,154 @@
+import asyncio
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from agent import run_agent, arun_agent, saved_record
+from utils.config_loader import config
+from utils.dedup import dhash, get_dedup_index
+from utils.manifest import get_manifest
+from utils.tools import classify_images_batch, aclassify_images_batch, get_classification_batch_config
+
+
+class NoRecordSavedError(RuntimeError):
+    """Raised when a run finished without saving a record for its image."""
+
+
+@dataclass
+class IngestResult:
+    """The outcome of ingesting one image.
+
+    Attributes:
+        status: 'processed' or 'duplicate'.
+        record_table: The table of the record created for, or linked to, the image.
+        record_id: The id of that record.
+        duplicate_of: The path of the original image if this one is a near-duplicate.
+    """
+    status: str
+    record_table: Optional[str] = None
+    record_id: Optional[int] = None
+    duplicate_of: Optional[str] = None
+
+
+def _classifies_separately() -> bool:
+    """Returns whether runs call `classify_image`: agent mode, or the pipeline without fused extraction."""
+    agent_config = config.get('agent', {})
+    return agent_config.get('mode', 'pipeline') == 'agent' or not agent_config.get('fused_extraction', False)
+
+
+def classify_ahead(image_paths: List[str]):
+    """Classifies a backlog in batched VLM requests before its images are ingested one by one.
+
+    The labels land in the VLM cache, so the `classify_image` call of each
+    run is a cache hit. Skipped when batching is disabled, for a single
+    image, and when runs classify and extract in one fused call.
+    """
+    if len(image_paths) > 1 and _classifies_separately() and get_classification_batch_config()['enabled']:
+        classify_images_batch(image_paths)
+
+
+async def aclassify_ahead(image_paths: List[str]):
+    """Async counterpart of `classify_ahead`."""
+    if len(image_paths) > 1 and _classifies_separately() and get_classification_batch_config()['enabled']:
+        await aclassify_images_batch(image_paths)
+
+
+def ingest_image(image_path: str) -> IngestResult:
+    """Processes one image and records the outcome in the ingest manifest.
+
+    See `_ingest` for the near-duplicate check. Failures, including runs
+    that finished without saving a record (`NoRecordSavedError`), are
+    recorded as 'failed' so the image is retried on the next run, then
+    re-raised.
+
+    Args:
+        image_path: The local file path to the image.
+
+    Returns:
+        An `IngestResult` describing what happened.
+    """
+    manifest = get_manifest()
+    try:
+        result = _ingest(image_path)
+    except Exception as e:
+        manifest.mark(image_path, 'failed', error=str(e))
+        raise
+    status = 'duplicate' if result.status == 'duplicate' else 'done'
+    manifest.mark(image_path, status, result.record_table, result.record_id)
+    return result
+
+
+async def aingest_image(image_path: str) -> IngestResult:
+    """Async counterpart of `ingest_image`, running the graph with `arun_agent`."""
+    manifest = get_manifest()
+    try:
+        result = await _aingest(image_path)
+    except Exception as e:
+        await asyncio.to_thread(manifest.mark, image_path, 'failed', error=str(e))
+        raise
+    status = 'duplicate' if result.status == 'duplicate' else 'done'
+    await asyncio.to_thread(manifest.mark, image_path, status, result.record_table, result.record_id)
+    return result
+
+
+def _saved_record_of(image_path: str, final_state) -> Tuple[str, int]:
+    """Returns the record saved by a run, raising `NoRecordSavedError` if there is none."""
+    record = saved_record(final_state)
+    if record is None:
+        raise NoRecordSavedError(f"The run for {image_path} finished without saving a record")
+    return record
+
+
+def _ingest(image_path: str) -> IngestResult:
+    """Processes one image unless it is a near-duplicate of an ingested one.
+
+    The image's perceptual hash is looked up before any model call. A
+    near-duplicate is linked to the record of the original image and skipped;
+    otherwise the hash is reserved while `run_agent` runs, so near-duplicates
+    arriving meanwhile wait for this image's record instead of being
+    processed too. The reservation becomes an index entry with the saved
+    record, or is dropped if the run fails.
+    """
+    dedup_enabled = config.get('dedup', {}).get('enabled', True)
+    if not dedup_enabled:
+        return IngestResult('processed', *_saved_record_of(image_path, run_agent(image_path)))
+
+    index = get_dedup_index()
+    phash = dhash(image_path)
+    original, reservation = index.reserve(phash, image_path)
+    if original is not None:
+        print(f"--- {image_path} is a near-duplicate of {original.image_path}, skipping. ---")
+        index.add(phash, image_path, original.record_table, original.record_id, duplicate_of=original)
+        return IngestResult('duplicate', original.record_table, original.record_id, original.image_path)
+
+    try:
+        record = _saved_record_of(image_path, run_agent(image_path))
+    except BaseException:
+        index.release(reservation)
+        raise
+    index.complete(reservation, phash, image_path, *record)
+    return IngestResult('processed', *record)
+
+
+async def _aingest(image_path: str) -> IngestResult:
+    """Async counterpart of `_ingest`; hashing and index writes run in worker threads."""
+    dedup_enabled = config.get('dedup', {}).get('enabled', True)
+    if not dedup_enabled:
+        return IngestResult('processed', *_saved_record_of(image_path, await arun_agent(image_path)))
+
+    index = get_dedup_index()
+    phash = await asyncio.to_thread(dhash, image_path)
+    original, reservation = await index.areserve(phash, image_path)
+    if original is not None:
+        print(f"--- {image_path} is a near-duplicate of {original.image_path}, skipping. ---")
+        await asyncio.to_thread(index.add, phash, image_path, original.record_table, original.record_id,
+                                duplicate_of=original)
+        return IngestResult('duplicate', original.record_table, original.record_id, original.image_path)
+
+    try:
+        record = _saved_record_of(image_path, await arun_agent(image_path))
+    except BaseException:
+        # 任务被取消时也要释放预留，这里同步执行，不再await
+        index.release(reservation)
+        raise
+    await asyncio.to_thread(index.complete, reservation, phash, image_path, *record)
+    return IngestResult('processed', *record)
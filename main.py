@@ -1,32 +1,138 @@
 import os
+import asyncio
+import argparse
 from dotenv import load_dotenv
-from agent import run_agent
+from utils.batch import list_images, run_batch, arun_batch
+from utils.manifest import get_manifest
+from utils.resilience import format_provider_metrics
+from utils.watcher import watch_images
 
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '.env'))
 
+def print_result(result):
+    """Prints the outcome of one image."""
+    if result.ok and result.value.status == 'duplicate':
+        print(f"--- Skipped {result.image_path}: near-duplicate of {result.value.duplicate_of} ---\n")
+    elif result.ok:
+        print(f"--- Finished processing {result.image_path} in {result.elapsed:.1f}s ---\n")
+    else:
+        print(f"An error occurred while processing {result.image_path}: {result.error}")
+
+def process_images(image_paths, use_async=False):
+    """Ingests images concurrently and prints one line per image in input order.
+
+    With `use_async` the images run as tasks of one event loop instead of a
+    thread pool, which allows far more images in flight. When the runs
+    classify images separately, the backlog is first classified in batched
+    VLM requests (`ingest.classify_ahead`). Afterwards the
+    retries, hedged requests and latencies of each provider are printed,
+    and how many tool outputs the rules settled versus the LLM reflection.
+    """
+    if not image_paths:
+        return
+    # agent和模型客户端导入很慢，只在确实有新图片时才导入
+    from ingest import ingest_image, aingest_image, classify_ahead, aclassify_ahead
+    from utils.validators import format_decision_counts
+    from utils.preclassifier import format_gate_stats
+    from utils.vlm_cache import format_cache_stats
+
+    if use_async:
+        async def _process():
+            await aclassify_ahead(image_paths)
+            async for result in arun_batch(image_paths, aingest_image):
+                print_result(result)
+        asyncio.run(_process())
+    else:
+        classify_ahead(image_paths)
+        for result in run_batch(image_paths, ingest_image):
+            print_result(result)
+    metrics = format_provider_metrics()
+    if metrics:
+        print(f"--- Provider calls ---\n{metrics}")
+    cache_stats = format_cache_stats()
+    if cache_stats:
+        print(f"--- VLM cache ---\n{cache_stats}")
+    decisions = format_decision_counts()
+    if decisions:
+        print(f"--- Reflection decisions ---\n{decisions}")
+    gate = format_gate_stats()
+    if gate:
+        print(f"--- Pre-classifier ---\n{gate}")
+
+def enqueue_images(image_paths):
+    """Adds images to the ingest job queue, to be processed by `worker.py`."""
+    if not image_paths:
+        return
+    from utils.job_queue import get_job_queue
+
+    queue = get_job_queue()
+    added = queue.enqueue(image_paths)
+    print(f"--- Enqueued {added} images ({len(image_paths) - added} already queued); jobs: {queue.stats()} ---")
+
+def watch_batch(manifest, paths, retry_failed_after):
+    """Returns the images to handle for one batch yielded by `watch_images`.
+
+    Only the yielded paths are checked against the manifest, so a watch cycle
+    does not rescan the folder. Images whose last run failed are not retried
+    just because some other file arrived; they are added once their failure
+    is at least `retry_failed_after` seconds old (never if it is negative).
+    """
+    batch = manifest.pending(paths, include_failed=False)
+    if retry_failed_after < 0:
+        return batch
+    retry = [path for path in manifest.failed(retry_failed_after) if path not in batch]
+    if retry:
+        print(f"--- Retrying {len(retry)} images that failed at least {retry_failed_after:.0f}s ago ---")
+    return batch + retry
+
 def main():
     """Executes the main image processing workflow.
 
-    This function scans the 'images' directory for image files (PNG, JPG, JPEG),
-    and then iterates through each file, calling the `run_agent` function to
-    process it. It prints status messages before and after processing each image
-    and catches any exceptions that occur during the agent's execution.
+    This function scans the 'images' directory for image files (PNG, JPG, JPEG)
+    and processes the new or changed ones concurrently with `run_batch`,
+    calling `ingest_image` for each file so that near-duplicates of ingested
+    images are skipped. Images already recorded in the ingest manifest are
+    not touched again. Results are printed in the original file order and
+    exceptions or timeouts of a single image do not stop the others.
+
+    With `--watch`, the directory is watched afterwards and new images are
+    processed as they arrive; images that failed are retried every
+    `--retry-failed-after` seconds. With `--async`, images are processed on an
+    asyncio event loop (`arun_batch`) instead of the thread pool. With
+    `--enqueue`, the images are only added to the job queue and processed by
+    `worker.py` processes, possibly on other machines sharing the database.
     """
+    parser = argparse.ArgumentParser(description="Analyze the images in the 'images' folder.")
+    parser.add_argument('--watch', action='store_true', help="keep running and process new images as they arrive")
+    parser.add_argument('--image-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "images"),
+                        help="the folder of images to analyze")
+    parser.add_argument('--poll-interval', type=float, default=5.0, help="seconds between scans when inotify is unavailable")
+    parser.add_argument('--retry-failed-after', type=float, default=600.0,
+                        help="seconds before --watch retries an image that failed; negative to never retry")
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="process images on an asyncio event loop instead of threads")
+    parser.add_argument('--enqueue', action='store_true',
+                        help="add the images to the job queue for worker.py instead of processing them here")
+    args = parser.parse_args()
+
     # You can process multiple images by iterating through a directory
-    image_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "images")
-    for image_file in os.listdir(image_dir):
-        if image_file.lower().endswith(('.png', '.jpg', '.jpeg')):
-            image_path = os.path.join(image_dir, image_file)
-  
-            
-
-
-            print(f"--- Processing image: {image_path} ---")
-            try:
-                run_agent(image_path)
-            except Exception as e:
-                print(f"An error occurred while processing {image_path}: {e}")
-            print(f"--- Finished processing {image_path} ---\n")
+    image_dir = args.image_dir
+    manifest = get_manifest()
+    all_images = list_images(image_dir)
+    image_paths = manifest.pending(all_images)
+    print(f"--- {len(image_paths)} of {len(all_images)} images are new or changed ---")
+    handle = enqueue_images if args.enqueue else lambda paths: process_images(paths, args.use_async)
+    handle(image_paths)
+
+    if args.watch:
+        print(f"--- Watching {image_dir} for new images (Ctrl+C to stop) ---")
+        try:
+            # 没有新图片时也定期醒来，重试到期的失败图片
+            idle_timeout = max(args.retry_failed_after, args.poll_interval) if args.retry_failed_after >= 0 else None
+            for paths in watch_images(image_dir, poll_interval=args.poll_interval, idle_timeout=idle_timeout):
+                handle(watch_batch(manifest, paths, args.retry_failed_after))
+        except KeyboardInterrupt:
+            print("--- Stopped watching ---")
 
 if __name__ == "__main__":
     # Example: run agent on a single image
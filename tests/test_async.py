@@ -0,0 +1,150 @@
+import asyncio
+import shutil
+
+import pytest
+from langchain_core.messages import ToolMessage
+
+import agent
+import ingest
+from utils.batch import arun_batch, async_provider_slot
+from utils.config_loader import PROJECT_ROOT, config
+from utils.search import format_results
+
+SAVED = "Data successfully saved to table 'paper_info' (id=7)."
+
+
+class _FakeTool:
+    """Stands in for a tool in `agent`, recording whether it was called through invoke or ainvoke."""
+
+    def __init__(self, calls, name, result):
+        self.calls, self.name, self.result = calls, name, result
+
+    def invoke(self, args):
+        self.calls.append(('sync', self.name))
+        return self.result
+
+    async def ainvoke(self, args):
+        self.calls.append(('async', self.name))
+        await asyncio.sleep(0)
+        return self.result
+
+
+@pytest.fixture
+def tools(tmp_path, monkeypatch):
+    monkeypatch.setenv('DB_PATH', str(tmp_path / 'agent.db'))
+    monkeypatch.setitem(config, 'checkpoint', {'enabled': False})
+    monkeypatch.setitem(config, 'agent', {**config.get('agent', {}), 'mode': 'pipeline', 'fused_extraction': False})
+    calls = []
+    results = {
+        'classify_image': '论文',
+        'extract_info_from_image': {'paper_title': 'Attention Is All You Need', 'abstract': '无明确内容'},
+        'google_search': format_results([{'title': 'Attention Is All You Need',
+                                          'snippet': 'The dominant sequence transduction models.', 'link': 'a'}]),
+        'save_data_to_db': SAVED,
+    }
+    for name, result in results.items():
+        monkeypatch.setattr(agent, name, _FakeTool(calls, name, result))
+    return calls
+
+
+def test_async_pipeline_awaits_every_step(tools):
+    final_state = asyncio.run(agent.arun_agent('a.jpg'))
+    assert tools == [('async', 'classify_image'), ('async', 'extract_info_from_image'),
+                     ('async', 'google_search'), ('async', 'save_data_to_db')]
+    assert final_state['data']['abstract'] == 'The dominant sequence transduction models.'
+    assert agent.saved_record(final_state) == ('paper_info', 7)
+
+
+def test_async_pipeline_falls_back_to_the_agent_graph(tools, monkeypatch):
+    agent.classify_image.result = '菜谱'
+    prompts = []
+
+    class FakeApp:
+        async def ainvoke(self, inputs):
+            prompts.append(inputs['messages'][0].content)
+            return {'messages': [ToolMessage(content=SAVED, name='save_data_to_db', tool_call_id='1')]}
+
+    monkeypatch.setattr(agent, 'get_app', FakeApp)
+    final_state = asyncio.run(agent.arun_agent('a.jpg'))
+    assert tools == [('async', 'classify_image')]
+    assert 'Unknown image type: 菜谱' in prompts[0]
+    assert agent.saved_record(final_state) == ('paper_info', 7)
+
+
+def _collect(image_paths, worker, **kwargs):
+    async def collect():
+        return [result async for result in arun_batch(image_paths, worker, **kwargs)]
+    return asyncio.run(collect())
+
+
+def test_async_results_come_in_input_order_and_errors_stay_with_their_image():
+    async def worker(path):
+        await asyncio.sleep(0.05 if path == 'a' else 0.0)  # a finishes last
+        if path == 'b':
+            raise ValueError('broken image')
+        return path.upper()
+
+    results = _collect(['a', 'b', 'c'], worker, max_concurrency=3, timeout=5)
+    assert [r.image_path for r in results] == ['a', 'b', 'c']
+    assert [r.value for r in results] == ['A', None, 'C']
+    assert 'ValueError: broken image' in results[1].error
+
+
+def test_a_slow_image_is_cancelled_at_its_timeout():
+    cancelled = []
+
+    async def worker(path):
+        if path == 'slow':
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(path)
+                raise
+        return path
+
+    results = _collect(['slow', 'fast'], worker, max_concurrency=2, timeout=0.1)
+    assert (results[0].ok, results[0].timed_out) == (False, True)
+    assert (results[1].ok, results[1].value) == (True, 'fast')
+    # 和线程池不同，超时的协程会真正被取消
+    assert cancelled == ['slow']
+
+
+def test_async_concurrency_and_provider_limits(monkeypatch):
+    monkeypatch.setitem(config, 'batch', {'provider_limits': {'test-provider': 1}})
+    running, peak, inside, overlap = [0], [0], [0], []
+
+    async def worker(path):
+        running[0] += 1
+        peak[0] = max(peak[0], running[0])
+        async with async_provider_slot('test-provider'):
+            inside[0] += 1
+            overlap.append(inside[0])
+            await asyncio.sleep(0.01)
+            inside[0] -= 1
+        running[0] -= 1
+
+    results = _collect([str(i) for i in range(8)], worker, max_concurrency=3, timeout=5)
+    assert all(r.ok for r in results)
+    assert peak[0] == 3
+    assert max(overlap) == 1
+
+
+def test_a_cancelled_ingest_releases_its_dedup_reservation(tmp_path, monkeypatch):
+    monkeypatch.setenv('DB_PATH', str(tmp_path / 'agent.db'))
+    monkeypatch.setitem(config, 'dedup', {**config.get('dedup', {}), 'enabled': True})
+    image = str(tmp_path / 'a.jpg')
+    shutil.copy(f'{PROJECT_ROOT}/images/195233.jpg', image)
+
+    async def hanging_run(path):
+        await asyncio.sleep(5)
+
+    async def saving_run(path):
+        return {'save_result': SAVED}
+
+    monkeypatch.setattr(ingest, 'arun_agent', hanging_run)
+    (timed_out,) = _collect([image], ingest.aingest_image, timeout=0.1)
+    assert timed_out.timed_out
+    # 预留已经释放，再次处理同一张图片不会被当作重复图片去等待
+    monkeypatch.setattr(ingest, 'arun_agent', saving_run)
+    (result,) = _collect([image], ingest.aingest_image, timeout=5)
+    assert (result.value.status, result.value.record_id) == ('processed', 7)
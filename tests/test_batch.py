@@ -0,0 +1,83 @@
+import threading
+import time
+
+from utils.batch import list_images, provider_slot, run_batch
+from utils.config_loader import config
+
+
+def test_results_come_in_input_order_and_errors_stay_with_their_image():
+    def worker(path):
+        time.sleep(0.05 if path == 'a' else 0.0)  # a finishes last
+        if path == 'b':
+            raise ValueError('broken image')
+        return path.upper()
+
+    results = list(run_batch(['a', 'b', 'c'], worker, max_concurrency=3, timeout=5))
+    assert [r.image_path for r in results] == ['a', 'b', 'c']
+    assert [r.ok for r in results] == [True, False, True]
+    assert [r.value for r in results] == ['A', None, 'C']
+    assert 'ValueError: broken image' in results[1].error
+
+
+def test_at_most_max_concurrency_images_run_at_once():
+    running, peak = [0], [0]
+    lock = threading.Lock()
+
+    def worker(path):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+
+    results = list(run_batch([str(i) for i in range(8)], worker, max_concurrency=2, timeout=5))
+    assert all(r.ok for r in results)
+    assert peak[0] == 2
+
+
+def test_a_slow_image_times_out_without_holding_up_the_others():
+    release = threading.Event()
+
+    def worker(path):
+        if path == 'slow':
+            release.wait(5)
+        return path
+
+    start = time.monotonic()
+    try:
+        results = list(run_batch(['slow', 'fast'], worker, max_concurrency=2, timeout=0.2))
+    finally:
+        release.set()
+    assert time.monotonic() - start < 2
+    assert (results[0].ok, results[0].timed_out) == (False, True)
+    assert 'Timed out after 0.2 seconds' in results[0].error
+    assert (results[1].ok, results[1].value) == (True, 'fast')
+
+
+def test_provider_slots_limit_concurrent_requests(monkeypatch):
+    monkeypatch.setitem(config, 'batch', {'provider_limits': {'test-provider': 1}})
+    inside, overlap = [0], []
+    lock = threading.Lock()
+
+    def call():
+        with provider_slot('test-provider'):
+            with lock:
+                inside[0] += 1
+                overlap.append(inside[0])
+            time.sleep(0.02)
+            with lock:
+                inside[0] -= 1
+
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(overlap) == 1
+
+
+def test_list_images_keeps_only_supported_images_sorted(tmp_path):
+    for name in ('b.PNG', 'a.jpg', 'notes.txt', 'c.jpeg'):
+        (tmp_path / name).write_bytes(b'')
+    assert list_images(str(tmp_path)) == [str(tmp_path / n) for n in ('a.jpg', 'b.PNG', 'c.jpeg')]
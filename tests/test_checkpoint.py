@@ -0,0 +1,130 @@
+import asyncio
+import shutil
+from types import SimpleNamespace
+
+import pytest
+
+import agent
+from agent import _plan_run
+from utils import checkpoint
+from utils.config_loader import PROJECT_ROOT, config
+
+SAVED = "Data successfully saved to table 'activity_log' (id=3)."
+INITIAL = {'image_path': 'a.jpg'}
+
+
+@pytest.mark.parametrize('snapshot, resume, action', [
+    (None, True, 'start'),
+    (SimpleNamespace(values={}, next=()), True, 'start'),
+    (SimpleNamespace(values={'image_type': '活动'}, next=('extract',)), True, 'resume'),
+    (SimpleNamespace(values={'save_result': SAVED}, next=()), True, 'skip'),
+    # 运行结束了但没有保存记录，重新开始而不是跳过
+    (SimpleNamespace(values={'save_result': 'Error saving data: locked'}, next=()), True, 'restart'),
+    (SimpleNamespace(values={'image_type': '活动'}, next=('extract',)), False, 'restart'),
+    (SimpleNamespace(values={'save_result': SAVED}, next=()), False, 'restart'),
+])
+def test_plan_run(snapshot, resume, action):
+    planned, state = _plan_run(snapshot, 'a.jpg', 'pipeline', resume)
+    assert planned == action
+    if action in ('start', 'restart'):
+        assert state == INITIAL
+    else:
+        assert state == snapshot.values
+
+
+def test_agent_mode_starts_from_the_prompt():
+    action, state = _plan_run(None, 'a.jpg', 'agent', True)
+    assert action == 'start'
+    assert 'a.jpg' in state['messages'][0].content
+
+
+class _FakeTool:
+    def __init__(self, calls, name, results):
+        self.calls, self.name, self.results = calls, name, results
+
+    def invoke(self, args):
+        self.calls.append(self.name)
+        result = self.results[self.name]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def ainvoke(self, args):
+        return self.invoke(args)
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    monkeypatch.setenv('DB_PATH', str(tmp_path / 'agent.db'))
+    monkeypatch.setitem(config, 'checkpoint', {'enabled': True, 'path': str(tmp_path / 'checkpoints.db')})
+    monkeypatch.setitem(config, 'agent', {**config.get('agent', {}), 'mode': 'pipeline', 'fused_extraction': False})
+    image = str(tmp_path / 'a.jpg')
+    shutil.copy(f'{PROJECT_ROOT}/images/195233.jpg', image)
+    calls = []
+    results = {'classify_image': '活动', 'extract_info_from_image': {'activity_name': 'A'},
+               'save_data_to_db': RuntimeError('database is locked')}
+    for name in results:
+        monkeypatch.setattr(agent, name, _FakeTool(calls, name, results))
+    yield image, calls, results
+    saver = checkpoint._savers.pop(config['checkpoint']['path'], None)
+    if saver is not None:
+        saver.conn.close()
+
+
+def test_a_failed_run_resumes_at_the_failed_step(pipeline):
+    image, calls, results = pipeline
+    with pytest.raises(RuntimeError, match='locked'):
+        agent.run_agent(image)
+    assert calls == ['classify_image', 'extract_info_from_image', 'save_data_to_db']
+
+    calls.clear()
+    results['save_data_to_db'] = SAVED
+    final_state = agent.run_agent(image)
+    # 分类和提取的结果来自checkpoint，不再调用模型
+    assert calls == ['save_data_to_db']
+    assert final_state['data'] == {'activity_name': 'A'}
+    assert agent.saved_record(final_state) == ('activity_log', 3)
+
+    calls.clear()
+    assert agent.saved_record(agent.run_agent(image)) == ('activity_log', 3)
+    assert calls == []
+
+
+def test_an_async_run_resumes_the_checkpoints_of_a_sync_run(pipeline):
+    image, calls, results = pipeline
+    with pytest.raises(RuntimeError):
+        agent.run_agent(image)
+    calls.clear()
+    results['save_data_to_db'] = SAVED
+    final_state = asyncio.run(agent.arun_agent(image))
+    assert calls == ['save_data_to_db']
+    assert agent.saved_record(final_state) == ('activity_log', 3)
+
+
+def test_resume_false_discards_the_old_checkpoints(pipeline):
+    image, calls, results = pipeline
+    results['save_data_to_db'] = SAVED
+    agent.run_agent(image)
+    calls.clear()
+    results['classify_image'] = '经验'
+    final_state = agent.run_agent(image, resume=False)
+    assert calls == ['classify_image', 'extract_info_from_image', 'save_data_to_db']
+    assert final_state['image_type'] == '经验'
+
+    saver = checkpoint.get_checkpointer()
+    thread = {'configurable': {'thread_id': checkpoint.thread_id_for(image, 'pipeline')}}
+    # 旧的checkpoint已删除，历史里只剩这次运行
+    image_types = {item.checkpoint['channel_values'].get('image_type') for item in saver.list(thread)}
+    assert '经验' in image_types and '活动' not in image_types
+
+
+def test_modes_and_image_contents_have_their_own_threads(tmp_path):
+    image = str(tmp_path / 'a.jpg')
+    shutil.copy(f'{PROJECT_ROOT}/images/195233.jpg', image)
+    other = str(tmp_path / 'b.jpg')
+    shutil.copy(image, other)
+    assert checkpoint.thread_id_for(image, 'pipeline') == checkpoint.thread_id_for(other, 'pipeline')
+    assert checkpoint.thread_id_for(image, 'pipeline') != checkpoint.thread_id_for(image, 'agent')
+    with open(other, 'ab') as f:
+        f.write(b'\0')
+    assert checkpoint.thread_id_for(image, 'pipeline') != checkpoint.thread_id_for(other, 'pipeline')
@@ -0,0 +1,158 @@
+import asyncio
+import json
+
+import pytest
+
+import ingest
+from utils import tools
+from utils.config_loader import config
+from utils.image_prep import PreparedImage
+
+
+@pytest.fixture
+def batch(monkeypatch):
+    """Classifies with a scripted batched VLM answer, keyed by image path instead of file hash."""
+    answers = []
+    sent = []
+    monkeypatch.setattr(tools, '_vlm_cache_key', lambda path, prompt: f'key:{path}')
+    monkeypatch.setattr(tools, '_known_label', lambda path, key: None)
+    monkeypatch.setattr(tools, 'prepare_image', lambda path, max_side=None: PreparedImage(path, 1, 1))
+    monkeypatch.setattr(tools, 'image_pixels', lambda path: 100)
+    monkeypatch.setattr(tools, '_vlm_batch_message', lambda prompt, paths: sent.append(paths) or paths)
+    monkeypatch.setattr(tools, '_stream_vlm', lambda message, image_bytes: _pop(answers))
+
+    async def astream_vlm(message, image_bytes):
+        return _pop(answers)
+
+    monkeypatch.setattr(tools, '_astream_vlm', astream_vlm)
+    # 一次只发一个请求，答案按请求的顺序取用
+    monkeypatch.setitem(config, 'batch', {'provider_limits': {'vlm': 1}})
+    monkeypatch.setattr(tools.get_vlm_cache(), 'enabled', False)
+    tools._classified_ahead.clear()
+    return answers, sent
+
+
+def _pop(answers):
+    answer = answers.pop(0)
+    if isinstance(answer, Exception):
+        raise answer
+    return answer
+
+
+class _SingleClassify:
+    """Stands in for `classify_image` as the one-by-one fallback."""
+
+    def __init__(self):
+        self.paths = []
+
+    def invoke(self, args):
+        self.paths.append(args['image_path'])
+        return '经验'
+
+    async def ainvoke(self, args):
+        return self.invoke(args)
+
+
+@pytest.fixture
+def single(monkeypatch):
+    single = _SingleClassify()
+    monkeypatch.setattr(tools, 'classify_image', single)
+    return single
+
+
+def _answer(*labels):
+    return json.dumps({'结果': [{'图片': i + 1, '类型': label} for i, label in enumerate(labels)]},
+                      ensure_ascii=False)
+
+
+def test_unused_labels_of_the_previous_batch_are_dropped(batch):
+    answers, _ = batch
+    answers += [_answer('论文', '活动'), _answer('经验', '论文')]
+    assert tools.classify_images_batch(['a.jpg', 'b.jpg'], batch_size=2) == ['论文', '活动']
+    assert tools._classified_ahead == {'key:a.jpg': '论文', 'key:b.jpg': '活动'}
+    # a.jpg and b.jpg were skipped (e.g. duplicates); the next batch does not keep their labels
+    tools.classify_images_batch(['c.jpg', 'd.jpg'], batch_size=2)
+    assert tools._classified_ahead == {'key:c.jpg': '经验', 'key:d.jpg': '论文'}
+
+
+def test_images_are_packed_into_requests_of_batch_size(batch, single):
+    answers, sent = batch
+    answers += [_answer('论文', '活动'), _answer('经验', '论文'), _answer('活动')]
+    paths = ['a.jpg', 'b.jpg', 'c.jpg', 'd.jpg', 'e.jpg']
+    assert tools.classify_images_batch(paths, batch_size=2) == ['论文', '活动', '经验', '论文', '活动']
+    assert sent == [['a.jpg', 'b.jpg'], ['c.jpg', 'd.jpg'], ['e.jpg']]
+    assert single.paths == []
+
+
+def test_classify_image_takes_the_label_without_calling_the_vlm(batch, monkeypatch):
+    answers, _ = batch
+    answers.append(_answer('论文', '活动'))
+    tools.classify_images_batch(['a.jpg', 'b.jpg'], batch_size=2)
+    monkeypatch.setattr(tools, '_invoke_vlm_json', lambda *args: pytest.fail('the VLM was called'))
+    assert tools.classify_image.invoke({'image_path': 'b.jpg'}) == '活动'
+    assert 'key:b.jpg' not in tools._classified_ahead  # each label is handed over once
+
+
+def test_unlabelled_images_are_classified_one_by_one(batch, single):
+    answers, _ = batch
+    answers += [json.dumps({'结果': [{'图片': 2, '类型': '活动'}, {'图片': 1, '类型': '菜谱'}]}, ensure_ascii=False),
+                'not json at all', RuntimeError('VLM outage')]
+    labels = tools.classify_images_batch(['a.jpg', 'b.jpg', 'c.jpg', 'd.jpg', 'e.jpg'], batch_size=2)
+    assert labels == ['经验', '活动', '经验', '经验', '经验']
+    assert single.paths == ['a.jpg', 'c.jpg', 'd.jpg', 'e.jpg']
+
+
+def test_known_labels_are_not_sent(batch, single, monkeypatch):
+    answers, sent = batch
+    monkeypatch.setattr(tools, '_known_label', lambda path, key: '论文' if path == 'b.jpg' else None)
+    answers.append(_answer('活动', '经验'))
+    assert tools.classify_images_batch(['a.jpg', 'b.jpg', 'c.jpg'], batch_size=8) == ['活动', '论文', '经验']
+    assert sent == [['a.jpg', 'c.jpg']]
+
+
+def test_requests_are_split_by_max_pixels(batch):
+    prepared = {i: PreparedImage(f'{i}.jpg', 1, 1) for i in range(5)}
+    assert tools._pack(prepared, 8, None) == [[0, 1, 2, 3, 4]]
+    assert tools._pack(prepared, 8, 250) == [[0, 1], [2, 3], [4]]
+    assert tools._pack(prepared, 8, 50) == [[0], [1], [2], [3], [4]]  # an oversized image still goes alone
+    assert tools._pack(prepared, 3, 1000) == [[0, 1, 2], [3, 4]]
+
+
+@pytest.mark.parametrize('raw_content, labels', [
+    (_answer('论文', '活动'), {0: '论文', 1: '活动'}),
+    ('```json\n' + _answer('论文') + '\n```', {0: '论文'}),
+    ('{"结果": [{"类型": "论文"}, {"类型": "经验"}]}', {0: '论文', 1: '经验'}),  # numbered by position
+    ('{"结果": [{"图片": "2", "类型": "论文"}, {"图片": 2, "类型": "活动"}]}', {1: '论文'}),
+    ('{"结果": [{"图片": 3, "类型": "论文"}, {"图片": 0, "类型": "论文"}, {"图片": "x", "类型": "论文"}]}', {}),
+    ('{"结果": ["论文", {"图片": 1, "类型": "菜谱"}]}', {}),
+    ('{"结果": {"图片": 1, "类型": "论文"}}', {}),
+    ('no json here', {}),
+])
+def test_batch_labels(raw_content, labels):
+    assert tools._batch_labels(raw_content, 2) == labels
+
+
+def test_async_batch_classification_matches_the_sync_one(batch, single):
+    answers, sent = batch
+    answers += [_answer('论文', '活动'), 'not json at all']
+    labels = asyncio.run(tools.aclassify_images_batch(['a.jpg', 'b.jpg', 'c.jpg'], batch_size=2))
+    assert labels == ['论文', '活动', '经验']
+    assert sent == [['a.jpg', 'b.jpg'], ['c.jpg']]
+    assert single.paths == ['c.jpg']
+    assert tools._classified_ahead == {'key:a.jpg': '论文', 'key:b.jpg': '活动'}
+
+
+@pytest.mark.parametrize('paths, agent_config, enabled, classified', [
+    (['a.jpg', 'b.jpg'], {'mode': 'pipeline', 'fused_extraction': False}, True, True),
+    (['a.jpg', 'b.jpg'], {'mode': 'agent', 'fused_extraction': True}, True, True),
+    (['a.jpg'], {'mode': 'pipeline', 'fused_extraction': False}, True, False),
+    (['a.jpg', 'b.jpg'], {'mode': 'pipeline', 'fused_extraction': True}, True, False),
+    (['a.jpg', 'b.jpg'], {'mode': 'pipeline', 'fused_extraction': False}, False, False),
+])
+def test_classify_ahead_runs_only_when_runs_classify_separately(monkeypatch, paths, agent_config, enabled, classified):
+    calls = []
+    monkeypatch.setitem(config, 'agent', agent_config)
+    monkeypatch.setitem(config, 'classification_batch', {'enabled': enabled})
+    monkeypatch.setattr(ingest, 'classify_images_batch', calls.append)
+    ingest.classify_ahead(paths)
+    assert calls == ([paths] if classified else [])
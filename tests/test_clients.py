@@ -0,0 +1,88 @@
+import threading
+
+import pytest
+
+from utils import clients
+
+
+class FakeModel:
+    def __init__(self, model_config):
+        self.model_config = model_config
+        self.bindings = 0
+
+    def bind_tools(self, tools):
+        self.bindings += 1
+        return (self, tuple(t.name for t in tools))
+
+
+class FakeTool:
+    def __init__(self, name):
+        self.name = name
+
+
+@pytest.fixture
+def built(monkeypatch):
+    """Builds fake LLMs for a switchable active model configuration and records every build."""
+    active = {'model_name': 'fake-1'}
+    built = []
+
+    def factory(model_config):
+        built.append(model_config)
+        return FakeModel(model_config)
+
+    monkeypatch.setitem(clients._FACTORIES, 'llm', factory)
+    monkeypatch.setattr(clients, 'get_active_model_config', lambda model_type: dict(active))
+    monkeypatch.setattr(clients, 'reload_config_if_changed', lambda: False)
+    clients.invalidate()
+    yield built, active
+    clients.invalidate()
+
+
+def test_one_client_is_built_and_shared_across_threads(built):
+    builds, _ = built
+    seen = []
+    threads = [threading.Thread(target=lambda: seen.append(clients.get_client('llm'))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(builds) == 1
+    assert all(client is seen[0] for client in seen)
+
+
+def test_a_new_model_configuration_gets_its_own_client(built):
+    builds, active = built
+    first = clients.get_client('llm')
+    active['model_name'] = 'fake-2'
+    second = clients.get_client('llm')
+    assert second is not first
+    assert second.model_config == {'model_name': 'fake-2'}
+    active['model_name'] = 'fake-1'
+    assert clients.get_client('llm') is first
+    assert len(builds) == 2
+
+
+def test_tool_bindings_are_reused_per_tool_set(built):
+    search, save = FakeTool('google_search'), FakeTool('save_data_to_db')
+    bound = clients.get_llm_with_tools([search, save])
+    assert clients.get_llm_with_tools([search, save]) is bound
+    assert clients.get_llm_with_tools([save]) is not bound
+    assert clients.get_client('llm').bindings == 2
+
+
+def test_a_changed_config_file_drops_the_cached_clients(built, monkeypatch):
+    builds, _ = built
+    first = clients.get_client('llm')
+    monkeypatch.setattr(clients, 'reload_config_if_changed', lambda: True)
+    monkeypatch.setattr(clients, '_last_config_check', 0.0)
+    assert clients.get_client('llm') is not first
+    # 检查有节流：刚检查过就不再读取config.yaml
+    assert clients.get_client('llm') is clients.get_client('llm')
+    assert len(builds) == 2
+
+
+def test_register_factory_replaces_the_builder(built, monkeypatch):
+    clients.get_client('llm')
+    monkeypatch.setitem(clients._FACTORIES, 'llm', clients._FACTORIES['llm'])  # restored afterwards
+    clients.register_factory('llm', lambda model_config: 'replacement')
+    assert clients.get_client('llm') == 'replacement'
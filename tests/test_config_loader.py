@@ -0,0 +1,61 @@
+import os
+import threading
+
+import pytest
+import yaml
+
+from utils import config_loader
+from utils.config_loader import config, reload_config_if_changed
+
+
+@pytest.fixture
+def config_file(tmp_path, monkeypatch):
+    saved, loaded_from = dict(config), dict(config_loader._loaded_from)
+    path = tmp_path / 'config.yaml'
+    monkeypatch.setattr(config_loader, 'CONFIG_PATH', str(path))
+    yield path
+    config.clear()
+    config.update(saved)
+    config_loader._loaded_from.update(loaded_from)
+
+
+def _write(path, data, mtime):
+    path.write_text(yaml.safe_dump(data), encoding='utf-8')
+    os.utime(path, (mtime, mtime))
+
+
+def test_readers_never_miss_a_key_during_reloads(config_file):
+    errors = []
+    stop = threading.Event()
+
+    def _read():
+        while not stop.is_set():
+            try:
+                config['active_models']
+            except KeyError as e:
+                errors.append(e)
+
+    readers = [threading.Thread(target=_read) for _ in range(2)]
+    for reader in readers:
+        reader.start()
+    for i in range(50):
+        _write(config_file, {'active_models': {'llm': f'model-{i}'}, f'extra_{i}': i}, 1_000_000 + i)
+        assert reload_config_if_changed()
+    stop.set()
+    for reader in readers:
+        reader.join()
+    assert errors == []
+    assert config['active_models'] == {'llm': 'model-49'}
+    assert 'extra_48' not in config
+
+
+def test_empty_or_broken_file_keeps_the_current_config(config_file):
+    _write(config_file, {'active_models': {'llm': 'a'}}, 1_000_000)
+    assert reload_config_if_changed()
+    config_file.write_text('', encoding='utf-8')
+    os.utime(config_file, (1_000_001, 1_000_001))
+    assert not reload_config_if_changed()
+    config_file.write_text('active_models: [', encoding='utf-8')
+    os.utime(config_file, (1_000_002, 1_000_002))
+    assert not reload_config_if_changed()
+    assert config['active_models'] == {'llm': 'a'}
@@ -0,0 +1,149 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import pytest
+
+from utils.db_writer import DBWriter
+
+
+@pytest.fixture
+def writer(tmp_path):
+    writer = DBWriter(str(tmp_path / 'agent.db'))
+    yield writer
+    writer.close()
+
+
+@contextmanager
+def _held(writer, queued=0):
+    """Keeps the writer thread busy, so everything submitted inside the block is written as one batch.
+
+    Args:
+        queued: Number of items that must be in the queue before the writer is let go,
+            for items submitted from other threads.
+    """
+    started, release = threading.Event(), threading.Event()
+
+    def block(conn):
+        started.set()
+        release.wait(5)
+
+    blocker = threading.Thread(target=writer.execute, args=(block,))
+    blocker.start()
+    assert started.wait(5)
+    try:
+        yield
+        deadline = time.time() + 5
+        while writer._queue.qsize() < queued and time.time() < deadline:
+            time.sleep(0.005)
+    finally:
+        release.set()
+        blocker.join()
+
+
+def _rows(writer, sql):
+    conn = sqlite3.connect(writer.db_path)
+    try:
+        return conn.execute(sql).fetchall()
+    finally:
+        conn.close()
+
+
+def test_ids_match_the_rows_of_a_multi_row_batch(writer):
+    records = [('paper_info', {'title': 'A'}), ('paper_info', {'title': 'B'}),
+               ('activity_info', {'name': 'C'}), ('paper_info', {'title': 'D', 'abstract': 'x'}),
+               ('paper_info', {'title': 'E'}), ('activity_info', {'name': 'F'})]
+    writer.write('paper_info', {'title': 'earlier'})
+    with _held(writer):
+        futures = [writer.submit(table, data) for table, data in records]
+    ids = [future.result(5) for future in futures]
+
+    for (table, data), row_id in zip(records, ids):
+        key = 'title' if table == 'paper_info' else 'name'
+        assert _rows(writer, f'SELECT "{key}" FROM "{table}" WHERE id = {row_id}') == [(data[key],)]
+    assert ids[:2] == [2, 3]
+
+
+def test_a_failing_item_fails_alone(writer):
+    writer.execute(lambda conn: conn.execute('CREATE TABLE tags ("id" INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                             '"name" TEXT UNIQUE)'))
+    with _held(writer):
+        futures = [writer.submit('tags', {'name': name}) for name in ('a', 'b', 'a', 'c')]
+
+    with pytest.raises(sqlite3.IntegrityError):
+        futures[2].result(5)
+    ids = {name: futures[i].result(5) for i, name in ((0, 'a'), (1, 'b'), (3, 'c'))}
+    assert dict(_rows(writer, 'SELECT name, id FROM tags')) == ids
+
+
+def test_a_failing_call_rolls_back_only_itself(writer):
+    writer.write('notes', {'text': 'setup'})
+    results = {}
+
+    def call(name, fn):
+        try:
+            results[name] = writer.execute(fn, timeout=5)
+        except Exception as e:
+            results[name] = e
+
+    def failing(conn):
+        conn.execute('INSERT INTO notes (text) VALUES (?)', ('from failing call',))
+        raise ValueError('boom')
+
+    def counting(conn):
+        # 同一批的插入先提交，之后才运行call
+        return conn.execute('SELECT COUNT(*) FROM notes').fetchone()[0]
+
+    threads = [threading.Thread(target=call, args=('failing', failing)),
+               threading.Thread(target=call, args=('counting', counting))]
+    with _held(writer, queued=4):
+        insert = writer.submit('notes', {'text': 'batched'})
+        for thread in threads:
+            thread.start()
+        # 调用线程入队之后才放开写线程，插入和两个call属于同一批
+        last = writer.submit('notes', {'text': 'batched too'})
+    for thread in threads:
+        thread.join()
+
+    assert isinstance(results['failing'], ValueError)
+    assert results['counting'] == 3
+    assert (insert.result(5), last.result(5)) == (2, 3)
+    assert [text for (text,) in _rows(writer, 'SELECT text FROM notes ORDER BY id')] == \
+        ['setup', 'batched', 'batched too']
+
+
+class _NoWaitWriter(DBWriter):
+    def _connect(self):
+        conn = super()._connect()
+        conn.execute("PRAGMA busy_timeout=0")
+        return conn
+
+
+def test_a_locked_database_fails_the_batch_but_keeps_the_writer(tmp_path):
+    writer = _NoWaitWriter(str(tmp_path / 'agent.db'))
+    writer.write('notes', {'text': 'setup'})
+    other = sqlite3.connect(writer.db_path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        # BEGIN IMMEDIATE fails, so there is no transaction to roll back
+        with pytest.raises(sqlite3.OperationalError, match='locked'):
+            writer.write('notes', {'text': 'a'}, timeout=5)
+        with pytest.raises(sqlite3.OperationalError, match='locked'):
+            writer.execute(lambda conn: None, timeout=5)
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+    assert writer.write('notes', {'text': 'after'}, timeout=5) == 2
+    writer.close()
+
+
+def test_an_unexpected_error_fails_the_batch_but_keeps_the_writer(writer, monkeypatch):
+    def broken(conn, batch):
+        raise RuntimeError('writer bug')
+
+    monkeypatch.setattr(writer, '_process', broken)
+    with pytest.raises(RuntimeError, match='writer bug'):
+        writer.write('notes', {'text': 'lost'}, timeout=5)
+    monkeypatch.undo()
+    assert writer.write('notes', {'text': 'kept'}, timeout=5) == 1
@@ -0,0 +1,86 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+import ingest
+from utils.config_loader import PROJECT_ROOT
+from utils.dedup import DedupIndex
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    path = str(tmp_path / 'agent.db')
+    monkeypatch.setenv('DB_PATH', path)
+    return path
+
+
+def test_other_processes_hashes_are_seen_on_reserve(db_path):
+    first, second = DedupIndex(db_path), DedupIndex(db_path)
+    original, reservation = first.reserve(0xF0F0, 'a.jpg')
+    assert original is None
+    # 另一个进程（这里用另一个实例模拟）在预留期间不会领取相近的哈希
+    assert second.try_reserve(0xF0F1, 'b.jpg') == (None, None)
+    first.complete(reservation, 0xF0F0, 'a.jpg', 'paper_info', 1)
+    original, reservation = second.try_reserve(0xF0F1, 'b.jpg')
+    assert (original.image_path, original.record_id, reservation) == ('a.jpg', 1, None)
+
+
+def test_released_reservation_lets_the_duplicate_run(db_path):
+    index = DedupIndex(db_path)
+    _, reservation = index.reserve(0xF0F0, 'a.jpg')
+    index.release(reservation)
+    original, reservation = index.try_reserve(0xF0F1, 'b.jpg')
+    assert original is None and reservation is not None
+
+
+def test_stale_reservation_is_ignored(db_path):
+    index = DedupIndex(db_path, reservation_timeout=0)
+    index.reserve(0xF0F0, 'a.jpg')
+    time.sleep(0.01)
+    original, reservation = index.try_reserve(0xF0F1, 'b.jpg')
+    assert original is None and reservation is not None
+
+
+def test_existing_table_gets_the_pending_column(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE image_hashes (id INTEGER PRIMARY KEY AUTOINCREMENT, phash INTEGER NOT NULL, "
+                 "image_path TEXT NOT NULL, record_table TEXT, record_id INTEGER, duplicate_of INTEGER, "
+                 "created_at REAL NOT NULL)")
+    conn.execute("INSERT INTO image_hashes (phash, image_path, record_table, record_id, created_at) "
+                 "VALUES (61680, 'a.jpg', 'paper_info', 3, 0)")
+    conn.commit()
+    conn.close()
+    assert DedupIndex(db_path).find_duplicate(0xF0F1).record_id == 3
+
+
+def test_concurrent_near_duplicates_run_the_agent_once(db_path, tmp_path, monkeypatch):
+    source = Image.open(f'{PROJECT_ROOT}/images/195233.jpg')
+    paths = []
+    for i in range(4):
+        path = str(tmp_path / f'{i}.jpg')
+        source.save(path, quality=95 - 10 * i)
+        paths.append(path)
+    runs = []
+
+    def fake_run_agent(path):
+        runs.append(path)
+        time.sleep(0.3)
+        return {'save_result': f"Data successfully saved to table 'paper_info' (id={len(runs)})."}
+
+    monkeypatch.setattr(ingest, 'run_agent', fake_run_agent)
+    results = [None] * len(paths)
+
+    def _run(i):
+        results[i] = ingest.ingest_image(paths[i])
+
+    threads = [threading.Thread(target=_run, args=(i,)) for i in range(len(paths))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(runs) == 1
+    assert sorted(r.status for r in results) == ['duplicate'] * 3 + ['processed']
+    assert {r.record_id for r in results} == {1}
@@ -0,0 +1,87 @@
+import sqlite3
+from datetime import date, timedelta
+
+import pytest
+
+from utils.dates import parse_date
+from utils.db_writer import get_db_writer
+from utils.events import ISO_DATE_COLUMN, ensure_activity_schema, normalize_record, query_upcoming_events
+from utils.tools import check_upcoming_events, save_data_to_db
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    path = str(tmp_path / 'agent.db')
+    monkeypatch.setenv('DB_PATH', path)
+    return path
+
+
+def _activity(name, day, location='图书馆'):
+    return {'activity_name': name, 'activity_date': day.strftime('%d/%m/%y'),
+            'activity_location': location, 'activity_content': '讲座'}
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('21/07/25', date(2025, 7, 21)),
+    ('21/07/2025', date(2025, 7, 21)),
+    ('2025-07-21', date(2025, 7, 21)),
+    ('2025.7.21', date(2025, 7, 21)),
+    ('2025年7月21日', date(2025, 7, 21)),
+    ('25年7月21号', date(2025, 7, 21)),
+    ('7月21日 14:00', date(2024, 7, 21)),
+    ('下周三', None),
+    ('31/02/25', None),
+    (None, None),
+])
+def test_parse_date(value, expected):
+    assert parse_date(value, today=date(2024, 1, 1)) == expected
+
+
+def test_normalize_record_adds_the_iso_date_to_activities_only():
+    record = {'activity_name': 'A', 'activity_date': '21/07/25'}
+    assert normalize_record('活动', record) == {**record, ISO_DATE_COLUMN: '2025-07-21'}
+    assert normalize_record('活动', {'activity_date': '待定'})[ISO_DATE_COLUMN] is None
+    paper = {'paper_title': 'T', 'activity_date': '21/07/25'}
+    assert normalize_record('论文', paper) is paper
+
+
+def test_ensure_activity_schema_backfills_legacy_rows(db_path):
+    ensure_activity_schema(db_path)  # no table yet: nothing to do, tried again later
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE TABLE activity_log (id INTEGER PRIMARY KEY AUTOINCREMENT, activity_name TEXT, '
+                 'activity_date TEXT, activity_location TEXT)')
+    conn.executemany('INSERT INTO activity_log (activity_name, activity_date) VALUES (?, ?)',
+                     [('a', '21/07/25'), ('b', '2025年8月1日'), ('c', '待定'), ('d', None)])
+    conn.commit()
+
+    ensure_activity_schema(db_path)
+    rows = conn.execute(f'SELECT activity_name, {ISO_DATE_COLUMN} FROM activity_log ORDER BY id').fetchall()
+    assert rows == [('a', '2025-07-21'), ('b', '2025-08-01'), ('c', None), ('d', None)]
+    indexes = [row[1] for row in conn.execute('PRAGMA index_list(activity_log)')]
+    assert 'idx_activity_log_date_iso' in indexes
+    plan = ' '.join(row[3] for row in conn.execute(
+        f'EXPLAIN QUERY PLAN SELECT * FROM activity_log WHERE {ISO_DATE_COLUMN} BETWEEN ? AND ?', ('a', 'b')))
+    assert 'idx_activity_log_date_iso' in plan
+    conn.close()
+
+
+def test_upcoming_events_are_filtered_ordered_and_paged(db_path):
+    today = date.today()
+    for name, offset, location in [('later', 5, '礼堂'), ('soon', 1, '图书馆'), ('past', -1, '图书馆'),
+                                   ('far', 30, '图书馆'), ('today', 0, '图书馆东区')]:
+        assert save_data_to_db.invoke({'data': _activity(name, today + timedelta(days=offset), location),
+                                       'image_type': '活动'}).startswith('Data successfully saved')
+    get_db_writer().flush()
+
+    events, total = query_upcoming_events(days=10)
+    assert ([e['activity_name'] for e in events], total) == (['today', 'soon', 'later'], 3)
+    events, total = query_upcoming_events(days=10, location='图书馆', limit=1, offset=1)
+    assert ([e['activity_name'] for e in events], total) == (['soon'], 2)
+
+    page = check_upcoming_events(days=10, page=2, page_size=2)
+    assert '第2/2页，共3条' in page and '- later (日期: ' in page
+    assert check_upcoming_events(days=10, page=3, page_size=2) == '第3页没有活动，共3条。'
+
+
+def test_check_upcoming_events_without_an_activity_table(db_path):
+    assert '表不存在' in check_upcoming_events(days=10)
@@ -0,0 +1,77 @@
+import sqlite3
+
+import pytest
+
+from utils import fulltext
+from utils.db_writer import get_db_writer
+from utils.fulltext import rebuild_search_index, search, segment
+from utils.tools import save_data_to_db
+
+pytestmark = pytest.mark.skipif(fulltext.tokenizer() != 'trigram', reason="needs the FTS5 trigram tokenizer")
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    path = str(tmp_path / 'agent.db')
+    monkeypatch.setenv('DB_PATH', path)
+    return path
+
+
+def _save(data, image_type):
+    assert save_data_to_db.invoke({'data': data, 'image_type': image_type}).startswith('Data successfully saved')
+
+
+def test_segment_splits_chinese_runs_into_bigrams():
+    assert segment('读论文 GPT-4') == ' 读论 论文 文  GPT-4'
+    assert segment(None) is None
+
+
+def test_two_character_chinese_terms_use_the_short_term_index(db_path):
+    _save({'experience_type': '学习', 'experience_content': '读论文要先看图', 'reason': ''}, '经验')
+    _save({'activity_name': '扩散模型讲座', 'activity_date': '2026-01-12', 'activity_location': '3号楼',
+           'activity_content': '介绍diffusion'}, '活动')
+
+    records, total = search('论文')
+    assert total == 1 and records[0]['snippet'] == '读[论文]要先看图'
+    assert search('扩散 讲座')[1] == 1
+    assert search('讲座 diffusion')[1] == 1
+    assert search('座')[1] == 1
+    assert search('论座')[1] == 0
+
+    conn = sqlite3.connect(db_path)
+    plan = conn.execute('EXPLAIN QUERY PLAN SELECT rowid FROM "exp_fts_short" WHERE "exp_fts_short" MATCH ?',
+                        ('"论文 文"*',)).fetchall()
+    assert 'VIRTUAL TABLE' in str(plan)
+
+
+def test_short_term_index_follows_updates_and_deletes(db_path):
+    _save({'experience_type': '学习', 'experience_content': '读论文要先看图', 'reason': ''}, '经验')
+    get_db_writer().execute(lambda conn: conn.execute("UPDATE exp SET experience_content = '写代码' WHERE id = 1"))
+    assert search('论文')[1] == 0 and search('代码')[1] == 1
+    get_db_writer().execute(lambda conn: conn.execute("DELETE FROM exp WHERE id = 1"))
+    assert search('代码')[1] == 0
+
+
+def test_rows_written_by_other_connections_are_indexed_on_rebuild(db_path):
+    _save({'experience_type': '学习', 'experience_content': '读论文', 'reason': ''}, '经验')
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO exp (experience_type, experience_content, reason) VALUES ('生活', '早睡', '')")
+    conn.commit()
+    assert search('早睡')[1] == 0
+    rebuild_search_index()
+    assert search('早睡')[1] == 1
+
+
+def test_scores_are_normalised_per_table(db_path):
+    for i in range(3):
+        _save({'paper_title': f'Diffusion models {i}', 'abstract': 'diffusion ' * (i + 1)}, '论文')
+    _save({'activity_name': 'Diffusion talk', 'activity_date': '2026-01-12', 'activity_location': 'x',
+           'activity_content': 'y'}, '活动')
+    records, total = search('diffusion')
+    assert total == 4
+    best = {}
+    for record in records:
+        assert 0 < record['rank'] <= 1
+        best[record['table']] = max(best.get(record['table'], 0), record['rank'])
+    assert best == {'paper_info': 1.0, 'activity_log': 1.0}
+    assert [r['rank'] for r in records] == sorted((r['rank'] for r in records), reverse=True)
@@ -0,0 +1,27 @@
+import json
+
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+from utils.history import compact_messages
+
+
+def _round(name, content, call_id):
+    return [AIMessage(content='', tool_calls=[{'name': name, 'args': {}, 'id': call_id}]),
+            ToolMessage(content=content, name=name, tool_call_id=call_id)]
+
+
+def test_over_budget_keeps_structured_results_and_summarises_search():
+    extraction = json.dumps({'paper_title': 'Attention Is All You Need', 'abstract': '注意力' * 200,
+                             'raw_output': 'x' * 1000}, ensure_ascii=False)
+    messages = [HumanMessage(content='task'),
+                *_round('extract_info_from_image', extraction, '1'),
+                *_round('google_search', 'snippet ' * 300, '2'),
+                *_round('save_data_to_db', 'ok', '3')]
+    compacted = compact_messages(messages, token_budget=300, max_tool_chars=5000)
+
+    tools = {m.name: m.content for m in compacted if isinstance(m, ToolMessage)}
+    assert tools['google_search'].startswith('[compacted]')
+    kept = json.loads(tools['extract_info_from_image'])
+    assert kept['paper_title'] == 'Attention Is All You Need' and 'raw_output' not in kept
+    assert tools['save_data_to_db'] == 'ok'
+    assert len(compacted) == len(messages)
@@ -0,0 +1,87 @@
+import os
+import time
+
+import pytest
+from PIL import Image
+
+from utils import image_prep
+from utils.config_loader import config
+from utils.image_prep import prepare_image
+
+
+@pytest.fixture
+def prep(tmp_path, monkeypatch):
+    monkeypatch.setitem(config, 'image_preprocessing', {
+        'enabled': True, 'max_side': 200, 'quality': 80, 'crop_borders': True, 'border_tolerance': 12,
+        'cache_dir': str(tmp_path / 'cache')})
+    image_prep._prepare.cache_clear()
+    yield tmp_path
+    image_prep._prepare.cache_clear()
+
+
+def _noisy_image(path, size=(800, 600)):
+    Image.effect_noise(size, 60).convert('RGB').save(path, 'PNG')
+    return str(path)
+
+
+def test_prepared_images_are_memoised_in_a_bounded_lru(prep):
+    path = _noisy_image(prep / 'a.png')
+    first = prepare_image(path)
+    assert prepare_image(path) is first
+    assert image_prep._prepare.cache_info().hits == 1
+
+    # 文件改动后mtime和大小变化，重新处理
+    _noisy_image(path, size=(900, 600))
+    os.utime(path, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+    assert prepare_image(path) is not first
+
+    size = os.path.getsize(path)
+    for mtime_ns in range(image_prep._PREPARED_MEMO_SIZE + 5):
+        image_prep._prepare(os.path.abspath(path), mtime_ns, size, None)
+    assert image_prep._prepare.cache_info().currsize == image_prep._PREPARED_MEMO_SIZE
+
+
+def test_large_images_are_downscaled_and_reused(prep):
+    path = _noisy_image(prep / 'big.png', size=(1000, 500))
+    prepared = prepare_image(path)
+    assert prepared.path.startswith(str(prep / 'cache'))
+    assert prepared.prepared_bytes < prepared.original_bytes
+    with Image.open(prepared.path) as image:
+        assert (image.format, image.size) == ('JPEG', (200, 100))
+    # 同一内容的副本使用同一个预处理文件
+    copy = prep / 'copy.png'
+    copy.write_bytes(open(path, 'rb').read())
+    assert prepare_image(str(copy)).path == prepared.path
+
+
+def test_uniform_borders_are_cropped(prep):
+    path = prep / 'bordered.png'
+    canvas = Image.new('RGB', (400, 400), 'white')
+    canvas.paste(Image.effect_noise((100, 50), 60).convert('RGB'), (150, 175))
+    canvas.save(path)
+    with Image.open(prepare_image(str(path)).path) as image:
+        assert image.size == (100, 50)
+
+
+def test_max_side_override_for_batched_classification(prep):
+    path = _noisy_image(prep / 'big.png', size=(1000, 500))
+    with Image.open(prepare_image(path, max_side=50).path) as image:
+        assert image.size == (50, 25)
+    assert prepare_image(path, max_side=50).path != prepare_image(path).path
+
+
+def test_the_original_is_used_when_preprocessing_does_not_help(prep, monkeypatch):
+    small = prep / 'small.jpg'
+    Image.effect_noise((100, 100), 60).convert('RGB').save(small, 'JPEG', quality=20)
+    assert prepare_image(str(small)).path == str(small)
+
+    monkeypatch.setitem(config['image_preprocessing'], 'enabled', False)
+    path = _noisy_image(prep / 'big.png')
+    prepared = prepare_image(path)
+    assert (prepared.path, prepared.bytes_saved) == (path, 0)
+
+
+def test_unreadable_images_fall_back_to_the_original(prep):
+    path = prep / 'broken.jpg'
+    path.write_bytes(b'not an image' * 100)
+    assert prepare_image(str(path)).path == str(path)
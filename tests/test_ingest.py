@@ -0,0 +1,47 @@
+import os
+import shutil
+
+import pytest
+
+import ingest
+from utils.config_loader import PROJECT_ROOT
+from utils.manifest import get_manifest
+
+
+@pytest.fixture
+def image(tmp_path, monkeypatch):
+    monkeypatch.setenv('DB_PATH', str(tmp_path / 'agent.db'))
+    path = tmp_path / 'a.jpg'
+    shutil.copy(f'{PROJECT_ROOT}/images/195233.jpg', path)
+    return str(path)
+
+
+def test_run_without_saved_record_is_marked_failed(image, monkeypatch):
+    monkeypatch.setattr(ingest, 'run_agent', lambda path: {'image_path': path, 'save_result': ''})
+    with pytest.raises(ingest.NoRecordSavedError):
+        ingest.ingest_image(image)
+    entry = get_manifest().get(image)
+    assert entry.status == 'failed'
+    assert 'without saving a record' in entry.error
+    assert get_manifest().pending([image]) == [image]
+
+
+def test_saved_record_is_marked_done(image, monkeypatch):
+    monkeypatch.setattr(ingest, 'run_agent', lambda path: {
+        'save_result': "Data successfully saved to table 'paper_info' (id=7)."})
+    result = ingest.ingest_image(image)
+    assert (result.status, result.record_table, result.record_id) == ('processed', 'paper_info', 7)
+    assert get_manifest().get(image).status == 'done'
+    assert get_manifest().pending([image]) == []
+
+
+def test_image_deleted_during_the_run_keeps_the_original_error(image, monkeypatch):
+    def run_agent(path):
+        os.remove(path)
+        raise RuntimeError('model outage')
+
+    monkeypatch.setattr(ingest, 'run_agent', run_agent)
+    with pytest.raises(RuntimeError, match='model outage'):
+        ingest.ingest_image(image)
+    entry = get_manifest().get(image)
+    assert (entry.status, entry.error, entry.content_hash) == ('failed', 'model outage', '')
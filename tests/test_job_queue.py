@@ -0,0 +1,127 @@
+import os
+import sqlite3
+import time
+from dataclasses import replace
+
+import pytest
+
+from utils.job_queue import DEAD, DONE, LEASED, QUEUED, Heartbeat, JobQueue
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    path = str(tmp_path / 'agent.db')
+    monkeypatch.setenv('DB_PATH', path)
+    queue = JobQueue(path)
+    queue.settings.update(visibility_timeout_seconds=60, max_attempts=2, retry_delay_seconds=0)
+    return queue
+
+
+def _row(queue, job_id):
+    conn = sqlite3.connect(queue.db_path)
+    try:
+        return conn.execute("SELECT status, attempts, lease_owner, last_error FROM ingest_jobs WHERE id = ?",
+                            (job_id,)).fetchone()
+    finally:
+        conn.close()
+
+
+def test_an_open_path_is_enqueued_once(queue):
+    assert queue.enqueue(['a.jpg', 'b.jpg', 'a.jpg']) == 2
+    assert queue.enqueue(['a.jpg']) == 0
+    job = queue.lease('worker-a')
+    assert queue.enqueue([job.image_path]) == 0  # leased jobs are still open
+    assert queue.ack(job)
+    # 任务完成后同一张图片可以再次入队
+    assert queue.enqueue([job.image_path]) == 1
+    assert queue.stats() == {QUEUED: 2, LEASED: 0, DONE: 1, DEAD: 0}
+
+
+def test_two_owners_never_lease_the_same_job(queue):
+    queue.enqueue(['a.jpg', 'b.jpg'])
+    first, second = queue.lease('worker-a'), queue.lease('worker-b')
+    assert {first.image_path, second.image_path} == {os.path.abspath('a.jpg'), os.path.abspath('b.jpg')}
+    assert queue.lease('worker-a') is None
+    # 只有持有租约的一方可以续期、确认或失败
+    stolen = replace(second, lease_owner='worker-a')
+    assert not queue.heartbeat(stolen)
+    assert not queue.ack(stolen)
+    assert not queue.fail(stolen, 'boom')
+    assert _row(queue, second.id)[2] == 'worker-b'
+
+
+def test_expired_lease_is_leased_again_and_the_old_owner_loses_it(queue):
+    queue.enqueue(['a.jpg'])
+    job = queue.lease('worker-a', visibility_timeout=0.01)
+    time.sleep(0.05)
+    again = queue.lease('worker-b')
+    assert (again.id, again.attempts, again.lease_owner) == (job.id, 2, 'worker-b')
+    assert not queue.heartbeat(job)
+    assert not queue.ack(job)
+    assert queue.ack(again)
+    assert _row(queue, job.id)[0] == DONE
+
+
+def test_expired_lease_on_the_last_attempt_is_dead_lettered(queue):
+    queue.enqueue(['a.jpg'])
+    queue.lease('worker-a', visibility_timeout=0.01)
+    time.sleep(0.05)
+    queue.lease('worker-b', visibility_timeout=0.01)
+    time.sleep(0.05)
+    assert queue.lease('worker-c') is None
+    assert queue.dead_letters()[0]['last_error'] == 'lease expired'
+    assert queue.stats()[DEAD] == 1
+
+
+def test_heartbeat_extends_the_lease(queue):
+    queue.enqueue(['a.jpg'])
+    queue.settings['visibility_timeout_seconds'] = 0.15
+    job = queue.lease('worker-a')
+    first_expiry = job.lease_expires_at
+    with Heartbeat(queue, job) as heartbeat:
+        time.sleep(0.4)
+        assert queue.lease('worker-b') is None
+    assert not heartbeat.lost
+    assert job.lease_expires_at > first_expiry
+    assert queue.ack(job)
+
+
+def test_failed_job_is_retried_then_dead_lettered(queue):
+    queue.enqueue(['a.jpg'])
+    job = queue.lease('worker-a')
+    assert queue.fail(job, 'boom')
+    assert _row(queue, job.id) == (QUEUED, 1, None, 'boom')
+    job = queue.lease('worker-b')
+    assert job.attempts == 2
+    assert queue.fail(job, 'boom again')
+    assert _row(queue, job.id) == (DEAD, 2, None, 'boom again')
+    assert queue.lease('worker-a') is None
+
+    assert queue.requeue_dead() == 1
+    assert _row(queue, job.id)[:2] == (QUEUED, 0)
+
+
+def test_failed_job_waits_for_its_backoff(queue):
+    queue.settings['retry_delay_seconds'] = 60
+    queue.enqueue(['a.jpg'])
+    queue.fail(queue.lease('worker-a'), 'boom')
+    assert queue.lease('worker-a') is None
+
+
+def test_release_does_not_count_the_attempt(queue):
+    queue.enqueue(['a.jpg'])
+    job = queue.lease('worker-a')
+    assert queue.release(job)
+    assert _row(queue, job.id)[:3] == (QUEUED, 0, None)
+    assert not queue.release(job)  # the lease is gone
+    assert queue.lease('worker-b').attempts == 1
+
+
+def test_requeue_dead_skips_images_queued_again(queue):
+    queue.settings['max_attempts'] = 1
+    queue.enqueue(['a.jpg'])
+    queue.fail(queue.lease('worker-a'), 'boom')
+    assert queue.enqueue(['a.jpg']) == 1
+    # 唯一索引不允许同一张图片有两个未完成的任务，死信保持不变
+    assert queue.requeue_dead() == 0
+    assert queue.stats() == {QUEUED: 1, LEASED: 0, DONE: 0, DEAD: 1}
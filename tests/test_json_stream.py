@@ -0,0 +1,121 @@
+import json
+
+import pytest
+from langchain_core.messages import AIMessageChunk
+
+from utils.json_stream import JSONObjectStream, parse_json_object
+from utils.tools import _StreamRead, _validate_fused_field
+
+
+def _feed_all(chunks):
+    stream = JSONObjectStream()
+    fields = []
+    for chunk in chunks:
+        fields += stream.feed(chunk)
+    return stream, fields
+
+
+def _split_every(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def test_fields_are_reported_across_split_tokens():
+    text = '{"类型": "论文", "数据": {"title": "A"}, "n": 12}'
+    for size in (1, 2, 3, 7):
+        stream, fields = _feed_all(_split_every(text, size))
+        assert stream.done
+        assert fields == [('类型', '论文'), ('数据', {'title': 'A'}), ('n', 12)]
+
+
+def test_escaped_quotes_and_braces_inside_strings():
+    value = {'title': 'He said "hi" {not a brace} [nor this]', 'path': 'C:\\dir\\', 'end': '}'}
+    text = json.dumps(value, ensure_ascii=False)
+    stream, fields = _feed_all(_split_every(text, 1))
+    assert stream.value == value
+    assert dict(fields) == value
+
+
+def test_nested_objects_are_one_field():
+    text = '{"数据": {"a": {"b": [1, {"c": "}"}]}}, "x": []}'
+    stream, fields = _feed_all([text])
+    assert fields == [('数据', {'a': {'b': [1, {'c': '}'}]}}), ('x', [])]
+    assert stream.consumed_text() == text
+
+
+def test_prose_and_markdown_fences_around_the_json():
+    text = 'Sure! Here is {the answer}:\n```json\n{"类型": "活动"}\n```\nLet me know {if} that helps.'
+    stream, fields = _feed_all(_split_every(text, 4))
+    assert stream.value == {'类型': '活动'}
+    assert fields == [('类型', '活动')]
+    assert stream.consumed_text().endswith('{"类型": "活动"}')
+    assert parse_json_object(text) == {'类型': '活动'}
+
+
+def test_rejected_candidate_may_report_fields_but_changes_candidate_start():
+    stream = JSONObjectStream()
+    assert stream.feed('e.g. {"类型": "bad", ') == [('类型', 'bad')]
+    first = stream.candidate_start
+    stream.feed('see below} then {"类型": "论文"}')
+    assert stream.value == {'类型': '论文'}
+    assert stream.candidate_start != first
+
+
+def test_no_object_raises():
+    with pytest.raises(json.JSONDecodeError):
+        parse_json_object('{"unfinished": 1')
+
+
+def _read(chunks, on_field):
+    read = _StreamRead(on_field)
+    for chunk in chunks:
+        if read.feed(AIMessageChunk(content=chunk)):
+            break
+    return read
+
+
+def test_fields_of_a_rejected_candidate_do_not_carry_over():
+    calls = []
+    read = _read(['e.g. {"类型": "活动", ', 'see below}\n', '{"数据": {}, ', '"类型": "论文"}', 'tail'],
+                 lambda key, value, fields: calls.append((key, value, dict(fields))))
+    assert read.error is None
+    assert read.parser.done
+    assert calls == [('类型', '活动', {'类型': '活动'}),
+                     ('数据', {}, {'数据': {}}),
+                     ('类型', '论文', {'数据': {}, '类型': '论文'})]
+
+
+def test_fields_are_validated_as_they_arrive():
+    calls = []
+    read = _StreamRead(lambda key, value, fields: calls.append(key))
+    assert not read.feed(AIMessageChunk(content='{"a": 1, '))
+    assert calls == ['a']
+    assert read.first_field_ms is not None
+    assert read.feed(AIMessageChunk(content='"b": 2}'))
+    assert calls == ['a', 'b']
+
+
+def test_invalid_field_stops_reading_before_the_object_closes():
+    def on_field(key, value, fields):
+        if key == '类型' and value != '论文':
+            raise ValueError(f'Unknown image type: {value}')
+
+    read = _StreamRead(on_field)
+    assert read.feed(AIMessageChunk(content='{"类型": "菜谱", '))
+    assert not read.parser.done
+    assert 'Unknown image type' in str(read.error)
+
+
+def test_invalid_field_of_the_accepted_object_is_reported():
+    def on_field(key, value, fields):
+        if key == '类型' and value != '论文':
+            raise ValueError(f'Unknown image type: {value}')
+
+    read = _read(['{"类型": "菜谱", "数据": {}}'], on_field)
+    assert 'Unknown image type' in str(read.error)
+
+
+@pytest.mark.parametrize('data', ['"just text"', '["a", "b"]', 'null'])
+def test_non_object_fused_data_is_an_invalid_field(data):
+    read = _read([f'{{"类型": "论文", "数据": {data}}}'], _validate_fused_field)
+    assert isinstance(read.error, ValueError)
+    assert 'must be a JSON object' in str(read.error)
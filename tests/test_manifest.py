@@ -0,0 +1,79 @@
+import os
+import time
+
+import pytest
+
+from main import watch_batch
+from utils.manifest import Manifest
+
+
+@pytest.fixture
+def manifest(tmp_path, monkeypatch):
+    path = str(tmp_path / 'agent.db')
+    monkeypatch.setenv('DB_PATH', path)
+    return Manifest(path)
+
+
+def _image(tmp_path, name, content=b'image'):
+    path = tmp_path / name
+    path.write_bytes(content)
+    return str(path)
+
+
+def _age(manifest, path, seconds):
+    manifest.get(path).updated_at -= seconds
+
+
+def test_done_images_are_skipped_until_they_change(manifest, tmp_path):
+    path = _image(tmp_path, 'a.jpg')
+    manifest.mark(path, 'done', 'paper_info', 1)
+    assert manifest.pending([path]) == []
+    # touch without a content change: only the fingerprint is refreshed
+    os.utime(path, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+    assert manifest.pending([path]) == []
+    with open(path, 'ab') as f:
+        f.write(b'more')
+    assert manifest.pending([path]) == [path]
+
+
+def test_failed_images_are_pending_only_when_asked_or_rewritten(manifest, tmp_path):
+    path = _image(tmp_path, 'a.jpg')
+    manifest.mark(path, 'failed', error='boom')
+    assert manifest.pending([path]) == [path]
+    assert manifest.pending([path], include_failed=False) == []
+    with open(path, 'ab') as f:
+        f.write(b'fixed')
+    assert manifest.pending([path], include_failed=False) == [path]
+
+
+def test_failed_images_are_due_after_the_backoff(manifest, tmp_path):
+    old, recent, gone = (_image(tmp_path, name) for name in ('old.jpg', 'recent.jpg', 'gone.jpg'))
+    for path in (old, recent, gone):
+        manifest.mark(path, 'failed', error='boom')
+    _age(manifest, old, 700)
+    _age(manifest, gone, 700)
+    os.remove(gone)
+    assert manifest.failed(600) == [old]
+    assert sorted(manifest.failed()) == sorted([old, recent])
+
+
+def test_mark_without_the_file_records_no_fingerprint(manifest, tmp_path):
+    path = str(tmp_path / 'missing.jpg')
+    manifest.mark(path, 'failed', error='boom')
+    entry = Manifest(manifest.db_path).get(path)  # reloaded from the table
+    assert (entry.status, entry.size, entry.content_hash, entry.error) == ('failed', 0, '', 'boom')
+    _image(tmp_path, 'missing.jpg')
+    assert manifest.pending([path], include_failed=False) == [path]
+
+
+def test_watch_batch_checks_only_the_new_paths_and_retries_due_failures(manifest, tmp_path):
+    done, failed_old, failed_recent = (_image(tmp_path, name) for name in ('done.jpg', 'f1.jpg', 'f2.jpg'))
+    manifest.mark(done, 'done')
+    manifest.mark(failed_old, 'failed', error='boom')
+    manifest.mark(failed_recent, 'failed', error='boom')
+    _age(manifest, failed_old, 700)
+    new = _image(tmp_path, 'new.jpg')
+
+    assert watch_batch(manifest, [new, done], 600) == [new, failed_old]
+    assert watch_batch(manifest, [new], -1) == [new]
+    assert watch_batch(manifest, [], 600) == [failed_old]
@@ -0,0 +1,20 @@
+from utils.search import format_results
+
+from agent import _search_update
+
+PLACEHOLDER = {'paper_title': 'Attention Is All You Need', 'abstract': '无明确内容'}
+
+
+def test_search_fills_the_abstract_from_the_matching_result():
+    results = format_results([
+        {'title': 'Some other paper', 'snippet': 'Unrelated text.', 'link': 'a'},
+        {'title': 'Attention Is All You Need', 'snippet': 'The dominant sequence transduction models.', 'link': 'b'},
+    ])
+    update = _search_update({'data': PLACEHOLDER}, results)
+    assert update['data']['abstract'] == 'The dominant sequence transduction models.'
+
+
+def test_search_without_a_matching_result_keeps_the_placeholder():
+    results = format_results([{'title': 'Some other paper', 'snippet': 'Unrelated text.', 'link': 'a'}])
+    assert 'data' not in _search_update({'data': PLACEHOLDER}, results)
+    assert 'data' not in _search_update({'data': PLACEHOLDER}, '')
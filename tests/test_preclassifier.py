@@ -0,0 +1,54 @@
+import random
+
+from utils import preclassifier
+from utils.preclassifier import FEATURE_NAMES, evaluate, train
+
+
+def _samples(per_label=20, seed=1):
+    rng = random.Random(seed)
+    samples = []
+    for offset, label in enumerate(['活动', '论文']):
+        for _ in range(per_label):
+            samples.append(([offset + rng.gauss(0, 0.3) for _ in FEATURE_NAMES], label))
+    return samples
+
+
+def test_test_set_is_used_for_neither_weights_nor_temperature(monkeypatch):
+    samples = _samples()
+    seen = {}
+    real_fit_softmax, real_fit_temperature = preclassifier._fit_softmax, preclassifier._fit_temperature
+
+    def fit_softmax(x, y, n_labels, **kwargs):
+        seen['fit'] = len(x)
+        return real_fit_softmax(x, y, n_labels, **kwargs)
+
+    def fit_temperature(scores, y):
+        seen['calibration'] = len(scores)
+        return real_fit_temperature(scores, y)
+
+    monkeypatch.setattr(preclassifier, '_fit_softmax', fit_softmax)
+    monkeypatch.setattr(preclassifier, '_fit_temperature', fit_temperature)
+    model, test_set = train(samples)
+
+    assert len(test_set) == 8  # 20% of each label
+    assert seen == {'fit': 22, 'calibration': 10}
+    assert seen['fit'] + seen['calibration'] + len(test_set) == len(samples)
+    assert {label for _, label in test_set} == {'活动', '论文'}
+    assert evaluate(model, test_set, 0.9)['accuracy'] == 1.0
+
+
+def test_tiny_labels_keep_one_sample_for_the_weights():
+    model, test_set = train(_samples(per_label=2))
+    assert test_set == []
+    assert model.labels == ['活动', '论文']
+
+
+def test_gate_stats_are_formatted_and_reset():
+    preclassifier.reset_gate_stats()
+    assert preclassifier.format_gate_stats() == ''
+    with preclassifier._model_lock:
+        preclassifier._stats.update(hits=3, fallbacks=1, seconds=0.004)
+    assert preclassifier.format_gate_stats() == \
+        "3 decided locally, 1 sent to the VLM (hit fraction 0.75, mean 1.0 ms)"
+    preclassifier.reset_gate_stats()
+    assert preclassifier.gate_stats()['hits'] == 0
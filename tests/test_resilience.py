@@ -0,0 +1,90 @@
+import time
+
+import pytest
+
+from utils.resilience import (CircuitBreaker, ProviderGuard, ProviderUnavailableError, TokenBucket,
+                              get_resilience_config, _DEFAULTS)
+
+
+class HTTPError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+def _server_error():
+    raise HTTPError(500)
+
+
+def _settings(**overrides):
+    return {**_DEFAULTS, 'backoff_base_seconds': 0.001, 'backoff_max_seconds': 0.001, **overrides}
+
+
+def test_hedging_is_off_by_default():
+    for provider in ('llm', 'vlm', 'search'):
+        assert get_resilience_config(provider)['hedge'] is False
+
+
+def test_bucket_allows_a_burst_then_queues_at_the_rate():
+    bucket = TokenBucket(rate=10, burst=2)
+    assert bucket.reserve() == 0 and bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.1, abs=0.02)
+    assert not bucket.try_take()
+
+
+def test_bucket_halves_its_rate_on_throttle_and_recovers():
+    bucket = TokenBucket(rate=10, burst=1)
+    bucket.throttle()
+    assert bucket.rate == 5
+    for _ in range(20):
+        bucket.recover()
+    assert bucket.rate == 10
+
+
+def test_breaker_opens_after_threshold_and_lets_one_probe_through():
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=0.05)
+    assert not breaker.failed()
+    assert breaker.failed()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()  # 探测请求进行中
+    breaker.succeeded()
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.allow()
+
+
+def test_guard_retries_transient_errors():
+    guard = ProviderGuard('test', _settings(max_attempts=3))
+    answers = [HTTPError(503), HTTPError(429), 'ok']
+
+    def fn():
+        answer = answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    assert guard.call(fn) == 'ok'
+    assert guard.counters['retries'] == 2 and guard.counters['throttled'] == 1
+
+
+def test_guard_does_not_retry_client_errors():
+    guard = ProviderGuard('test', _settings())
+    calls = []
+
+    def fn():
+        calls.append(1)
+        raise HTTPError(400)
+
+    with pytest.raises(HTTPError):
+        guard.call(fn)
+    assert len(calls) == 1 and guard.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_open_circuit_fails_fast():
+    guard = ProviderGuard('test', _settings(max_attempts=1, failure_threshold=2, reset_seconds=60))
+    for _ in range(2):
+        with pytest.raises(HTTPError):
+            guard.call(_server_error)
+    with pytest.raises(ProviderUnavailableError):
+        guard.call(lambda: 'never called')
+    assert guard.counters['rejected'] == 1
@@ -0,0 +1,109 @@
+import asyncio
+import threading
+
+import pytest
+
+from utils.search import (NO_RESULT, LocalIndexBackend, SearchBackend, SearchCache, SearchService, best_match,
+                          format_results, parse_results)
+
+
+class BlockingBackend(SearchBackend):
+    """Answers after `release` is set, counting the calls."""
+    name = 'blocking'
+
+    def __init__(self):
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def search(self, query):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        return f"result for {query}"
+
+    async def asearch(self, query):
+        self.calls += 1
+        self.started.set()
+        while not self.release.is_set():
+            await asyncio.sleep(0.01)
+        return f"result for {query}"
+
+
+def _service(backend, tmp_path, **kwargs):
+    return SearchService(backend, SearchCache(str(tmp_path / 'cache.db'), enabled=False), **kwargs)
+
+
+def test_concurrent_identical_searches_share_one_backend_call(tmp_path):
+    backend = BlockingBackend()
+    service = _service(backend, tmp_path)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(service.search('Attention  Is All You Need')))
+               for _ in range(4)]
+    threads[0].start()
+    backend.started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    backend.release.set()
+    for thread in threads:
+        thread.join()
+    assert backend.calls == 1
+    assert results == ["result for attention is all you need"] * 4
+    assert service.stats()['collapsed'] == 3
+
+
+def test_cancelled_leader_releases_waiters_and_later_searches(tmp_path):
+    async def scenario(service, backend):
+        leader = asyncio.create_task(service.asearch('query'))
+        while not backend.started.is_set():
+            await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(service.asearch('query'))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        with pytest.raises(RuntimeError, match='interrupted'):
+            await waiter
+        assert service._in_flight == {}
+        backend.release.set()
+        return await asyncio.wait_for(service.asearch('query'), 5)
+
+    backend = BlockingBackend()
+    service = _service(backend, tmp_path)
+    assert asyncio.run(scenario(service, backend)) == "result for query"
+
+
+def test_waiter_gives_up_after_wait_timeout(tmp_path):
+    backend = BlockingBackend()
+    service = _service(backend, tmp_path, wait_timeout_seconds=0.1)
+    leader = threading.Thread(target=service.search, args=('query',))
+    leader.start()
+    backend.started.wait(5)
+    with pytest.raises(TimeoutError):
+        service.search('query')
+    backend.release.set()
+    leader.join()
+
+
+def test_best_match_picks_the_result_with_the_paper_title():
+    text = format_results([
+        {'title': 'BERT: Pre-training of Deep Bidirectional Transformers', 'snippet': 'We introduce BERT.',
+         'link': 'https://arxiv.org/abs/1810.04805'},
+        {'title': 'Attention Is All You Need - arXiv', 'snippet': 'The dominant sequence\ntransduction models ...',
+         'link': 'https://arxiv.org/abs/1706.03762'},
+    ])
+    match = best_match('Attention is all you need', text)
+    assert match['snippet'] == 'The dominant sequence transduction models ...'
+    assert best_match('注意力机制综述', format_results([{'title': '注意力机制综述 - 知网', 'snippet': '本文综述'}]))
+    assert best_match('Graph Neural Networks', text) is None
+    assert best_match('Attention Is All You Need', NO_RESULT) is None
+    assert best_match('Attention Is All You Need', 'Attention Is All You Need: some raw text') is None
+
+
+def test_local_backend_answers_in_result_blocks(tmp_path):
+    index = tmp_path / 'index.json'
+    index.write_text('[{"title": "Attention Is All You Need", "snippet": "Transformers.", "link": "x"}]')
+    backend = LocalIndexBackend(str(index))
+    assert parse_results(backend.search('attention')) == [
+        {'title': 'Attention Is All You Need', 'snippet': 'Transformers.', 'link': 'x'}]
+    assert backend.search('unrelated') == NO_RESULT
@@ -0,0 +1,109 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from utils import tracing
+from utils.tracing import format_summary, load_trace, record, record_usage, span, summarize, trace_run, traced
+
+
+@pytest.fixture
+def trace_path(tmp_path, monkeypatch):
+    path = str(tmp_path / 'traces.jsonl')
+    monkeypatch.setattr(tracing, '_enabled', False)
+    monkeypatch.setattr(tracing, '_trace_path', tracing._trace_path)
+    monkeypatch.setattr(tracing, '_print_summary', False)
+    tracing.enable(path)
+    return path
+
+
+def _records(path):
+    return [r for records in load_trace(path).values() for r in records]
+
+
+def test_disabled_tracing_records_nothing(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracing, '_enabled', False)
+    with span('node') as s:
+        record(retries=1)
+    assert s is tracing._NULL_SPAN
+    assert not (tmp_path / 'traces.jsonl').exists()
+
+
+def test_spans_of_a_run_are_nested_and_written_together(trace_path):
+    with trace_run('run_agent', image='a.jpg') as run:
+        with span('vlm_expert') as node:
+            with span('classify_image', kind='tool'):
+                record(image_bytes=100, cache_hits=1)
+            record(retries=1)
+        with pytest.raises(ValueError):
+            with span('save', kind='io'):
+                raise ValueError('disk full')
+        assert not os.path.exists(trace_path)  # the run is written when it ends
+
+    records = {r['name']: r for r in _records(trace_path)}
+    assert set(records) == {'run_agent', 'vlm_expert', 'classify_image', 'save'}
+    assert {r['run_id'] for r in records.values()} == {run.span_id}
+    assert records['classify_image']['parent_id'] == node.span_id
+    assert records['vlm_expert']['parent_id'] == run.span_id
+    assert records['classify_image']['counters'] == {'image_bytes': 100, 'cache_hits': 1}
+    assert records['vlm_expert']['counters'] == {'retries': 1}
+    assert records['save']['error'] == 'ValueError: disk full'
+    assert records['run_agent']['attrs'] == {'image': 'a.jpg'}
+
+
+def test_traced_functions_and_coroutines_open_spans(trace_path):
+    @traced(kind='tool')
+    def tool():
+        record(retries=2)
+        return 'sync'
+
+    @traced('async_tool', kind='tool')
+    async def atool():
+        # 并发的任务继承当前span，各自记到自己的span里
+        await asyncio.gather(asyncio.to_thread(tool), asyncio.sleep(0))
+        return 'async'
+
+    async def main():
+        with trace_run('arun'):
+            return await atool()
+
+    assert asyncio.run(main()) == 'async'
+    records = {r['name']: r for r in _records(trace_path)}
+    assert records['tool']['parent_id'] == records['async_tool']['span_id']
+    assert records['tool']['counters'] == {'retries': 2}
+
+
+def test_token_usage_is_read_from_either_metadata_style(trace_path):
+    with trace_run('run'):
+        with span('llm', kind='model'):
+            record_usage(SimpleNamespace(usage_metadata={'input_tokens': 10, 'output_tokens': 3}))
+        with span('vlm', kind='model'):
+            record_usage(SimpleNamespace(usage_metadata=None,
+                                         response_metadata={'token_usage': {'input_tokens': 7, 'output_tokens': 2}}))
+    rows = {row['name']: row for row in summarize(_records(trace_path))}
+    assert (rows['llm']['prompt_tokens'], rows['llm']['completion_tokens']) == (10, 3)
+    assert (rows['vlm']['prompt_tokens'], rows['vlm']['completion_tokens']) == (7, 2)
+    assert summarize(_records(trace_path))[0]['name'] == 'run'  # the run row comes first
+
+
+def test_summary_aggregates_calls_and_formats_a_table():
+    records = [
+        {'name': 'vlm', 'kind': 'model', 'duration_ms': 30.0, 'counters': {'image_bytes': 5}, 'error': None},
+        {'name': 'vlm', 'kind': 'model', 'duration_ms': 10.0, 'counters': {'retries': 1}, 'error': 'boom'},
+        {'name': 'run', 'kind': 'run', 'duration_ms': 50.0, 'counters': {}},
+    ]
+    rows = summarize(records)
+    assert [row['name'] for row in rows] == ['run', 'vlm']
+    assert {k: rows[1][k] for k in ('calls', 'errors', 'total_ms', 'image_bytes', 'retries')} == \
+        {'calls': 2, 'errors': 1, 'total_ms': 40.0, 'image_bytes': 5, 'retries': 1}
+    table = format_summary(rows, title='T').splitlines()
+    assert table[0] == '--- T ---'
+    assert table[3].split() == ['vlm', '2', '1', '40.0', '20.0', '0', '0', '5', '0', '1']
+
+
+def test_a_span_outside_a_run_is_written_on_its_own(trace_path):
+    with span('preclassify', kind='model'):
+        pass
+    (only,) = _records(trace_path)
+    assert (only['name'], only['run_id'], only['parent_id']) == ('preclassify', None, None)
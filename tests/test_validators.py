@@ -0,0 +1,32 @@
+import json
+
+from utils.validators import (OK, RETRY, SEARCH, UNDECIDED, format_decision_counts, record_decision,
+                              reset_decision_counts, validate_tool_output)
+
+
+def test_failed_database_write_is_retried_with_the_error():
+    verdict = validate_tool_output('save_data_to_db', "Database operation failed: no such column: foo")
+    assert verdict.decision == RETRY
+    assert 'no such column: foo' in verdict.message
+
+
+def test_successful_database_write_is_ok():
+    content = "Data successfully saved to table 'paper_info' (id=1)."
+    assert validate_tool_output('save_data_to_db', content).decision == OK
+    assert validate_tool_output('save_data_to_db', 'something else').decision == UNDECIDED
+
+
+def test_paper_without_abstract_asks_for_a_search():
+    content = json.dumps({'paper_title': 'Attention Is All You Need', 'abstract': '无明确内容'}, ensure_ascii=False)
+    verdict = validate_tool_output('extract_info_from_image', content, {'image_type': '论文'})
+    assert verdict.decision == SEARCH
+
+
+def test_decision_counts_are_formatted_rules_first():
+    reset_decision_counts()
+    record_decision('llm:continue')
+    record_decision('rule:ok')
+    record_decision('rule:ok')
+    assert format_decision_counts() == 'rule:ok 2, llm:continue 1'
+    reset_decision_counts()
+    assert format_decision_counts() == ''
@@ -0,0 +1,95 @@
+import os
+import time
+
+import pytest
+
+from utils import vlm_cache
+from utils.vlm_cache import VLMCache, file_sha256
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return VLMCache(str(tmp_path / 'cache.db'), max_entries=3, max_bytes=1000, max_age_days=1)
+
+
+def _keys(cache):
+    return {key for key, in cache._connect().execute("SELECT key FROM vlm_cache")}
+
+
+def _age(cache, key, seconds):
+    conn = cache._connect()
+    conn.execute("UPDATE vlm_cache SET created_at = created_at - ?, last_access = last_access - ? WHERE key = ?",
+                 (seconds, seconds, key))
+    conn.commit()
+
+
+def test_least_recently_used_entries_are_evicted_first(cache):
+    for i, key in enumerate('abcd'):
+        cache.put(key, 'v')
+        _age(cache, key, 10 - i)  # a is the oldest
+    assert cache.get('a') == 'v'  # refreshes a
+    cache.evict()
+    assert _keys(cache) == {'a', 'c', 'd'}
+
+
+def test_entries_are_evicted_down_to_max_bytes(cache):
+    for i, key in enumerate('abc'):
+        cache.put(key, 'x' * 400)
+        _age(cache, key, 10 - i)
+    cache.evict()
+    assert _keys(cache) == {'b', 'c'}
+
+
+def test_expired_entries_are_dropped_and_missed(cache):
+    cache.put('old', 'v')
+    cache.put('new', 'v')
+    _age(cache, 'old', 2 * 86400)
+    assert cache.get('old') is None
+    cache.evict()
+    assert _keys(cache) == {'new'}
+    assert cache.stats() == {'hits': 0, 'misses': 1, 'entries': 1}
+
+
+def test_eviction_runs_while_putting(tmp_path):
+    cache = VLMCache(str(tmp_path / 'cache.db'), max_entries=5)
+    for i in range(vlm_cache._EVICT_EVERY + 1):
+        cache.put(f'k{i}', 'v')
+    assert cache.stats()['entries'] <= 5
+
+
+def test_disabled_or_bypassed_cache_stores_nothing(cache, tmp_path):
+    cache.put('a', 'v', bypass=True)
+    assert cache.get('a') is None
+    disabled = VLMCache(str(tmp_path / 'other.db'), enabled=False)
+    disabled.put('a', 'v')
+    assert disabled.get('a') is None
+    assert disabled.hits + disabled.misses == 0
+
+
+def test_stats_reset_and_format(cache, monkeypatch):
+    monkeypatch.setattr(vlm_cache, '_cache', cache)
+    assert vlm_cache.format_cache_stats() == ''
+    cache.put('a', 'v')
+    cache.get('a')
+    cache.get('b')
+    assert vlm_cache.format_cache_stats() == '1 hits, 1 misses (hit rate 0.50), 1 entries'
+    cache.reset_stats()
+    assert vlm_cache.format_cache_stats() == ''
+
+
+def test_file_digests_are_memoised_in_a_bounded_lru(tmp_path):
+    vlm_cache._digest.cache_clear()
+    path = tmp_path / 'image.jpg'
+    path.write_bytes(b'one')
+    first = file_sha256(str(path))
+    assert file_sha256(str(path)) == first
+    assert vlm_cache._digest.cache_info().hits == 1
+
+    # 文件改动后mtime和大小变化，摘要重新计算
+    path.write_bytes(b'second')
+    os.utime(path, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+    assert file_sha256(str(path)) != first
+
+    for mtime_ns in range(vlm_cache._DIGEST_MEMO_SIZE + 10):
+        vlm_cache._digest(str(path), mtime_ns, 6)
+    assert vlm_cache._digest.cache_info().currsize == vlm_cache._DIGEST_MEMO_SIZE
@@ -0,0 +1,188 @@
+"""Concurrent batch runner for processing a folder of images.
+
+Images are processed by a bounded thread pool (`run_batch`) or as tasks on
+one event loop (`arun_batch`), while each model provider (LLM, VLM, search)
+gets its own concurrency limit through `provider_slot` / `async_provider_slot`.
+Results are yielded in submission order so progress logs stay readable.
+"""
+import os
+import time
+import asyncio
+import threading
+import traceback
+import weakref
+from contextlib import contextmanager, asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional
+
+from .config_loader import config
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+_DEFAULT_PROVIDER_LIMITS = {'llm': 4, 'vlm': 2, 'search': 2}
+_provider_semaphores: Dict[str, threading.BoundedSemaphore] = {}
+_semaphores_lock = threading.Lock()
+# asyncio的信号量绑定在事件循环上，每个循环各有一组
+_async_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Semaphore]]" = \
+    weakref.WeakKeyDictionary()
+
+
+def get_batch_config() -> Dict:
+    """Returns the `batch` section of config.yaml with defaults filled in."""
+    batch_config = config.get('batch', {})
+    return {
+        'max_concurrency': batch_config.get('max_concurrency', 4),
+        'async_max_concurrency': batch_config.get('async_max_concurrency', 200),
+        'timeout_seconds': batch_config.get('timeout_seconds', 300),
+        'provider_limits': {**_DEFAULT_PROVIDER_LIMITS, **batch_config.get('provider_limits', {})},
+    }
+
+
+def list_images(image_dir: str) -> List[str]:
+    """Returns the sorted paths of all supported image files in `image_dir`."""
+    return [
+        os.path.join(image_dir, f) for f in sorted(os.listdir(image_dir))
+        if f.lower().endswith(IMAGE_EXTENSIONS)
+    ]
+
+
+@contextmanager
+def provider_slot(provider: str):
+    """Holds one of the concurrent-request slots of a model provider.
+
+    Args:
+        provider: The provider name ('llm', 'vlm' or 'search').
+    """
+    with _semaphores_lock:
+        semaphore = _provider_semaphores.get(provider)
+        if semaphore is None:
+            limit = get_batch_config()['provider_limits'].get(provider, 1)
+            semaphore = _provider_semaphores[provider] = threading.BoundedSemaphore(limit)
+    with semaphore:
+        yield
+
+
+@asynccontextmanager
+async def async_provider_slot(provider: str):
+    """Async counterpart of `provider_slot` for coroutines on the running event loop.
+
+    The limit comes from the same `provider_limits` setting, counted per event loop.
+
+    Args:
+        provider: The provider name ('llm', 'vlm' or 'search').
+    """
+    semaphores = _async_semaphores.setdefault(asyncio.get_running_loop(), {})
+    semaphore = semaphores.get(provider)
+    if semaphore is None:
+        limit = get_batch_config()['provider_limits'].get(provider, 1)
+        semaphore = semaphores[provider] = asyncio.Semaphore(limit)
+    async with semaphore:
+        yield
+
+
+@dataclass
+class BatchResult:
+    """The outcome of processing one image in a batch."""
+    image_path: str
+    ok: bool
+    elapsed: float
+    error: Optional[str] = None
+    timed_out: bool = False
+    value: Any = None
+
+
+def run_batch(image_paths: List[str], worker: Callable[[str], object],
+              max_concurrency: Optional[int] = None,
+              timeout: Optional[float] = None) -> Iterator[BatchResult]:
+    """Processes images concurrently and yields their results in input order.
+
+    A result is reported as timed out once its image has been running for
+    longer than `timeout` seconds. Python threads cannot be killed, so the
+    underlying call keeps running in the background until its HTTP requests
+    return; only the report is not held up by it.
+
+    Args:
+        image_paths: The images to process.
+        worker: The function called with each image path, e.g. `ingest_image`.
+            Its return value is kept in `BatchResult.value`.
+        max_concurrency: Maximum number of images in flight. Defaults to config.
+        timeout: Per-image timeout in seconds. Defaults to config.
+
+    Yields:
+        A `BatchResult` per image, in the same order as `image_paths`.
+    """
+    batch_config = get_batch_config()
+    max_concurrency = max_concurrency or batch_config['max_concurrency']
+    timeout = timeout or batch_config['timeout_seconds']
+    started: Dict[int, float] = {}
+
+    def _run(index: int, image_path: str) -> BatchResult:
+        started[index] = time.monotonic()
+        try:
+            value = worker(image_path)
+            return BatchResult(image_path, True, time.monotonic() - started[index], value=value)
+        except Exception:
+            return BatchResult(image_path, False, time.monotonic() - started[index], traceback.format_exc())
+
+    executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='batch')
+    try:
+        futures = [executor.submit(_run, i, path) for i, path in enumerate(image_paths)]
+        for index, future in enumerate(futures):
+            while True:
+                if future.done():
+                    yield future.result()
+                    break
+                start = started.get(index)
+                remaining = None if start is None else start + timeout - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    yield BatchResult(image_paths[index], False, timeout,
+                                      f"Timed out after {timeout} seconds.", timed_out=True)
+                    break
+                # 等待当前图片完成，或最多等到它超时；尚未开始的图片每秒检查一次
+                wait([future], timeout=min(remaining, 1.0) if remaining is not None else 1.0)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def arun_batch(image_paths: List[str], worker: Callable[[str], Awaitable[object]],
+                     max_concurrency: Optional[int] = None,
+                     timeout: Optional[float] = None) -> AsyncIterator[BatchResult]:
+    """Processes images as tasks on the running event loop and yields their results in input order.
+
+    Unlike `run_batch`, an image that exceeds `timeout` is really cancelled.
+    Without threads per image, hundreds of images can be in flight; the
+    provider limits still bound the concurrent requests per provider.
+
+    Args:
+        image_paths: The images to process.
+        worker: The coroutine function called with each image path, e.g. `aingest_image`.
+        max_concurrency: Maximum number of images in flight. Defaults to
+            `batch.async_max_concurrency` in config.yaml.
+        timeout: Per-image timeout in seconds. Defaults to config.
+
+    Yields:
+        A `BatchResult` per image, in the same order as `image_paths`.
+    """
+    batch_config = get_batch_config()
+    semaphore = asyncio.Semaphore(max_concurrency or batch_config['async_max_concurrency'])
+    timeout = timeout or batch_config['timeout_seconds']
+
+    async def _run(image_path: str) -> BatchResult:
+        async with semaphore:
+            start = time.monotonic()
+            try:
+                value = await asyncio.wait_for(worker(image_path), timeout)
+                return BatchResult(image_path, True, time.monotonic() - start, value=value)
+            except asyncio.TimeoutError:
+                return BatchResult(image_path, False, timeout, f"Timed out after {timeout} seconds.", timed_out=True)
+            except Exception:
+                return BatchResult(image_path, False, time.monotonic() - start, traceback.format_exc())
+
+    tasks = [asyncio.ensure_future(_run(path)) for path in image_paths]
+    try:
+        for task in tasks:
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,88 @@
+"""Persistent checkpoints of graph runs, so failed runs resume where they stopped.
+
+`run_agent` runs each image on the thread `<mode>:<sha256 of the image>` of a
+SQLite checkpointer. After every completed node the graph state is saved; if
+a later node raises (a provider outage, a database error) the next run of the
+same image continues from the failed node, and a run that already finished
+is returned without calling any model.
+
+Checkpoints are kept in their own SQLite file next to the main database, so
+they never compete with the `DBWriter` thread for the write lock.
+"""
+import os
+import asyncio
+import sqlite3
+import threading
+from typing import Any, AsyncIterator, Dict, Optional
+
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+from .config_loader import PROJECT_ROOT, config
+from .db_writer import get_db_path
+from .vlm_cache import file_sha256
+
+
+class ThreadedSqliteSaver(SqliteSaver):
+    """A `SqliteSaver` whose async methods run the sync ones in worker threads.
+
+    `AsyncSqliteSaver` is bound to the event loop it was opened on, while this
+    process runs graphs from a thread pool, from `asyncio.run` and from
+    Gradio's loop; one saver shared by all of them keeps a single connection.
+    """
+
+    async def aget_tuple(self, config):
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None) -> AsyncIterator:
+        items = await asyncio.to_thread(lambda: list(self.list(config, filter=filter, before=before, limit=limit)))
+        for item in items:
+            yield item
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path=''):
+        return await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str):
+        return await asyncio.to_thread(self.delete_thread, thread_id)
+
+
+def get_checkpoint_config() -> Dict[str, Any]:
+    """Returns the `checkpoint` section of config.yaml with defaults applied."""
+    checkpoint_config = config.get('checkpoint', {})
+    return {
+        'enabled': checkpoint_config.get('enabled', True),
+        'path': checkpoint_config.get('path'),
+    }
+
+
+def get_checkpoint_path(db_path: Optional[str] = None) -> str:
+    """Returns the checkpoint file: `checkpoint.path`, or `<database>_checkpoints.db` next to the database."""
+    path = get_checkpoint_config()['path']
+    if path:
+        return path if os.path.isabs(path) else os.path.join(PROJECT_ROOT, path)
+    return os.path.splitext(db_path or get_db_path())[0] + '_checkpoints.db'
+
+
+def thread_id_for(image_path: str, mode: str) -> str:
+    """Returns the checkpoint thread of an image: the run mode and the content hash."""
+    return f"{mode}:{file_sha256(image_path)}"
+
+
+_savers: Dict[str, ThreadedSqliteSaver] = {}
+_savers_lock = threading.Lock()
+
+
+def get_checkpointer(db_path: Optional[str] = None) -> Optional[ThreadedSqliteSaver]:
+    """Returns the process-wide checkpointer of a database, or None if checkpointing is disabled."""
+    if not get_checkpoint_config()['enabled']:
+        return None
+    path = get_checkpoint_path(db_path)
+    with _savers_lock:
+        if path not in _savers:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            conn = sqlite3.connect(path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            _savers[path] = ThreadedSqliteSaver(conn)
+        return _savers[path]
@@ -0,0 +1,162 @@
+"""Process-wide registry of model clients.
+
+Clients are built once per active model configuration and reused by every
+tool call and graph step, so HTTP keep-alive connections survive between
+requests. Tool-bound LLMs are cached as well. Entries are dropped
+automatically when config.yaml changes on disk, or explicitly via `invalidate`.
+
+Provider SDKs are only imported by the factories, when the first client of a
+provider is built, so importing this module stays cheap.
+"""
+import os
+import json
+import time
+import threading
+from typing import Any, Dict, Sequence, Tuple
+
+from .config_loader import get_active_model_config, reload_config_if_changed
+from .resilience import is_enabled as is_guarded
+
+_CONFIG_CHECK_INTERVAL = 2.0  # 最多每隔几秒检查一次config.yaml是否被修改
+
+_lock = threading.RLock()
+_clients: Dict[Tuple[str, str], Any] = {}
+_bound_llms: Dict[Tuple[str, Tuple[str, ...]], Any] = {}
+_http_clients: Dict[str, Any] = {}
+_last_config_check = 0.0
+
+
+def _create_vlm(vlm_config: Dict[str, Any]):
+    """Builds the client of the configured VLM."""
+    api_key_name = vlm_config['api_key_name']
+    api_key = os.getenv(api_key_name)
+
+    if not api_key:
+        raise ValueError(f"API key '{api_key_name}' not found in environment variables.")
+
+    # This part can be extended if you support other VLMs
+    # DashScope SDK自己管理HTTP连接，这里只能复用客户端对象本身
+    if 'qwen' in vlm_config['model_name']:
+        from langchain_community.chat_models.tongyi import ChatTongyi
+
+        # 重试由utils.resilience负责，SDK自己的重试会把退避叠在一起
+        max_retries = 1 if is_guarded() else 10
+        return ChatTongyi(model_name=vlm_config['model_name'], dashscope_api_key=api_key, max_retries=max_retries)
+    else:
+        raise NotImplementedError(f"VLM for '{vlm_config['model_name']}' is not implemented.")
+
+
+def _create_llm(llm_config: Dict[str, Any]):
+    """Builds the client of the configured LLM on a shared keep-alive HTTP pool."""
+    api_key_name = llm_config['api_key_name']
+    api_key = os.getenv(api_key_name)
+
+    if not api_key:
+        raise ValueError(f"API key '{api_key_name}' not found in environment variables.")
+
+    # This part can be extended to support other LLMs like those from OpenAI, Anthropic, etc.
+    if 'deepseek' in llm_config['model_name']:
+        import httpx
+        from langchain_openai import ChatOpenAI
+
+        # 同一个api_base共享一组keep-alive连接
+        base_url = llm_config['api_base_url']
+        if base_url not in _http_clients:
+            limits = httpx.Limits(max_connections=32, max_keepalive_connections=16)
+            _http_clients[base_url] = (httpx.Client(limits=limits, timeout=120),
+                                       httpx.AsyncClient(limits=limits, timeout=120))
+        http_client, http_async_client = _http_clients[base_url]
+        return ChatOpenAI(
+            model=llm_config['model_name'],
+            openai_api_key=api_key,
+            openai_api_base=base_url,
+            http_client=http_client,
+            http_async_client=http_async_client,
+            max_retries=0 if is_guarded() else 2,
+        )
+    else:
+        raise NotImplementedError(f"LLM for '{llm_config['model_name']}' is not implemented.")
+
+
+_FACTORIES = {'llm': _create_llm, 'vlm': _create_vlm}
+
+
+def _check_config():
+    global _last_config_check
+    now = time.monotonic()
+    with _lock:
+        if now - _last_config_check < _CONFIG_CHECK_INTERVAL:
+            return
+        _last_config_check = now
+    if reload_config_if_changed():
+        invalidate()
+
+
+def get_client(model_type: str):
+    """Returns the shared client of the active model of a given type.
+
+    Args:
+        model_type: 'llm' or 'vlm'.
+
+    Returns:
+        The cached client for the active model configuration.
+
+    Raises:
+        ValueError: If the required API key is not found in the environment variables.
+        NotImplementedError: If the configured model is not supported.
+    """
+    _check_config()
+    model_config = get_active_model_config(model_type)
+    key = (model_type, json.dumps(model_config, sort_keys=True))
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = _FACTORIES[model_type](model_config)
+    return client
+
+
+def get_llm_with_tools(tools: Sequence[Any]):
+    """Returns the active LLM with `tools` bound, reusing a previous binding.
+
+    Args:
+        tools: The tools to expose to the LLM.
+
+    Returns:
+        The tool-calling runnable for the active LLM.
+    """
+    llm = get_client('llm')
+    key = (str(id(llm)), tuple(t.name for t in tools))
+    bound = _bound_llms.get(key)
+    if bound is None:
+        with _lock:
+            bound = _bound_llms.get(key)
+            if bound is None:
+                bound = _bound_llms[key] = llm.bind_tools(tools)
+    return bound
+
+
+def register_factory(model_type: str, factory):
+    """Replaces the factory that builds clients of a model type.
+
+    Used to plug in other providers, or fake models in the benchmarks.
+
+    Args:
+        model_type: 'llm' or 'vlm'.
+        factory: Called with the active model configuration, returns a chat model.
+    """
+    with _lock:
+        _FACTORIES[model_type] = factory
+        invalidate()
+
+
+def invalidate():
+    """Drops every cached client and tool binding.
+
+    Shared HTTP connection pools are kept, since they do not depend on the
+    model configuration.
+    """
+    with _lock:
+        _clients.clear()
+        _bound_llms.clear()
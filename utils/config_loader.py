@@ -1,5 +1,6 @@
 import yaml
 import os
+import threading
 
 # Get the project root directory (which is the parent of the 'utils' directory)
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -7,6 +8,9 @@ PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 CONFIG_PATH = os.path.join(PROJECT_ROOT, 'config', 'config.yaml')
 EXAMPLE_CONFIG_PATH = os.path.join(PROJECT_ROOT, 'config', 'config.example.yaml')
 
+_loaded_from = {'path': None, 'mtime': None}
+_reload_lock = threading.Lock()
+
 def load_config():
     """Loads the model and API configuration from config.yaml."""
     if not os.path.exists(CONFIG_PATH):
@@ -20,10 +24,42 @@ def load_config():
 
     with open(config_file_to_load, 'r', encoding='utf-8') as f:
         config = yaml.safe_load(f)
+    _loaded_from['path'] = config_file_to_load
+    _loaded_from['mtime'] = os.path.getmtime(config_file_to_load)
     return config
 
 config = load_config()
 
+def reload_config_if_changed() -> bool:
+    """Reloads the configuration in place if config.yaml changed on disk.
+
+    The module-level `config` dict is updated in place so that modules which
+    imported it keep seeing the current values. The new file is parsed
+    first; keys are then overwritten and removed ones deleted, so threads
+    reading the config meanwhile never miss a key that both versions have.
+
+    Returns:
+        True if the configuration was reloaded.
+    """
+    path = CONFIG_PATH if os.path.exists(CONFIG_PATH) else EXAMPLE_CONFIG_PATH
+    with _reload_lock:
+        if path == _loaded_from['path'] and os.path.getmtime(path) == _loaded_from['mtime']:
+            return False
+        try:
+            new_config = load_config()
+        except yaml.YAMLError as e:
+            print(f"Warning: config reload failed, keeping the current configuration: {e}")
+            return False
+        if not new_config:
+            # 文件正在被写入时可能读到空内容，保留当前配置，下次再检查
+            _loaded_from['mtime'] = None
+            return False
+        # 不能先clear：其他线程此时读取会得到KeyError
+        config.update(new_config)
+        for key in [key for key in config if key not in new_config]:
+            config.pop(key, None)
+        return True
+
 def get_active_model_config(model_type: str):
     """Gets the configuration for the currently active model of a given type (llm or vlm)."""
     active_model_name = config['active_models'][model_type]
@@ -0,0 +1,151 @@
+"""Cached registry of the category and prompt configuration.
+
+`categories_config.yaml` and `prompt_config.yaml` are resolved relative to
+`PROJECT_ROOT`, parsed once, and turned into ready-to-use prompt strings and
+schemas. The files are only parsed again when their mtime changes, so the VLM
+tools do no file I/O or YAML parsing on the per-image hot path.
+"""
+import os
+import json
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple, Type
+
+import yaml
+from pydantic import BaseModel
+
+from .config_loader import PROJECT_ROOT
+from .models import TYPE_MODELS
+
+CONFIG_DIR = os.path.join(PROJECT_ROOT, 'config')
+CATEGORIES_CONFIG_PATH = os.path.join(CONFIG_DIR, 'categories_config.yaml')
+PROMPT_CONFIG_PATH = os.path.join(CONFIG_DIR, 'prompt_config.yaml')
+
+
+@dataclass(frozen=True)
+class CategoryPrompt:
+    """The precompiled extraction prompt and schema of one category.
+
+    Attributes:
+        name: The category name, e.g. '论文'.
+        description: The category description from categories_config.yaml.
+        prompt: The full extraction prompt (base prompt + category instruction).
+        model_class: The Pydantic model used to validate the extracted data.
+        fingerprint: The prompt plus the model's JSON schema, used for cache keys.
+    """
+    name: str
+    description: str
+    prompt: str
+    model_class: Type[BaseModel]
+    fingerprint: str
+
+
+@dataclass(frozen=True)
+class PromptSet:
+    """All prompts compiled from one version of the configuration files.
+
+    `batch_classification_prompt` contains the placeholder `{count}` for the
+    number of images in the request.
+    """
+    base_prompt: str
+    classification_prompt: str
+    fused_prompt: str
+    categories: Dict[str, CategoryPrompt]
+    batch_classification_prompt: str
+
+
+def _read_yaml(path: str) -> Dict:
+    with open(path, encoding='utf-8') as f:
+        return yaml.safe_load(f) or {}
+
+
+def _compile(categories_config: Dict, prompt_config: Dict) -> PromptSet:
+    """Builds every prompt string from the parsed configuration files."""
+    base_prompt = prompt_config.get('base_prompt', '')
+    instructions = {p['name']: p['instruction'] for p in prompt_config.get('prompts', [])}
+
+    descriptions: List[Tuple[str, str]] = []
+    for cat in categories_config.get('categories', []):
+        description = cat['description']
+        if not isinstance(description, str):
+            description = ', '.join(description)
+        descriptions.append((cat['name'], description))
+
+    classification_prompt = """请判断图像内容最符合下面哪种description的需求，选择最符合的类型
+    """
+    for name, description in descriptions:
+        classification_prompt += f"\n- {name}: {description}"
+    classification_prompt += """\n严格按照下面json格式输出
+    {"分析":"分析属于哪个类型的过程","类型":"类型名称"}
+    """
+
+    # 批量分类：类型说明只发送一次，按图片顺序输出每张图片的类型
+    batch_classification_prompt = """下面依次给出{count}张图片，每张图片前标有它的编号。请分别判断每张图片的内容最符合下面哪种description的需求
+    """
+    for name, description in descriptions:
+        batch_classification_prompt += f"\n- {name}: {description}"
+    batch_classification_prompt += """\n严格按照下面json格式输出，每张图片一项，按编号顺序，不要遗漏
+    {"结果":[{"图片":1,"类型":"类型名称"},{"图片":2,"类型":"类型名称"}]}
+    """
+
+    fused_prompt = base_prompt + "\n首先判断图像内容最符合下面哪种类型，然后按照该类型对应的字段提取信息：\n"
+    categories: Dict[str, CategoryPrompt] = {}
+    for name, description in descriptions:
+        model_class = TYPE_MODELS.get(name)
+        if model_class is None:
+            continue
+        prompt = base_prompt + instructions.get(name, '')
+        schema = json.dumps(model_class.model_json_schema(), sort_keys=True, ensure_ascii=False)
+        categories[name] = CategoryPrompt(name, description, prompt, model_class, prompt + schema)
+        fields = {field_name: field.description for field_name, field in model_class.model_fields.items()}
+        fused_prompt += f"\n- {name}: {description}\n  字段: {json.dumps(fields, ensure_ascii=False)}"
+    fused_prompt += """\n严格按照下面json格式输出
+    {"类型":"类型名称","数据":{该类型对应的字段}}
+    """
+
+    return PromptSet(base_prompt, classification_prompt, fused_prompt, categories, batch_classification_prompt)
+
+
+class PromptRegistry:
+    """Holds the compiled prompts and recompiles them when a config file changes."""
+
+    def __init__(self, categories_path: str = CATEGORIES_CONFIG_PATH, prompts_path: str = PROMPT_CONFIG_PATH):
+        self.categories_path = categories_path
+        self.prompts_path = prompts_path
+        self._mtimes: Optional[Tuple[float, float]] = None
+        self._prompts: Optional[PromptSet] = None
+        self._lock = threading.Lock()
+
+    def get(self) -> PromptSet:
+        """Returns the compiled prompts, reloading them if a file's mtime changed."""
+        mtimes = (os.path.getmtime(self.categories_path), os.path.getmtime(self.prompts_path))
+        if mtimes != self._mtimes:
+            with self._lock:
+                if mtimes != self._mtimes:
+                    self._prompts = _compile(_read_yaml(self.categories_path), _read_yaml(self.prompts_path))
+                    self._mtimes = mtimes
+        return self._prompts
+
+    def category(self, image_type: str) -> CategoryPrompt:
+        """Returns the compiled prompt of a category.
+
+        Raises:
+            ValueError: If the category has no Pydantic model.
+        """
+        categories = self.get().categories
+        if image_type not in categories:
+            raise ValueError(f"Unsupported image type: {image_type}")
+        return categories[image_type]
+
+
+_registry = PromptRegistry()
+
+
+def get_prompts() -> PromptSet:
+    """Returns the current compiled prompts of the process-wide registry."""
+    return _registry.get()
+
+
+def get_category_prompt(image_type: str) -> CategoryPrompt:
+    """Returns the compiled prompt of a category from the process-wide registry."""
+    return _registry.category(image_type)
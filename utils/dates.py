@@ -0,0 +1,43 @@
+"""Parsing of the free-form dates returned by the VLM."""
+import re
+from datetime import date, datetime
+from typing import Optional
+
+# Activity模型要求dd/mm/yy，但VLM经常返回其他格式，按顺序尝试
+DATE_FORMATS = ('%d/%m/%y', '%d/%m/%Y', '%Y-%m-%d', '%Y/%m/%d', '%Y.%m.%d', '%d.%m.%Y', '%d-%m-%Y')
+_CHINESE_DATE = re.compile(r'(?:(\d{2,4})\s*年)?\s*(\d{1,2})\s*月\s*(\d{1,2})\s*[日号]')
+
+
+def parse_date(value: str, today: Optional[date] = None) -> Optional[date]:
+    """Parses a date string in one of the formats the VLM commonly returns.
+
+    Supports dd/mm/yy (the format requested by the `Activity` model), ISO
+    dates and their '/' or '.' variants, and Chinese dates such as
+    '2025年7月21日' or '7月21日' (the year defaults to the current one).
+
+    Args:
+        value: The date string.
+        today: The reference date used for Chinese dates without a year.
+
+    Returns:
+        The parsed date, or None if the string is not a recognised date.
+    """
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    match = _CHINESE_DATE.search(value)
+    if match:
+        year, month, day = match.groups()
+        year = int(year) if year else (today or date.today()).year
+        if year < 100:
+            year += 2000
+        try:
+            return date(year, int(month), int(day))
+        except ValueError:
+            return None
+    return None
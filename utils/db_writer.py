@@ -0,0 +1,285 @@
+"""Persistent, batched SQLite writer for extracted records.
+
+All writes to the database go through one writer thread that owns a single
+WAL-mode connection. Records queued by concurrent tool calls are written
+together in one transaction, and table DDL only runs the first time a table
+(or a new column) is seen, so bulk ingests are not bound by one fsync and one
+`CREATE TABLE` per record.
+"""
+import os
+import json
+import queue
+import atexit
+import sqlite3
+import threading
+from concurrent.futures import Future
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+_STOP = object()
+
+
+def infer_column_type(value: Any) -> str:
+    """Returns the SQLite column type used for a Python value."""
+    if isinstance(value, bool): return "INTEGER"  # SQLite uses INTEGER for booleans
+    elif isinstance(value, int): return "INTEGER"
+    elif isinstance(value, float): return "REAL"
+    elif isinstance(value, str):
+        try:
+            datetime.strptime(value, '%Y-%m-%d')
+            return "DATE"
+        except ValueError:
+            return "TEXT"
+    return "TEXT" # Default for lists, etc.
+
+
+def _to_sql_value(value: Any) -> Any:
+    # Convert lists and dicts to JSON strings for storage
+    return json.dumps(value, ensure_ascii=False) if isinstance(value, (list, dict)) else value
+
+
+class DBWriter:
+    """A single-threaded writer that batches inserts into one transaction.
+
+    Args:
+        db_path: Path of the SQLite database.
+        batch_size: Maximum number of records written per transaction.
+    """
+
+    def __init__(self, db_path: str, batch_size: int = 500):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self._queue: "queue.Queue" = queue.Queue()
+        self._schemas: Dict[str, Set[str]] = {}
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self._thread.start()
+
+    # --- public API ---
+
+    def submit(self, table: str, data: Dict[str, Any]) -> Future:
+        """Queues a record for insertion.
+
+        Args:
+            table: The table to insert into; it is created if needed.
+            data: Column names mapped to values.
+
+        Returns:
+            A future resolving to the id of the inserted row.
+        """
+        if self._closed:
+            raise RuntimeError("DBWriter is closed.")
+        future: Future = Future()
+        self._queue.put(('insert', table, dict(data), future))
+        return future
+
+    def write(self, table: str, data: Dict[str, Any], timeout: Optional[float] = None) -> int:
+        """Inserts a record and waits until its transaction is committed.
+
+        Returns:
+            The id of the inserted row.
+        """
+        return self.submit(table, data).result(timeout)
+
+    def execute(self, fn, timeout: Optional[float] = None):
+        """Runs `fn(conn)` on the writer thread, inside its own transaction.
+
+        This is the hook for other writes that must not compete with the
+        writer for the database lock, e.g. migrations.
+        """
+        future: Future = Future()
+        self._queue.put(('call', fn, None, future))
+        return future.result(timeout)
+
+    def flush(self, timeout: Optional[float] = None):
+        """Blocks until every record queued so far is committed."""
+        self.execute(lambda conn: None, timeout)
+
+    def close(self):
+        """Flushes the queue and closes the connection. Registered with atexit."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    # --- writer thread ---
+
+    def _connect(self) -> sqlite3.Connection:
+        directory = os.path.dirname(os.path.abspath(self.db_path))
+        os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def _run(self):
+        try:
+            conn = self._connect()
+        except Exception as e:
+            conn, error = None, e
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            stop = False
+            # 把队列里已经排队的记录一起写入，合并为一个事务
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            if conn is None:
+                self._fail_batch(batch, error)
+            else:
+                try:
+                    self._process(conn, batch)
+                except Exception as e:
+                    # 写线程不能退出，否则之后所有的write()/execute()都会一直等待
+                    self._abort(conn, batch, e)
+            if stop:
+                break
+        if conn is not None:
+            conn.close()
+
+    def _abort(self, conn: sqlite3.Connection, batch: List[Tuple], error: Exception):
+        """Rolls back after an unexpected error and fails the unresolved futures of the batch."""
+        print(f"--- Database writer error: {error} ---")
+        self._schemas.clear()
+        try:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+        except sqlite3.Error:
+            pass
+        self._fail_batch(batch, error)
+
+    @staticmethod
+    def _fail_batch(batch: List[Tuple], error: Exception):
+        for item in batch:
+            future = item[3]
+            if not future.done():
+                future.set_exception(error)
+
+    def _process(self, conn: sqlite3.Connection, batch: List[Tuple]):
+        inserts = [item for item in batch if item[0] == 'insert']
+        if inserts:
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                ids = self._insert_many(conn, inserts)
+                conn.execute("COMMIT")
+                for (_, _, _, future), row_id in zip(inserts, ids):
+                    future.set_result(row_id)
+            except Exception:
+                # BEGIN IMMEDIATE本身失败（例如数据库一直被其他进程锁住）时没有事务可回滚
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                self._schemas.clear()  # DDL可能随事务一起回滚
+                # 整批失败时逐条重试，只让出错的记录失败
+                for item in inserts:
+                    self._insert_one(conn, item)
+        for kind, fn, _, future in batch:
+            if kind != 'call':
+                continue
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                result = fn(conn)
+                conn.execute("COMMIT")
+                self._schemas.clear()  # fn可能修改了表结构
+                future.set_result(result)
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                future.set_exception(e)
+
+    def _insert_one(self, conn: sqlite3.Connection, item: Tuple):
+        future = item[3]
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row_id = self._insert_many(conn, [item])[0]
+            conn.execute("COMMIT")
+            future.set_result(row_id)
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            self._schemas.clear()
+            future.set_exception(e)
+
+    def _insert_many(self, conn: sqlite3.Connection, items: List[Tuple]) -> List[int]:
+        """Inserts records, grouping consecutive ones with the same columns into one executemany."""
+        ids: List[int] = []
+        start = 0
+        while start < len(items):
+            _, table, data, _ = items[start]
+            columns = tuple(data.keys())
+            end = start + 1
+            while end < len(items) and items[end][1] == table and tuple(items[end][2].keys()) == columns:
+                end += 1
+            group = [item[2] for item in items[start:end]]
+            self._ensure_table(conn, table, group[0])
+            placeholders = ', '.join(['?'] * len(columns))
+            column_list = ', '.join(f'"{c}"' for c in columns)
+            sql = f'INSERT INTO "{table}" ({column_list}) VALUES ({placeholders})'
+            conn.executemany(sql, [tuple(_to_sql_value(d[c]) for c in columns) for d in group])
+            # 单写线程持有写锁，AUTOINCREMENT的id在同一批内是连续的
+            last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            ids.extend(range(last_id - len(group) + 1, last_id + 1))
+            start = end
+        return ids
+
+    def _ensure_table(self, conn: sqlite3.Connection, table: str, data: Dict[str, Any]):
+        """Creates the table or adds missing columns, using the in-memory schema cache."""
+        columns = self._schemas.get(table)
+        if columns is None:
+            columns = {row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')}
+            if not columns:
+                columns_defs = [f'"{key}" {infer_column_type(value)}' for key, value in data.items()]
+                conn.execute(f"""
+                    CREATE TABLE IF NOT EXISTS "{table}" (
+                        "id" INTEGER PRIMARY KEY AUTOINCREMENT,
+                        {', '.join(columns_defs)}
+                    )
+                """)
+                columns = {'id', *data.keys()}
+            self._schemas[table] = columns
+        for key, value in data.items():
+            if key not in columns:
+                conn.execute(f'ALTER TABLE "{table}" ADD COLUMN "{key}" {infer_column_type(value)}')
+                columns.add(key)
+
+
+_writers: Dict[str, DBWriter] = {}
+_writers_lock = threading.Lock()
+
+
+def get_db_path() -> str:
+    """Returns the database path from the DB_PATH environment variable."""
+    return os.getenv("DB_PATH", "database.db")
+
+
+def get_db_writer(db_path: Optional[str] = None) -> DBWriter:
+    """Returns the process-wide writer for a database, starting it if needed.
+
+    Args:
+        db_path: The database path. Defaults to the DB_PATH environment variable.
+    """
+    db_path = os.path.abspath(db_path or get_db_path())
+    writer = _writers.get(db_path)
+    if writer is None:
+        with _writers_lock:
+            writer = _writers.get(db_path)
+            if writer is None:
+                writer = _writers[db_path] = DBWriter(db_path)
+    return writer
+
+
+@atexit.register
+def close_all_writers():
+    """Flushes and closes every open writer. Runs automatically at interpreter exit."""
+    for writer in list(_writers.values()):
+        writer.close()
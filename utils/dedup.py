@@ -0,0 +1,283 @@
+"""Perceptual-hash index for detecting near-duplicate images.
+
+Every ingested image gets a 64-bit difference hash (dHash), which changes
+little under re-compression, small crops or resizing. Hashes are stored in the
+`image_hashes` table of the database and held in memory in a multi-index
+Hamming structure: the hash is split into `threshold + 1` chunks, and by the
+pigeonhole principle any hash within `threshold` bits matches at least one
+chunk exactly. A lookup only compares against those few candidates, so it
+stays well under a millisecond at 100k images.
+"""
+import time
+import asyncio
+import sqlite3
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from .config_loader import config
+from .db_writer import get_db_writer, get_db_path
+
+HASH_BITS = 64
+
+
+@dataclass(frozen=True)
+class HashEntry:
+    """An indexed image and the database record it produced.
+
+    Attributes:
+        id: Row id in `image_hashes`.
+        phash: The 64-bit dHash of the image.
+        image_path: The image the hash was computed from.
+        record_table: The table of the record extracted from the image.
+        record_id: The id of that record.
+    """
+    id: int
+    phash: int
+    image_path: str
+    record_table: Optional[str]
+    record_id: Optional[int]
+
+
+def dhash(image_path: str, hash_size: int = 8) -> int:
+    """Computes the 64-bit difference hash of an image."""
+    from PIL import Image, ImageOps
+
+    with Image.open(image_path) as image:
+        image = ImageOps.exif_transpose(image).convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS)
+        pixels = list(image.getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def _to_signed(value: int) -> int:
+    # SQLite的INTEGER是有符号64位
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _to_unsigned(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+class HashIndex:
+    """In-memory multi-index Hamming lookup over 64-bit hashes.
+
+    Args:
+        threshold: Maximum Hamming distance considered a near-duplicate.
+    """
+
+    def __init__(self, threshold: int = 5):
+        self.threshold = threshold
+        chunks = threshold + 1
+        base, extra = divmod(HASH_BITS, chunks)
+        self._chunks = []  # (shift, mask) per chunk
+        shift = 0
+        for i in range(chunks):
+            width = base + (1 if i < extra else 0)
+            self._chunks.append((shift, (1 << width) - 1))
+            shift += width
+        self._tables: List[Dict[int, List[HashEntry]]] = [{} for _ in range(chunks)]
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, entry: HashEntry):
+        """Adds an entry to the index."""
+        for (shift, mask), table in zip(self._chunks, self._tables):
+            table.setdefault((entry.phash >> shift) & mask, []).append(entry)
+        self._size += 1
+
+    def nearest(self, phash: int) -> Optional[HashEntry]:
+        """Returns the closest entry within the threshold, or None."""
+        best, best_distance = None, self.threshold + 1
+        for (shift, mask), table in zip(self._chunks, self._tables):
+            # 同一条目可能出现在多个分块的候选中，重复计算距离比去重更便宜
+            for entry in table.get((phash >> shift) & mask, ()):
+                distance = (entry.phash ^ phash).bit_count()
+                if distance < best_distance:
+                    best, best_distance = entry, distance
+        return best
+
+
+class DedupIndex:
+    """The persisted near-duplicate index of one database.
+
+    An image about to be processed reserves its hash with a pending row in
+    `image_hashes`, so a near-duplicate arriving meanwhile, in this or another
+    process sharing the database, waits for the original's record instead of
+    being processed too. The in-memory index is brought up to date with the
+    rows other processes added on every reservation.
+
+    Args:
+        db_path: The database holding the `image_hashes` table.
+        threshold: Maximum Hamming distance considered a near-duplicate.
+        reservation_timeout: Seconds after which a pending reservation, e.g.
+            of a crashed process, is ignored.
+    """
+
+    def __init__(self, db_path: str, threshold: int = 5, reservation_timeout: float = 600):
+        self.db_path = db_path
+        self.index = HashIndex(threshold)
+        self.reservation_timeout = reservation_timeout
+        self._lock = threading.Lock()
+        self._last_id = 0
+        get_db_writer(db_path).execute(self._create_table)
+        conn = sqlite3.connect(db_path)
+        try:
+            self._load_new(conn)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _create_table(conn: sqlite3.Connection):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS image_hashes (
+                "id" INTEGER PRIMARY KEY AUTOINCREMENT,
+                "phash" INTEGER NOT NULL,
+                "image_path" TEXT NOT NULL,
+                "record_table" TEXT,
+                "record_id" INTEGER,
+                "duplicate_of" INTEGER,
+                "created_at" REAL NOT NULL,
+                "pending" INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        columns = {row[1] for row in conn.execute('PRAGMA table_info("image_hashes")')}
+        if 'pending' not in columns:
+            conn.execute('ALTER TABLE image_hashes ADD COLUMN "pending" INTEGER NOT NULL DEFAULT 0')
+
+    def _load_new(self, conn: sqlite3.Connection):
+        """Adds the originals indexed since the last load, by this or another process."""
+        # AUTOINCREMENT的id只增不减，写事务又是串行的，所以按id增量加载不会漏行
+        rows = conn.execute(
+            "SELECT id, phash, image_path, record_table, record_id FROM image_hashes "
+            "WHERE id > ? AND duplicate_of IS NULL AND pending = 0 ORDER BY id", (self._last_id,)
+        ).fetchall()
+        with self._lock:
+            for row_id, phash, image_path, record_table, record_id in rows:
+                if row_id > self._last_id:
+                    self.index.add(HashEntry(row_id, _to_unsigned(phash), image_path, record_table, record_id))
+                    self._last_id = row_id
+
+    def find_duplicate(self, phash: int) -> Optional[HashEntry]:
+        """Returns the indexed image closest to `phash`, if within the threshold."""
+        with self._lock:
+            return self.index.nearest(phash)
+
+    def try_reserve(self, phash: int, image_path: str) -> Tuple[Optional[HashEntry], Optional[int]]:
+        """Looks up `phash` and reserves it if no near-duplicate is indexed or being processed.
+
+        Returns:
+            (original, None) for a near-duplicate of an indexed image,
+            (None, reservation id) once the hash is reserved, or (None, None)
+            while a near-duplicate is still being processed.
+        """
+        def _reserve(conn: sqlite3.Connection):
+            self._load_new(conn)
+            original = self.find_duplicate(phash)
+            if original is not None:
+                return original, None
+            now = time.time()
+            conn.execute("DELETE FROM image_hashes WHERE pending = 1 AND created_at < ?",
+                         (now - self.reservation_timeout,))
+            # 正在处理的图片一般只有几张，直接逐个比较
+            for (pending_hash,) in conn.execute("SELECT phash FROM image_hashes WHERE pending = 1"):
+                if (_to_unsigned(pending_hash) ^ phash).bit_count() <= self.index.threshold:
+                    return None, None
+            cursor = conn.execute(
+                "INSERT INTO image_hashes (phash, image_path, created_at, pending) VALUES (?, ?, ?, 1)",
+                (_to_signed(phash), image_path, now))
+            return None, cursor.lastrowid
+
+        return get_db_writer(self.db_path).execute(_reserve)
+
+    def reserve(self, phash: int, image_path: str, poll_interval: float = 0.5) -> Tuple[Optional[HashEntry], Optional[int]]:
+        """Like `try_reserve`, but waits while a near-duplicate is being processed.
+
+        Returns:
+            (original, None) for a near-duplicate, or (None, reservation id).
+        """
+        while True:
+            original, reservation = self.try_reserve(phash, image_path)
+            if original is not None or reservation is not None:
+                return original, reservation
+            time.sleep(poll_interval)
+
+    async def areserve(self, phash: int, image_path: str,
+                       poll_interval: float = 0.5) -> Tuple[Optional[HashEntry], Optional[int]]:
+        """Async counterpart of `reserve`; waits with `asyncio.sleep` instead of blocking a thread."""
+        while True:
+            original, reservation = await asyncio.to_thread(self.try_reserve, phash, image_path)
+            if original is not None or reservation is not None:
+                return original, reservation
+            await asyncio.sleep(poll_interval)
+
+    def complete(self, reservation: int, phash: int, image_path: str, record_table: str, record_id: int) -> int:
+        """Replaces a reservation with an indexed original and the record it produced.
+
+        Returns:
+            The id of the new `image_hashes` row.
+        """
+        def _complete(conn: sqlite3.Connection) -> int:
+            # 删除后重新插入得到新的id，其他进程按id增量加载时才能看到它
+            conn.execute("DELETE FROM image_hashes WHERE id = ? AND pending = 1", (reservation,))
+            cursor = conn.execute(
+                "INSERT INTO image_hashes (phash, image_path, record_table, record_id, created_at) "
+                "VALUES (?, ?, ?, ?, ?)", (_to_signed(phash), image_path, record_table, record_id, time.time()))
+            self._load_new(conn)
+            return cursor.lastrowid
+
+        return get_db_writer(self.db_path).execute(_complete)
+
+    def release(self, reservation: int):
+        """Drops a reservation, e.g. because processing its image failed."""
+        get_db_writer(self.db_path).execute(
+            lambda conn: conn.execute("DELETE FROM image_hashes WHERE id = ? AND pending = 1", (reservation,)))
+
+    def add(self, phash: int, image_path: str, record_table: Optional[str], record_id: Optional[int],
+            duplicate_of: Optional[HashEntry] = None) -> int:
+        """Persists an image hash; originals are also added to the in-memory index.
+
+        Args:
+            phash: The image's dHash.
+            image_path: The image path.
+            record_table: The table of the record produced for (or linked to) the image.
+            record_id: The id of that record.
+            duplicate_of: The original entry if the image is a near-duplicate.
+
+        Returns:
+            The id of the new `image_hashes` row.
+        """
+        def _insert(conn: sqlite3.Connection) -> int:
+            cursor = conn.execute(
+                "INSERT INTO image_hashes (phash, image_path, record_table, record_id, duplicate_of, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (_to_signed(phash), image_path, record_table, record_id,
+                 duplicate_of.id if duplicate_of else None, time.time())
+            )
+            if duplicate_of is None:
+                self._load_new(conn)
+            return cursor.lastrowid
+
+        return get_db_writer(self.db_path).execute(_insert)
+
+
+_indexes: Dict[str, DedupIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_dedup_index(db_path: Optional[str] = None) -> DedupIndex:
+    """Returns the process-wide near-duplicate index of a database, loading it on first use."""
+    db_path = db_path or get_db_path()
+    with _indexes_lock:
+        if db_path not in _indexes:
+            dedup_config = config.get('dedup', {})
+            _indexes[db_path] = DedupIndex(db_path, dedup_config.get('max_distance', 5),
+                                           dedup_config.get('reservation_timeout_seconds', 600))
+        return _indexes[db_path]
@@ -0,0 +1,106 @@
+"""Normalised, indexed storage and range queries for activity dates.
+
+The VLM returns activity dates as free text (usually dd/mm/yy), which SQLite's
+`date()` cannot parse. Records are therefore given an ISO `activity_date_iso`
+column at write time, backed by an index, and all event queries filter on it.
+"""
+import sqlite3
+import threading
+from datetime import date, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from .config_loader import config
+from .dates import parse_date
+from .db_writer import get_db_writer, get_db_path
+
+ACTIVITY_TYPE = '活动'
+ISO_DATE_COLUMN = 'activity_date_iso'
+
+_migrated_paths = set()
+_migrate_lock = threading.Lock()
+
+
+def activity_table() -> str:
+    """Returns the name of the table that stores activities."""
+    return config['database_tables'].get(ACTIVITY_TYPE, 'activity_log')
+
+
+def normalize_record(image_type: str, data: Dict[str, Any]) -> Dict[str, Any]:
+    """Adds the ISO date column to an activity record; other records are returned unchanged."""
+    if image_type != ACTIVITY_TYPE or 'activity_date' not in data:
+        return data
+    parsed = parse_date(data['activity_date'])
+    return {**data, ISO_DATE_COLUMN: parsed.isoformat() if parsed else None}
+
+
+def _migrate(conn: sqlite3.Connection) -> bool:
+    """Adds and backfills the ISO date column and its index. Returns False if the table does not exist yet."""
+    table = activity_table()
+    columns = {row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')}
+    if not columns:
+        return False
+    if ISO_DATE_COLUMN not in columns:
+        conn.execute(f'ALTER TABLE "{table}" ADD COLUMN "{ISO_DATE_COLUMN}" DATE')
+    # 补齐旧数据的ISO日期
+    rows = conn.execute(
+        f'SELECT id, activity_date FROM "{table}" WHERE "{ISO_DATE_COLUMN}" IS NULL AND activity_date IS NOT NULL'
+    ).fetchall()
+    updates = [(parsed.isoformat(), row_id) for row_id, value in rows if (parsed := parse_date(value))]
+    conn.executemany(f'UPDATE "{table}" SET "{ISO_DATE_COLUMN}" = ? WHERE id = ?', updates)
+    conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{table}_date_iso" ON "{table}" ("{ISO_DATE_COLUMN}")')
+    return True
+
+
+def ensure_activity_schema(db_path: Optional[str] = None):
+    """Makes sure the activity table has the ISO date column and index.
+
+    Runs on the database's writer thread, once per process and database.
+    """
+    db_path = db_path or get_db_path()
+    if db_path in _migrated_paths:
+        return
+    with _migrate_lock:
+        if db_path not in _migrated_paths and get_db_writer(db_path).execute(_migrate):
+            _migrated_paths.add(db_path)
+
+
+def query_upcoming_events(days: int = 10, location: Optional[str] = None, limit: int = 20,
+                          offset: int = 0, start: Optional[date] = None) -> Tuple[List[Dict[str, Any]], int]:
+    """Returns the activities taking place within the next `days` days.
+
+    The query only touches the index range of the ISO date column.
+
+    Args:
+        days: How many days ahead to look, starting today.
+        location: Optional substring the activity location must contain.
+        limit: Page size.
+        offset: Number of matching events to skip.
+        start: The first day of the range. Defaults to today.
+
+    Returns:
+        The events of the requested page, ordered by date, and the total
+        number of matching events.
+
+    Raises:
+        sqlite3.OperationalError: If the activity table does not exist.
+    """
+    ensure_activity_schema()
+    start = start or date.today()
+    where = f'"{ISO_DATE_COLUMN}" BETWEEN ? AND ?'
+    params: List[Any] = [start.isoformat(), (start + timedelta(days=days)).isoformat()]
+    if location:
+        where += ' AND activity_location LIKE ?'
+        params.append(f'%{location}%')
+
+    table = activity_table()
+    conn = sqlite3.connect(get_db_path())
+    try:
+        conn.row_factory = sqlite3.Row
+        total = conn.execute(f'SELECT COUNT(*) FROM "{table}" WHERE {where}', params).fetchone()[0]
+        rows = conn.execute(
+            f'SELECT * FROM "{table}" WHERE {where} ORDER BY "{ISO_DATE_COLUMN}", id LIMIT ? OFFSET ?',
+            params + [limit, offset]
+        ).fetchall()
+        return [dict(row) for row in rows], total
+    finally:
+        conn.close()
@@ -0,0 +1,337 @@
+"""SQLite FTS5 full-text search over the archived records.
+
+Every category table (`paper_info`, `exp`, `activity_log`, ...) gets an
+external-content FTS5 table `<table>_fts` over the text fields of its
+category model. Triggers on the record table keep the index in sync with
+every insert, update and delete, whichever code path writes the row; the
+index stores no second copy of the text.
+
+The `trigram` tokenizer is used when SQLite supports it (3.34+). It matches
+Chinese text, which has no word boundaries, by substring. Trigrams need at
+least three characters, and most Chinese words have two, so shorter terms are
+looked up in a second, contentless index `<table>_fts_short`: its text is
+pre-segmented by `segment` into the bigrams of every run of Chinese characters
+(plus the run's last character), and a short term is matched as a prefix
+phrase of its own segmentation. That index is maintained by temporary triggers
+on the process's writer connection, which has the `fts_segment` function;
+rows changed by other connections are picked up by `rebuild_search_index`.
+Older SQLite versions fall back to the `unicode61` tokenizer for everything.
+"""
+import re
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from .config_loader import config
+from .db_writer import get_db_writer, get_db_path
+from .models import TYPE_MODELS
+
+_CJK_RUN = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+
+_indexed = set()
+_index_lock = threading.Lock()
+_tokenizer: Optional[str] = None
+
+
+def tokenizer() -> str:
+    """Returns the FTS5 tokenizer used for new indexes: 'trigram' if available, else 'unicode61'."""
+    global _tokenizer
+    if _tokenizer is None:
+        conn = sqlite3.connect(':memory:')
+        try:
+            conn.execute("CREATE VIRTUAL TABLE t USING fts5(x, tokenize='trigram')")
+            _tokenizer = 'trigram'
+        except sqlite3.OperationalError:
+            _tokenizer = 'unicode61'
+        finally:
+            conn.close()
+    return _tokenizer
+
+
+def searchable_tables() -> Dict[str, str]:
+    """Returns the record tables that are indexed, mapped to their category."""
+    return {table: category for category, table in config['database_tables'].items() if category in TYPE_MODELS}
+
+
+def _fts_table(table: str) -> str:
+    return f"{table}_fts"
+
+
+def _columns(conn: sqlite3.Connection, name: str) -> List[str]:
+    return [row[1] for row in conn.execute(f'PRAGMA table_info("{name}")')]
+
+
+def _indexed_columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    """Returns the columns of the FTS table of `table`, in index order; empty if it does not exist."""
+    return _columns(conn, _fts_table(table))
+
+
+def segment(text: Any) -> Optional[str]:
+    """Splits every run of Chinese characters into its overlapping bigrams plus its last character.
+
+    '开会议题' becomes '开会 会议 议题 题', so every one- or two-character
+    substring of the run starts a token. Other text is left as it is.
+    """
+    if text is None:
+        return None
+    return _CJK_RUN.sub(lambda m: ' ' + ' '.join([m[0][i:i + 2] for i in range(len(m[0]) - 1)] + [m[0][-1]]) + ' ',
+                        str(text))
+
+
+def _register_segment(conn: sqlite3.Connection):
+    """Makes `segment` available as the SQL function `fts_segment` on `conn`."""
+    try:
+        conn.execute("SELECT fts_segment('')")
+    except sqlite3.OperationalError:
+        # 已有语句用到这个函数时不能重复注册，所以先检查
+        conn.create_function('fts_segment', 1, segment, deterministic=True)
+
+
+def _short_table(table: str) -> str:
+    return f"{table}_fts_short"
+
+
+def _fill_short_index(conn: sqlite3.Connection, table: str, fields: List[str], only_missing: bool):
+    short = _short_table(table)
+    column_list = ', '.join(f'"{f}"' for f in fields)
+    values = ', '.join(f'fts_segment("{f}")' for f in fields)
+    missing = f' WHERE id NOT IN (SELECT rowid FROM "{short}")' if only_missing else ''
+    conn.execute(f'INSERT INTO "{short}" (rowid, {column_list}) SELECT id, {values} FROM "{table}"{missing}')
+
+
+def _attach_short_index(conn: sqlite3.Connection, table: str, fields: List[str]):
+    """Creates the short-term index of `table` if needed and wires it to this connection's writes."""
+    _register_segment(conn)
+    short = _short_table(table)
+    column_list = ', '.join(f'"{f}"' for f in fields)
+    new_values = ', '.join(f'fts_segment(new."{f}")' for f in fields)
+    old_values = ', '.join(f'fts_segment(old."{f}")' for f in fields)
+    if not _columns(conn, short):
+        conn.execute(f"""
+            CREATE VIRTUAL TABLE "{short}" USING fts5({column_list}, content='', tokenize='unicode61')
+        """)
+    # 临时触发器只存在于本进程的写连接上，其他连接没有fts_segment函数也不会出错
+    conn.execute(f"""
+        CREATE TEMP TRIGGER IF NOT EXISTS "{short}_ai" AFTER INSERT ON main."{table}" BEGIN
+            INSERT INTO "{short}" (rowid, {column_list}) VALUES (new.id, {new_values});
+        END
+    """)
+    conn.execute(f"""
+        CREATE TEMP TRIGGER IF NOT EXISTS "{short}_ad" AFTER DELETE ON main."{table}" BEGIN
+            INSERT INTO "{short}" ("{short}", rowid, {column_list}) VALUES ('delete', old.id, {old_values});
+        END
+    """)
+    conn.execute(f"""
+        CREATE TEMP TRIGGER IF NOT EXISTS "{short}_au" AFTER UPDATE ON main."{table}" BEGIN
+            INSERT INTO "{short}" ("{short}", rowid, {column_list}) VALUES ('delete', old.id, {old_values});
+            INSERT INTO "{short}" (rowid, {column_list}) VALUES (new.id, {new_values});
+        END
+    """)
+    # 补上建索引之前、或本进程建触发器之前写入的记录
+    _fill_short_index(conn, table, fields, only_missing=True)
+
+
+def _create_index(conn: sqlite3.Connection, table: str) -> bool:
+    """Creates, fills and wires up the FTS tables of `table`. Returns False if `table` does not exist yet."""
+    columns = set(_columns(conn, table))
+    if not columns:
+        return False
+    fields = _indexed_columns(conn, table)
+    if not fields:
+        fields = [f for f in TYPE_MODELS[searchable_tables()[table]].model_fields if f in columns]
+        if not fields:
+            return False
+        _create_fts(conn, table, fields)
+    if tokenizer() == 'trigram':
+        _attach_short_index(conn, table, fields)
+    return True
+
+
+def _create_fts(conn: sqlite3.Connection, table: str, fields: List[str]):
+    """Creates and fills the trigger-synced FTS table of `table`."""
+    fts = _fts_table(table)
+    column_list = ', '.join(f'"{f}"' for f in fields)
+    new_values = ', '.join(f'new."{f}"' for f in fields)
+    old_values = ', '.join(f'old."{f}"' for f in fields)
+    conn.execute(f"""
+        CREATE VIRTUAL TABLE "{fts}" USING fts5(
+            {column_list}, content="{table}", content_rowid="id", tokenize='{tokenizer()}'
+        )
+    """)
+    # 外部内容表：FTS只存索引，插入、删除、更新都由触发器同步
+    conn.execute(f"""
+        CREATE TRIGGER "{fts}_ai" AFTER INSERT ON "{table}" BEGIN
+            INSERT INTO "{fts}" (rowid, {column_list}) VALUES (new.id, {new_values});
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER "{fts}_ad" AFTER DELETE ON "{table}" BEGIN
+            INSERT INTO "{fts}" ("{fts}", rowid, {column_list}) VALUES ('delete', old.id, {old_values});
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER "{fts}_au" AFTER UPDATE ON "{table}" BEGIN
+            INSERT INTO "{fts}" ("{fts}", rowid, {column_list}) VALUES ('delete', old.id, {old_values});
+            INSERT INTO "{fts}" (rowid, {column_list}) VALUES (new.id, {new_values});
+        END
+    """)
+    # 建索引之前已经存在的记录
+    conn.execute(f"""INSERT INTO "{fts}" ("{fts}") VALUES ('rebuild')""")
+
+
+def ensure_search_index(table: str, db_path: Optional[str] = None):
+    """Makes sure a record table has its FTS indexes and triggers.
+
+    Runs on the database's writer thread, once per process, database and
+    table, so every process's writer connection gets the short-term triggers.
+    """
+    if table not in searchable_tables():
+        return
+    key = (db_path or get_db_path(), table)
+    if key in _indexed:
+        return
+    with _index_lock:
+        if key not in _indexed and get_db_writer(key[0]).execute(lambda conn: _create_index(conn, table)):
+            _indexed.add(key)
+
+
+def rebuild_search_index(db_path: Optional[str] = None):
+    """Rebuilds every FTS index from its record table.
+
+    Needed after rows were edited with triggers disabled, or by another
+    connection than a writer of this package (short-term index only).
+    """
+    def _rebuild(conn: sqlite3.Connection):
+        for table in searchable_tables():
+            fields = _indexed_columns(conn, table)
+            if fields:
+                fts = _fts_table(table)
+                conn.execute(f"""INSERT INTO "{fts}" ("{fts}") VALUES ('rebuild')""")
+            if fields and _columns(conn, _short_table(table)):
+                _register_segment(conn)
+                short = _short_table(table)
+                conn.execute(f"""INSERT INTO "{short}" ("{short}") VALUES ('delete-all')""")
+                _fill_short_index(conn, table, fields, only_missing=False)
+    get_db_writer(db_path).execute(_rebuild)
+
+
+def _split_terms(query: str) -> Tuple[List[str], List[str]]:
+    """Splits a query into terms for the trigram index and terms too short for trigrams."""
+    terms = [t for t in query.split() if re.search(r'\w', t)]
+    if tokenizer() != 'trigram':
+        return terms, []
+    return [t for t in terms if len(t) >= 3], [t for t in terms if len(t) < 3]
+
+
+def _quote(text: str) -> str:
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _short_query(terms: List[str]) -> str:
+    # 短词按同样的方式切分，作为前缀短语匹配：'会议' -> "会议 议"*
+    return ' AND '.join(_quote(' '.join(segment(t).split())) + '*' for t in terms)
+
+
+def _plain_snippet(row: Dict[str, Any], fields: List[str], terms: List[str], width: int = 40) -> Optional[str]:
+    """Cuts a highlighted excerpt around the first term found in the row's fields."""
+    for field in fields:
+        text = row.get(field)
+        if not isinstance(text, str):
+            continue
+        for term in terms:
+            pos = text.lower().find(term.lower())
+            if pos >= 0:
+                start, end = max(0, pos - width // 2), pos + len(term)
+                return (('…' if start else '') + text[start:pos] + '[' + text[pos:end] + ']'
+                        + text[end:end + width // 2] + ('…' if end + width // 2 < len(text) else ''))
+    return None
+
+
+def search(query: str, tables: Optional[List[str]] = None, limit: int = 20,
+           offset: int = 0) -> Tuple[List[Dict[str, Any]], int]:
+    """Searches the archived records, best matches first.
+
+    All whitespace-separated terms must occur in a record. Records are scored
+    by BM25, the first field (e.g. the paper title) weighing twice as much as
+    the others. BM25 scores of different tables are not comparable, so each
+    table's scores are divided by its best one before the tables are merged.
+
+    Args:
+        query: The search terms.
+        tables: Record tables to search; defaults to every indexed table.
+        limit: Page size.
+        offset: Number of matching records to skip.
+
+    Returns:
+        The records of the requested page, each with its 'table', 'category',
+        'rank' (relevance in (0, 1], 1 for the best match of its table) and a
+        highlighted 'snippet', and the total number of matches.
+    """
+    match_terms, short_terms = _split_terms(query)
+    if not match_terms and not short_terms:
+        return [], 0
+    tables = [t for t in (tables or searchable_tables()) if t in searchable_tables()]
+    for table in tables:
+        ensure_search_index(table)
+
+    conn = sqlite3.connect(get_db_path())
+    try:
+        conn.row_factory = sqlite3.Row
+        selects, counts, params, table_params = [], [], [], {}
+        for table in tables:
+            fields = _indexed_columns(conn, table)
+            if not fields or (short_terms and not _columns(conn, _short_table(table))):
+                continue
+            weights = ', '.join(['2.0'] + ['1.0'] * (len(fields) - 1))
+            fts, short = _fts_table(table), _short_table(table)
+            if match_terms:
+                # 长词走trigram索引，短词用短词索引的匹配结果过滤；
+                # "+rowid" 避免把IN条件交给FTS5逐个按rowid查找
+                source, rank = fts, f'bm25("{fts}", {weights})'
+                where, where_params = [f'"{fts}" MATCH ?'], [' AND '.join(_quote(t) for t in match_terms)]
+                if short_terms:
+                    where.append(f'+rowid IN (SELECT rowid FROM "{short}" WHERE "{short}" MATCH ?)')
+                    where_params.append(_short_query(short_terms))
+            else:
+                source, rank = short, f'bm25("{short}", {weights})'
+                where, where_params = [f'"{short}" MATCH ?'], [_short_query(short_terms)]
+            where_sql = ' AND '.join(where)
+            selects.append(f"""
+                SELECT "table", id,
+                       CASE WHEN MIN(raw) OVER () < 0 THEN raw / MIN(raw) OVER () ELSE 1.0 END AS rank
+                FROM (SELECT '{table}' AS "table", rowid AS id, {rank} AS raw FROM "{source}" WHERE {where_sql})
+            """)
+            counts.append(f'SELECT COUNT(*) FROM "{source}" WHERE {where_sql}')
+            params.extend(where_params)
+            table_params[table] = where_params
+        if not selects:
+            return [], 0
+
+        total = sum(conn.execute(sql, table_params[table]).fetchone()[0]
+                    for sql, table in zip(counts, table_params))
+        union = ' UNION ALL '.join(selects)
+        hits = conn.execute(f'SELECT * FROM ({union}) ORDER BY rank DESC, id DESC LIMIT ? OFFSET ?',
+                            params + [limit, offset]).fetchall()
+
+        results = []
+        for hit in hits:
+            table = hit['table']
+            row = conn.execute(f'SELECT * FROM "{table}" WHERE id = ?', (hit['id'],)).fetchone()
+            if row is None:
+                continue
+            row = dict(row)
+            if match_terms:
+                # 只为当前页的记录生成摘录
+                fts = _fts_table(table)
+                snippet = conn.execute(
+                    f"""SELECT snippet("{fts}", -1, '[', ']', '…', 40) FROM "{fts}" WHERE "{fts}" MATCH ? AND rowid = ?""",
+                    (table_params[table][0], hit['id'])
+                ).fetchone()[0]
+            else:
+                # 短词索引不存原文，直接在记录里截取
+                snippet = _plain_snippet(row, _indexed_columns(conn, table), short_terms)
+            results.append({**row, 'table': table, 'category': searchable_tables()[table],
+                            'rank': hit['rank'], 'snippet': snippet})
+        return results, total
+    finally:
+        conn.close()
@@ -0,0 +1,115 @@
+"""Token-budgeted compaction of the message history sent to the orchestrator LLM.
+
+The graph state keeps the full history; `compact_messages` only builds the
+smaller view that `llm_agent` sends, so prompt size stays roughly flat as a
+run goes on instead of growing with every tool call.
+"""
+import json
+from typing import Any, Dict, List, Optional
+
+from langchain_core.messages import AIMessage, BaseMessage, ToolMessage
+
+from .config_loader import config
+
+# 结构化结果的工具，压缩时只保留解析后的字段
+STRUCTURED_TOOLS = ('classify_image', 'extract_info_from_image', 'classify_and_extract')
+REFLECTION_PREFIX = "Reflection on last action:"
+
+
+def estimate_tokens(message: BaseMessage) -> int:
+    """Roughly estimates the prompt tokens of a message.
+
+    Chinese text is about one token per 1-2 characters, so half the character
+    count is used as a cheap, slightly pessimistic estimate.
+    """
+    text = message.content if isinstance(message.content, str) else json.dumps(message.content, ensure_ascii=False)
+    tool_calls = getattr(message, 'tool_calls', None)
+    if tool_calls:
+        text += json.dumps([c['args'] for c in tool_calls], ensure_ascii=False)
+    return len(text) // 2 + 4
+
+
+def _truncate(text: str, max_chars: int) -> str:
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars] + f"... [truncated {len(text) - max_chars} chars]"
+
+
+def _structured_content(content: str) -> str:
+    """Drops raw model output and error details from a structured tool result."""
+    try:
+        data = json.loads(content)
+    except (json.JSONDecodeError, TypeError):
+        return content
+    if isinstance(data, dict):
+        data.pop('raw_output', None)
+        if 'details' in data:
+            data['details'] = _truncate(str(data['details']), 200)
+        return json.dumps(data, ensure_ascii=False)
+    return content
+
+
+def _summary(message: ToolMessage) -> str:
+    """One-line summary of a completed tool result."""
+    return f"[compacted] {message.name} → {_truncate(message.content, 80)}"
+
+
+def compact_messages(messages: List[BaseMessage], token_budget: Optional[int] = None,
+                     max_tool_chars: Optional[int] = None) -> List[BaseMessage]:
+    """Builds a compacted copy of the message history for the orchestrator LLM.
+
+    The first (task) message and the latest tool round are never summarised.
+    Older reflection notes are dropped, structured tool results lose their raw model
+    output, every tool message is capped at `max_tool_chars`, and if the
+    history still exceeds `token_budget`, the oldest completed results of the
+    other tools (e.g. search results) are replaced by one-line summaries.
+    Structured results are kept, since the LLM passes their fields on to
+    `save_data_to_db`. Tool call / tool result pairs are never split, so the
+    result stays a valid chat history.
+
+    Args:
+        messages: The full message history from the graph state.
+        token_budget: Approximate token budget. Defaults to `agent.history_token_budget`.
+        max_tool_chars: Maximum characters per tool message. Defaults to
+            `agent.max_tool_message_chars`.
+
+    Returns:
+        A new list of messages; the input messages are not modified.
+    """
+    agent_config: Dict[str, Any] = config.get('agent', {})
+    token_budget = token_budget or agent_config.get('history_token_budget', 4000)
+    max_tool_chars = max_tool_chars or agent_config.get('max_tool_message_chars', 2000)
+
+    # 最后一次发起工具调用的位置，之后的消息属于当前这一轮，保持原样
+    last_round = max((i for i, m in enumerate(messages) if isinstance(m, AIMessage) and m.tool_calls), default=len(messages))
+
+    compacted: List[BaseMessage] = []
+    keep_from = len(messages)
+    for i, message in enumerate(messages):
+        if i == last_round:
+            keep_from = len(compacted)
+        if isinstance(message, AIMessage) and not message.tool_calls \
+                and str(message.content).startswith(REFLECTION_PREFIX) and i < last_round:
+            continue  # 旧的反思意见已经被处理过了
+        if isinstance(message, ToolMessage):
+            content = message.content if isinstance(message.content, str) else json.dumps(message.content, ensure_ascii=False)
+            if message.name in STRUCTURED_TOOLS:
+                content = _structured_content(content)
+            message = message.model_copy(update={'content': _truncate(content, max_tool_chars)})
+        compacted.append(message)
+
+    total = sum(estimate_tokens(m) for m in compacted)
+    if total <= token_budget:
+        return compacted
+
+    # 仍然超出预算：从最早的已完成工具结果开始替换为摘要。
+    # 结构化提取结果不替换，LLM保存记录时还要用到其中的字段
+    for i, message in enumerate(compacted[1:keep_from], start=1):
+        if total <= token_budget:
+            break
+        if isinstance(message, ToolMessage) and message.name not in STRUCTURED_TOOLS \
+                and not message.content.startswith('[compacted]'):
+            summary = message.model_copy(update={'content': _summary(message)})
+            total += estimate_tokens(summary) - estimate_tokens(message)
+            compacted[i] = summary
+    return compacted
@@ -0,0 +1,148 @@
+"""Image preprocessing before VLM calls.
+
+Images are rotated according to their EXIF orientation, cropped of uniform
+borders, downscaled to a maximum side length and recompressed as JPEG. The
+result is written once to a disk cache keyed by the image content and the
+preprocessing settings, so every VLM call for the same image (classify,
+extract, fused) uploads the same small file.
+"""
+import os
+import json
+import hashlib
+import functools
+import threading
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from .config_loader import PROJECT_ROOT, config
+from .vlm_cache import file_sha256
+
+
+@dataclass(frozen=True)
+class PreparedImage:
+    """A preprocessed image ready to be sent to the VLM.
+
+    Attributes:
+        path: The file to upload; the original path if preprocessing was skipped.
+        original_bytes: Size of the original file.
+        prepared_bytes: Size of the file to upload.
+    """
+    path: str
+    original_bytes: int
+    prepared_bytes: int
+
+    @property
+    def bytes_saved(self) -> int:
+        """The number of upload bytes saved by preprocessing."""
+        return self.original_bytes - self.prepared_bytes
+
+
+_PREPARED_MEMO_SIZE = 4096  # 和vlm_cache的摘要一样，长时间运行的监视进程也只记住最近的这些图片
+_stats = {'images': 0, 'original_bytes': 0, 'prepared_bytes': 0}
+_lock = threading.Lock()
+
+
+def get_prep_config() -> Dict:
+    """Returns the `image_preprocessing` section of config.yaml with defaults filled in."""
+    prep_config = config.get('image_preprocessing', {})
+    cache_dir = prep_config.get('cache_dir', os.path.join('database', 'image_cache'))
+    return {
+        'enabled': prep_config.get('enabled', True),
+        'max_side': prep_config.get('max_side', 1600),
+        'quality': prep_config.get('quality', 85),
+        'crop_borders': prep_config.get('crop_borders', True),
+        'border_tolerance': prep_config.get('border_tolerance', 12),
+        'cache_dir': cache_dir if os.path.isabs(cache_dir) else os.path.join(PROJECT_ROOT, cache_dir),
+    }
+
+
+def _crop_uniform_border(image, tolerance: int):
+    """Crops borders that have (almost) the same colour as the top-left pixel."""
+    from PIL import Image, ImageChops
+
+    rgb = image.convert('RGB')
+    background = Image.new('RGB', rgb.size, rgb.getpixel((0, 0)))
+    diff = ImageChops.difference(rgb, background).convert('L').point(lambda v: 255 if v > tolerance else 0)
+    bbox = diff.getbbox()
+    if bbox and bbox != (0, 0) + image.size:
+        return image.crop(bbox)
+    return image
+
+
+def _preprocess(image_path: str, target_path: str, prep_config: Dict):
+    from PIL import Image, ImageOps
+
+    with Image.open(image_path) as image:
+        image = ImageOps.exif_transpose(image)
+        if prep_config['crop_borders']:
+            image = _crop_uniform_border(image, prep_config['border_tolerance'])
+        max_side = prep_config['max_side']
+        if max(image.size) > max_side:
+            image.thumbnail((max_side, max_side), Image.LANCZOS)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        tmp_path = f"{target_path}.{os.getpid()}.{threading.get_ident()}.tmp"  # 并发预处理同一张图时互不覆盖
+        image.save(tmp_path, 'JPEG', quality=prep_config['quality'], optimize=True)
+        os.replace(tmp_path, target_path)
+
+
+def prepare_image(image_path: str, max_side: Optional[int] = None) -> PreparedImage:
+    """Returns the preprocessed version of an image, creating it if needed.
+
+    If preprocessing is disabled, fails, or does not make the file smaller,
+    the original image is used.
+
+    Args:
+        image_path: The local file path of the original image.
+        max_side: Overrides `image_preprocessing.max_side`, e.g. for smaller
+            copies sent with batched classification requests.
+
+    Returns:
+        The `PreparedImage` to upload.
+    """
+    st = os.stat(image_path)
+    # 最近处理过的图片按 (路径, mtime, 大小) 记住结果，文件改动后重新处理
+    return _prepare(os.path.abspath(image_path), st.st_mtime_ns, st.st_size, max_side)
+
+
+@functools.lru_cache(maxsize=_PREPARED_MEMO_SIZE)
+def _prepare(image_path: str, mtime_ns: int, size: int, max_side: Optional[int]) -> PreparedImage:
+    prep_config = get_prep_config()
+    if max_side is not None:
+        prep_config['max_side'] = max_side
+    prepared = PreparedImage(image_path, size, size)
+    if prep_config['enabled']:
+        settings = json.dumps({k: v for k, v in prep_config.items() if k != 'cache_dir'}, sort_keys=True)
+        settings_fp = hashlib.sha256(settings.encode('utf-8')).hexdigest()[:8]
+        target_path = os.path.join(prep_config['cache_dir'], f"{file_sha256(image_path)}_{settings_fp}.jpg")
+        try:
+            if not os.path.exists(target_path):
+                os.makedirs(prep_config['cache_dir'], exist_ok=True)
+                _preprocess(image_path, target_path, prep_config)
+            prepared_size = os.path.getsize(target_path)
+            if prepared_size < size:
+                prepared = PreparedImage(target_path, size, prepared_size)
+        except Exception as e:
+            print(f"Image preprocessing failed for {image_path}, using the original: {e}")
+
+    with _lock:
+        _stats['images'] += 1
+        _stats['original_bytes'] += prepared.original_bytes
+        _stats['prepared_bytes'] += prepared.prepared_bytes
+    print(f"--- Image {os.path.basename(image_path)}: {prepared.original_bytes} -> {prepared.prepared_bytes} bytes "
+          f"({prepared.bytes_saved} saved) ---")
+    return prepared
+
+
+def image_pixels(path: str) -> int:
+    """Returns the pixel count of an image file, reading only its header."""
+    from PIL import Image
+
+    with Image.open(path) as image:
+        return image.width * image.height
+
+
+def preprocess_stats() -> Dict[str, int]:
+    """Returns the number of images prepared and their total original/uploaded bytes."""
+    with _lock:
+        return {**_stats, 'bytes_saved': _stats['original_bytes'] - _stats['prepared_bytes']}
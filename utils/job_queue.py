@@ -0,0 +1,282 @@
+"""Durable ingest job queue in the SQLite database.
+
+Producers (`main.py --enqueue`, the Gradio app) add one job per image to the
+`ingest_jobs` table; `worker.py` processes lease jobs one at a time. A lease
+hides the job from other workers for `visibility_timeout_seconds` and is
+extended by the worker's heartbeat while the job runs. A job that is neither
+acked nor extended in time, e.g. because its worker crashed, is leased again
+by the next worker. A job that failed `max_attempts` times is moved to the
+dead-letter state and kept for inspection (`requeue_dead` puts it back).
+
+All queue operations run as `BEGIN IMMEDIATE` transactions on the database's
+`DBWriter`, so workers in different processes, or on machines sharing the
+database file, never lease the same job twice.
+"""
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional
+
+from .config_loader import config
+from .db_writer import get_db_writer, get_db_path
+
+QUEUED, LEASED, DONE, DEAD = 'queued', 'leased', 'done', 'dead'
+
+
+@dataclass
+class Job:
+    """One leased ingest job."""
+    id: int
+    image_path: str
+    attempts: int
+    lease_owner: str
+    lease_expires_at: float
+
+
+def get_job_queue_config() -> Dict[str, Any]:
+    """Returns the `job_queue` section of config.yaml with defaults filled in."""
+    queue_config = config.get('job_queue', {})
+    return {
+        'visibility_timeout_seconds': queue_config.get('visibility_timeout_seconds', 120),
+        'max_attempts': queue_config.get('max_attempts', 3),
+        'retry_delay_seconds': queue_config.get('retry_delay_seconds', 30),
+        'poll_interval_seconds': queue_config.get('poll_interval_seconds', 2),
+        'workers': queue_config.get('workers', 2),
+    }
+
+
+def worker_id() -> str:
+    """Returns a lease owner name unique to this process: host and pid."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class JobQueue:
+    """The ingest job queue of one database.
+
+    Args:
+        db_path: The database holding the `ingest_jobs` table.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.settings = get_job_queue_config()
+        self._execute(self._create_table)
+
+    def _execute(self, fn):
+        # 多个进程同时开写事务时，busy_timeout过后仍可能报database is locked，稍后重试
+        for attempt in range(5):
+            try:
+                return get_db_writer(self.db_path).execute(fn)
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) or attempt == 4:
+                    raise
+                time.sleep(0.2 * 2 ** attempt)
+
+    @staticmethod
+    def _create_table(conn: sqlite3.Connection):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS ingest_jobs (
+                "id" INTEGER PRIMARY KEY AUTOINCREMENT,
+                "image_path" TEXT NOT NULL,
+                "status" TEXT NOT NULL,
+                "attempts" INTEGER NOT NULL DEFAULT 0,
+                "lease_owner" TEXT,
+                "lease_expires_at" REAL,
+                "available_at" REAL NOT NULL,
+                "last_error" TEXT,
+                "result" TEXT,
+                "created_at" REAL NOT NULL,
+                "updated_at" REAL NOT NULL
+            )
+        """)
+        # 同一张图片同时只能有一个未完成的任务
+        conn.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_ingest_jobs_open_path
+            ON ingest_jobs (image_path) WHERE status IN ('queued', 'leased')
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_ingest_jobs_status ON ingest_jobs (status, available_at)")
+
+    def enqueue(self, image_paths: Iterable[str]) -> int:
+        """Adds a job per image; images with a queued or running job are skipped.
+
+        Returns:
+            The number of jobs added.
+        """
+        now = time.time()
+        rows = [(os.path.abspath(path), QUEUED, now, now, now) for path in image_paths]
+
+        def _insert(conn: sqlite3.Connection) -> int:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO ingest_jobs (image_path, status, available_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)", rows)
+            return conn.total_changes - before
+
+        return self._execute(_insert) if rows else 0
+
+    def lease(self, owner: str, visibility_timeout: Optional[float] = None) -> Optional[Job]:
+        """Leases the oldest available job, or one whose lease has expired.
+
+        Expired jobs that already used all their attempts are dead-lettered
+        instead of being leased again.
+
+        Returns:
+            The leased job, or None if no job is available.
+        """
+        timeout = visibility_timeout or self.settings['visibility_timeout_seconds']
+        max_attempts = self.settings['max_attempts']
+
+        def _lease(conn: sqlite3.Connection) -> Optional[Job]:
+            now = time.time()
+            conn.execute(
+                "UPDATE ingest_jobs SET status = ?, lease_owner = NULL, updated_at = ?, "
+                "last_error = COALESCE(last_error, 'lease expired') "
+                "WHERE status = ? AND lease_expires_at < ? AND attempts >= ?",
+                (DEAD, now, LEASED, now, max_attempts))
+            row = conn.execute(
+                "SELECT id, image_path, attempts FROM ingest_jobs "
+                "WHERE (status = ? AND available_at <= ?) OR (status = ? AND lease_expires_at < ?) "
+                "ORDER BY available_at, id LIMIT 1",
+                (QUEUED, now, LEASED, now)).fetchone()
+            if row is None:
+                return None
+            expires = now + timeout
+            conn.execute(
+                "UPDATE ingest_jobs SET status = ?, attempts = attempts + 1, lease_owner = ?, "
+                "lease_expires_at = ?, updated_at = ? WHERE id = ?",
+                (LEASED, owner, expires, now, row[0]))
+            return Job(row[0], row[1], row[2] + 1, owner, expires)
+
+        return self._execute(_lease)
+
+    def _update_owned(self, job: Job, sql: str, params: tuple) -> bool:
+        """Runs an UPDATE of `job` only while `job.lease_owner` still holds its lease."""
+        def _update(conn: sqlite3.Connection) -> bool:
+            cursor = conn.execute(sql + " WHERE id = ? AND status = ? AND lease_owner = ?",
+                                  params + (job.id, LEASED, job.lease_owner))
+            return cursor.rowcount == 1
+        return self._execute(_update)
+
+    def heartbeat(self, job: Job, visibility_timeout: Optional[float] = None) -> bool:
+        """Extends the lease of a running job.
+
+        Returns:
+            False if the lease was lost, e.g. it expired and another worker took the job.
+        """
+        now = time.time()
+        expires = now + (visibility_timeout or self.settings['visibility_timeout_seconds'])
+        if self._update_owned(job, "UPDATE ingest_jobs SET lease_expires_at = ?, updated_at = ?", (expires, now)):
+            job.lease_expires_at = expires
+            return True
+        return False
+
+    def ack(self, job: Job, result: Optional[Dict[str, Any]] = None) -> bool:
+        """Marks a job as done, storing `result` as JSON. Returns False if the lease was lost."""
+        return self._update_owned(
+            job, "UPDATE ingest_jobs SET status = ?, lease_owner = NULL, result = ?, updated_at = ?",
+            (DONE, json.dumps(result, ensure_ascii=False) if result is not None else None, time.time()))
+
+    def fail(self, job: Job, error: str) -> bool:
+        """Records a failed attempt: the job is retried after a backoff, or dead-lettered after `max_attempts`.
+
+        Returns:
+            False if the lease was lost.
+        """
+        now = time.time()
+        if job.attempts >= self.settings['max_attempts']:
+            return self._update_owned(
+                job, "UPDATE ingest_jobs SET status = ?, lease_owner = NULL, last_error = ?, updated_at = ?",
+                (DEAD, error, now))
+        delay = self.settings['retry_delay_seconds'] * 2 ** (job.attempts - 1)
+        return self._update_owned(
+            job, "UPDATE ingest_jobs SET status = ?, lease_owner = NULL, last_error = ?, available_at = ?, "
+                 "updated_at = ?", (QUEUED, error, now + delay, now))
+
+    def release(self, job: Job) -> bool:
+        """Gives a job back without counting the attempt, e.g. when its worker is stopped."""
+        return self._update_owned(
+            job, "UPDATE ingest_jobs SET status = ?, lease_owner = NULL, attempts = attempts - 1, updated_at = ?",
+            (QUEUED, time.time()))
+
+    def requeue_dead(self) -> int:
+        """Puts every dead-lettered job back in the queue with fresh attempts. Returns their number."""
+        def _requeue(conn: sqlite3.Connection) -> int:
+            now = time.time()
+            # 图片已经重新入队（或同一张图片有多个死信）时，违反唯一索引的行保持不变
+            cursor = conn.execute(
+                "UPDATE OR IGNORE ingest_jobs SET status = ?, attempts = 0, available_at = ?, updated_at = ? "
+                "WHERE status = ?", (QUEUED, now, now, DEAD))
+            return cursor.rowcount
+        return self._execute(_requeue)
+
+    def _read(self, sql: str, params: tuple = ()) -> List[tuple]:
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the number of jobs per status."""
+        counts = {status: 0 for status in (QUEUED, LEASED, DONE, DEAD)}
+        counts.update(dict(self._read("SELECT status, COUNT(*) FROM ingest_jobs GROUP BY status")))
+        return counts
+
+    def dead_letters(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """Returns the most recent dead-lettered jobs with their last error."""
+        rows = self._read(
+            "SELECT id, image_path, attempts, last_error, updated_at FROM ingest_jobs "
+            "WHERE status = ? ORDER BY updated_at DESC LIMIT ?", (DEAD, limit))
+        return [dict(zip(('id', 'image_path', 'attempts', 'last_error', 'updated_at'), row)) for row in rows]
+
+
+class Heartbeat:
+    """Extends a job's lease in a background thread while the job runs.
+
+    Use as a context manager around the processing of a leased job; the
+    lease is extended every third of the visibility timeout.
+    """
+
+    def __init__(self, queue: JobQueue, job: Job):
+        self.queue = queue
+        self.job = job
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f'heartbeat-{job.id}', daemon=True)
+
+    def _run(self):
+        interval = self.queue.settings['visibility_timeout_seconds'] / 3
+        while not self._stop.wait(interval):
+            try:
+                if not self.queue.heartbeat(self.job):
+                    self.lost = True
+                    print(f"--- Lost the lease of job {self.job.id} ({self.job.image_path}) ---")
+                    return
+            except sqlite3.Error as e:
+                print(f"--- Heartbeat of job {self.job.id} failed: {e} ---")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+
+_queues: Dict[str, JobQueue] = {}
+_queues_lock = threading.Lock()
+
+
+def get_job_queue(db_path: Optional[str] = None) -> JobQueue:
+    """Returns the process-wide job queue of a database, creating its table on first use."""
+    db_path = db_path or get_db_path()
+    with _queues_lock:
+        if db_path not in _queues:
+            _queues[db_path] = JobQueue(db_path)
+        return _queues[db_path]
@@ -0,0 +1,139 @@
+"""Incremental parsing of the JSON object in a (streamed) model answer.
+
+Models wrap their JSON in markdown fences, put prose before it and chatter
+after it, and the prose may itself contain braces. `JSONObjectStream` is fed
+the answer chunk by chunk, finds the first text that parses as a JSON object,
+and reports each top-level field as soon as its value is complete, so a
+caller can see fields while the rest is still being generated and stop
+reading once the object closes. A candidate can still be rejected after some
+of its fields were reported (e.g. prose like `{"a": 1, see below}`), so
+callers that act on fields should wait until `done`, or compare
+`candidate_start`, before trusting them.
+"""
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+_OPEN = '{['
+_CLOSE = '}]'
+
+
+class JSONObjectStream:
+    """Finds the first JSON object in incrementally fed text.
+
+    Attributes:
+        text: All text fed so far.
+        fields: The top-level fields completed so far, in order.
+        done: Whether the object has closed.
+        value: The parsed object once `done`.
+        candidate_start: Position of the '{' of the current candidate object, or None.
+    """
+
+    def __init__(self):
+        self.text = ''
+        self.fields: Dict[str, Any] = {}
+        self.done = False
+        self.value: Optional[Dict[str, Any]] = None
+        self._pos = 0
+        self._end = 0
+        self._reset(None)
+
+    def _reset(self, start: Optional[int]):
+        """Starts looking for an object again after `start` (the '{' of a candidate that did not parse)."""
+        self._start = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._segment_start = 0
+        self.fields = {}
+        if start is not None:
+            self._pos = start + 1
+
+    @property
+    def candidate_start(self) -> Optional[int]:
+        return self._start
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        """Adds text and returns the top-level fields completed by it, as (key, value) pairs.
+
+        The returned fields all belong to the candidate at `candidate_start`
+        after the call; fields returned by earlier calls for a candidate that
+        has since been rejected are not withdrawn.
+        """
+        self.text += chunk
+        completed: List[Tuple[str, Any]] = []
+        text = self.text
+        while self._pos < len(text) and not self.done:
+            ch = text[self._pos]
+            if self._start is None:
+                if ch == '{':
+                    self._start, self._depth, self._segment_start = self._pos, 1, self._pos + 1
+            elif self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in _OPEN:
+                self._depth += 1
+            elif ch in _CLOSE:
+                self._depth -= 1
+                if self._depth == 0:
+                    if not self._close_segment(completed) or not self._close_object():
+                        self._reset(self._start)
+                        completed = []
+                        continue
+            elif ch == ',' and self._depth == 1:
+                if not self._close_segment(completed):
+                    self._reset(self._start)
+                    completed = []
+                    continue
+                self._segment_start = self._pos + 1
+            self._pos += 1
+        return completed
+
+    def _close_segment(self, completed: List[Tuple[str, Any]]) -> bool:
+        """Parses the `"key": value` pair ending at the current position."""
+        segment = self.text[self._segment_start:self._pos].strip()
+        if not segment:
+            return True
+        try:
+            pair = json.loads('{' + segment + '}')
+        except json.JSONDecodeError:
+            return False
+        if len(pair) != 1:
+            return False
+        key, value = next(iter(pair.items()))
+        self.fields[key] = value
+        completed.append((key, value))
+        return True
+
+    def _close_object(self) -> bool:
+        try:
+            value = json.loads(self.text[self._start:self._pos + 1])
+        except json.JSONDecodeError:
+            return False
+        if not isinstance(value, dict):
+            return False
+        self.value, self.done = value, True
+        self._end = self._pos + 1
+        return True
+
+    def consumed_text(self) -> str:
+        """Returns the text up to the end of the object, or all text if it has not closed."""
+        return self.text[:self._end] if self.done else self.text
+
+
+def parse_json_object(text: str) -> Dict[str, Any]:
+    """Returns the first JSON object found in a model answer.
+
+    Raises:
+        json.JSONDecodeError: If the text contains no complete JSON object.
+    """
+    stream = JSONObjectStream()
+    stream.feed(text)
+    if stream.done:
+        return stream.value
+    raise json.JSONDecodeError("No complete JSON object found", text, 0)
@@ -0,0 +1,181 @@
+"""Ingest manifest recording which images have already been processed.
+
+Each image path is stored with its size, mtime, content hash, status and the
+record it produced. A folder scan then only has to stat files: unchanged
+files are skipped without reading them, and files whose mtime changed are
+only re-processed if their content hash changed too.
+"""
+import os
+import time
+import sqlite3
+import threading
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+from .db_writer import get_db_writer, get_db_path
+from .vlm_cache import file_sha256
+
+# 这些状态表示图片已经处理完，不需要再处理
+DONE_STATUSES = ('done', 'duplicate')
+
+
+@dataclass
+class ManifestEntry:
+    """One row of the ingest manifest."""
+    path: str
+    size: int
+    mtime: float
+    content_hash: str
+    status: str
+    record_table: Optional[str] = None
+    record_id: Optional[int] = None
+    error: Optional[str] = None
+    updated_at: Optional[float] = None
+
+
+class Manifest:
+    """The ingest manifest of one database, cached in memory.
+
+    Args:
+        db_path: The database holding the `ingest_manifest` table.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        get_db_writer(db_path).execute(self._create_table)
+        conn = sqlite3.connect(db_path)
+        try:
+            rows = conn.execute(
+                "SELECT path, size, mtime, content_hash, status, record_table, record_id, error, updated_at "
+                "FROM ingest_manifest"
+            ).fetchall()
+        finally:
+            conn.close()
+        self._entries: Dict[str, ManifestEntry] = {row[0]: ManifestEntry(*row) for row in rows}
+
+    @staticmethod
+    def _create_table(conn: sqlite3.Connection):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS ingest_manifest (
+                "path" TEXT PRIMARY KEY,
+                "size" INTEGER NOT NULL,
+                "mtime" REAL NOT NULL,
+                "content_hash" TEXT NOT NULL,
+                "status" TEXT NOT NULL,
+                "record_table" TEXT,
+                "record_id" INTEGER,
+                "error" TEXT,
+                "updated_at" REAL NOT NULL
+            )
+        """)
+
+    def entries(self) -> List[ManifestEntry]:
+        """Returns all manifest entries."""
+        with self._lock:
+            return list(self._entries.values())
+
+    def get(self, path: str) -> Optional[ManifestEntry]:
+        """Returns the manifest entry of an image, if any."""
+        return self._entries.get(os.path.abspath(path))
+
+    def pending(self, image_paths: Iterable[str], include_failed: bool = True) -> List[str]:
+        """Filters `image_paths` down to the new, changed or previously failed images.
+
+        Args:
+            image_paths: Candidate image paths, e.g. from `list_images`.
+            include_failed: Whether images whose last run failed are returned
+                even if they have not changed since.
+
+        Returns:
+            The paths that still need processing, in the input order.
+        """
+        result = []
+        for path in image_paths:
+            entry = self.get(path)
+            if entry is None or (include_failed and entry.status not in DONE_STATUSES):
+                result.append(path)
+                continue
+            if entry.status not in DONE_STATUSES:
+                # 失败的图片只有在文件被改写后才算待处理，否则由failed()按退避时间重试
+                if self._changed(path, entry):
+                    result.append(path)
+                continue
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if st.st_size == entry.size and st.st_mtime == entry.mtime:
+                continue
+            # mtime变了但内容可能没变（例如被复制或touch过），比较内容哈希
+            if st.st_size == entry.size and file_sha256(path) == entry.content_hash:
+                self.mark(path, entry.status, entry.record_table, entry.record_id)
+                continue
+            result.append(path)
+        return result
+
+    @staticmethod
+    def _changed(path: str, entry: ManifestEntry) -> bool:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return False
+        return st.st_size != entry.size or st.st_mtime != entry.mtime
+
+    def failed(self, older_than: float = 0.0) -> List[str]:
+        """Returns the existing images whose last run failed at least `older_than` seconds ago."""
+        cutoff = time.time() - older_than
+        with self._lock:
+            entries = list(self._entries.values())
+        return [entry.path for entry in entries
+                if entry.status == 'failed' and (entry.updated_at or 0) <= cutoff and os.path.exists(entry.path)]
+
+    def mark(self, path: str, status: str, record_table: Optional[str] = None,
+             record_id: Optional[int] = None, error: Optional[str] = None):
+        """Records the outcome of processing an image.
+
+        If the image has been deleted or moved in the meantime, the status is
+        recorded without a fingerprint (size and mtime 0, no content hash),
+        so the image counts as changed if it ever comes back.
+
+        Args:
+            path: The image path.
+            status: 'done', 'duplicate' or 'failed'.
+            record_table: The table of the record produced for the image.
+            record_id: The id of that record.
+            error: The error message of a failed run.
+        """
+        path = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+            size, mtime, content_hash = st.st_size, st.st_mtime, file_sha256(path)
+        except OSError:
+            # 不能让这里的异常掩盖ingest失败时原本的错误
+            size, mtime, content_hash = 0, 0.0, ''
+        entry = ManifestEntry(path, size, mtime, content_hash, status, record_table, record_id, error, time.time())
+
+        def _upsert(conn: sqlite3.Connection):
+            conn.execute(
+                "INSERT OR REPLACE INTO ingest_manifest "
+                "(path, size, mtime, content_hash, status, record_table, record_id, error, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (entry.path, entry.size, entry.mtime, entry.content_hash, entry.status,
+                 entry.record_table, entry.record_id, entry.error, entry.updated_at)
+            )
+
+        get_db_writer(self.db_path).execute(_upsert)
+        with self._lock:
+            self._entries[path] = entry
+
+
+_manifests: Dict[str, Manifest] = {}
+_manifests_lock = threading.Lock()
+
+
+def get_manifest(db_path: Optional[str] = None) -> Manifest:
+    """Returns the process-wide ingest manifest of a database, loading it on first use."""
+    db_path = db_path or get_db_path()
+    with _manifests_lock:
+        if db_path not in _manifests:
+            _manifests[db_path] = Manifest(db_path)
+        return _manifests[db_path]
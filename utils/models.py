@@ -28,4 +28,11 @@ class Paper(BaseModel):
 #     research_field: str = Field(description="The field of the research")
 #     research_title: str = Field(description="The title of the research")
 #     research_content: str = Field(description="The summary of the research content")
-#     research_methods: Optional[List[str]] = Field(description="The research methods used")
\ No newline at end of file
+#     research_methods: Optional[List[str]] = Field(description="The research methods used")
+
+# 分类名称到数据模型的映射，提取结果按对应模型校验
+TYPE_MODELS = {
+    '活动': Activity,
+    '经验': Experience,
+    '论文': Paper # Assuming Paper and AcademicResearch can use the same prompt for now
+}
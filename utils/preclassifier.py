@@ -0,0 +1,444 @@
+"""A local, CPU-only pre-classifier in front of the VLM `classify_image` call.
+
+Screenshots of papers, activity posters and experience notes differ in
+simple image statistics: aspect ratio, how much of the image is text-like
+edges, how many text lines there are, how white and how colourful it is. The
+pre-classifier computes a few such features with Pillow from a small
+thumbnail and scores them with a softmax regression. The scores are
+calibrated with temperature scaling on held-out images, so a confidence of
+0.9 means about 9 in 10 such predictions are right.
+
+`classify_image` returns the local prediction when its confidence reaches
+`preclassifier.threshold` and asks the VLM otherwise. The model is trained
+from the images already ingested: the manifest maps each image to the table
+its record was saved in, and `database_tables` maps the table to a category.
+
+    python -m utils.preclassifier train    # train, save and print the report on the test images
+    python -m utils.preclassifier report   # evaluate the saved model on the labelled images
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .config_loader import PROJECT_ROOT, config
+from .tracing import span
+
+THUMBNAIL_SIZE = 128
+FEATURE_NAMES = [
+    'log_aspect', 'log_megapixels', 'brightness', 'contrast', 'white_fraction', 'dark_fraction',
+    'edge_density', 'text_row_fraction', 'text_line_rate', 'saturation', 'saturation_spread', 'hue_bins',
+] + [f'grid_{row}{col}' for row in range(3) for col in range(3)]
+
+
+def extract_features(image_path: str) -> List[float]:
+    """Computes the feature vector of an image from a small thumbnail.
+
+    Returns:
+        One float per name in `FEATURE_NAMES`.
+    """
+    from PIL import Image, ImageFilter, ImageOps, ImageStat
+
+    with Image.open(image_path) as image:
+        megapixels = image.width * image.height / 1e6
+        # JPEG在解码时就缩小，省掉大部分解码时间
+        image.draft('RGB', (THUMBNAIL_SIZE * 2, THUMBNAIL_SIZE * 2))
+        image = ImageOps.exif_transpose(image).convert('RGB')
+        aspect = image.height / image.width
+        image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+
+    gray = image.convert('L')
+    pixels = gray.width * gray.height
+    histogram = gray.histogram()
+    gray_stat = ImageStat.Stat(gray)
+
+    # 文字区域边缘密集：按行统计边缘像素，得到文字行的占比和行数
+    edges = gray.filter(ImageFilter.FIND_EDGES).point(lambda v: 255 if v > 40 else 0)
+    edge_data = list(edges.getdata())
+    row_density = [sum(edge_data[y * gray.width:(y + 1) * gray.width]) / (255 * gray.width)
+                   for y in range(gray.height)]
+    text_rows = [density > 0.05 for density in row_density]
+    line_starts = sum(1 for y in range(1, len(text_rows)) if text_rows[y] and not text_rows[y - 1])
+
+    hsv = image.convert('HSV')
+    hue, saturation, _ = hsv.split()
+    saturation_stat = ImageStat.Stat(saturation)
+    hue_counts = [0] * 12
+    for h, s in zip(hue.getdata(), saturation.getdata()):
+        if s > 60:
+            hue_counts[h * 12 // 256] += 1
+    grid = [v / 255 for v in gray.resize((3, 3), Image.BOX).getdata()]
+
+    return [
+        math.log(aspect),
+        math.log10(max(megapixels, 1e-6)),
+        gray_stat.mean[0] / 255,
+        gray_stat.stddev[0] / 255,
+        sum(histogram[230:]) / pixels,
+        sum(histogram[:50]) / pixels,
+        sum(edge_data) / (255 * pixels),
+        sum(text_rows) / len(text_rows),
+        line_starts / len(text_rows),
+        saturation_stat.mean[0] / 255,
+        saturation_stat.stddev[0] / 255,
+        sum(1 for c in hue_counts if c > 0.02 * pixels) / len(hue_counts),
+    ] + grid
+
+
+def _softmax(scores: Sequence[float]) -> List[float]:
+    top = max(scores)
+    exps = [math.exp(s - top) for s in scores]
+    total = sum(exps)
+    return [e / total for e in exps]
+
+
+class PreClassifier:
+    """A calibrated softmax regression over `FEATURE_NAMES`.
+
+    Args:
+        labels: The categories, in the order of the weight rows.
+        mean: Per-feature mean used for standardisation.
+        scale: Per-feature standard deviation used for standardisation.
+        weights: One weight row per label.
+        bias: One bias per label.
+        temperature: Divides the scores before the softmax; fitted on held-out images.
+    """
+
+    def __init__(self, labels: List[str], mean: List[float], scale: List[float],
+                 weights: List[List[float]], bias: List[float], temperature: float = 1.0):
+        self.labels = labels
+        self.mean = mean
+        self.scale = scale
+        self.weights = weights
+        self.bias = bias
+        self.temperature = temperature
+
+    def _standardize(self, features: Sequence[float]) -> List[float]:
+        return [(f - m) / s for f, m, s in zip(features, self.mean, self.scale)]
+
+    def scores(self, features: Sequence[float]) -> List[float]:
+        """Returns the uncalibrated score of every label."""
+        x = self._standardize(features)
+        return [b + sum(w_i * x_i for w_i, x_i in zip(w, x)) for w, b in zip(self.weights, self.bias)]
+
+    def probabilities(self, features: Sequence[float]) -> Dict[str, float]:
+        """Returns the calibrated probability of every label."""
+        probs = _softmax([s / self.temperature for s in self.scores(features)])
+        return dict(zip(self.labels, probs))
+
+    def predict_features(self, features: Sequence[float]) -> Tuple[str, float]:
+        """Returns the most likely label and its calibrated probability."""
+        probs = self.probabilities(features)
+        label = max(probs, key=probs.get)
+        return label, probs[label]
+
+    def predict(self, image_path: str) -> Tuple[str, float]:
+        """Classifies an image; returns the label and its calibrated probability."""
+        return self.predict_features(extract_features(image_path))
+
+    def to_dict(self) -> Dict:
+        return {'features': FEATURE_NAMES, 'labels': self.labels, 'mean': self.mean, 'scale': self.scale,
+                'weights': self.weights, 'bias': self.bias, 'temperature': self.temperature}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'PreClassifier':
+        if data.get('features') != FEATURE_NAMES:
+            raise ValueError("The pre-classifier was trained with other features; train it again.")
+        return cls(data['labels'], data['mean'], data['scale'], data['weights'], data['bias'],
+                   data.get('temperature', 1.0))
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> 'PreClassifier':
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls.from_dict(json.load(f))
+
+
+# --- Training ---
+
+def _fit_softmax(x: List[List[float]], y: List[int], n_labels: int, epochs: int = 300,
+                 learning_rate: float = 0.5, l2: float = 1e-3) -> Tuple[List[List[float]], List[float]]:
+    """Fits softmax regression weights by full-batch gradient descent with momentum."""
+    n, d = len(x), len(x[0])
+    weights = [[0.0] * d for _ in range(n_labels)]
+    bias = [0.0] * n_labels
+    velocity_w = [[0.0] * d for _ in range(n_labels)]
+    velocity_b = [0.0] * n_labels
+    for _ in range(epochs):
+        grad_w = [[l2 * w for w in row] for row in weights]
+        grad_b = [0.0] * n_labels
+        for xi, yi in zip(x, y):
+            probs = _softmax([b + sum(w_j * x_j for w_j, x_j in zip(w, xi)) for w, b in zip(weights, bias)])
+            for k in range(n_labels):
+                error = (probs[k] - (k == yi)) / n
+                if error:
+                    row = grad_w[k]
+                    for j in range(d):
+                        row[j] += error * xi[j]
+                    grad_b[k] += error
+        for k in range(n_labels):
+            for j in range(d):
+                velocity_w[k][j] = 0.9 * velocity_w[k][j] - learning_rate * grad_w[k][j]
+                weights[k][j] += velocity_w[k][j]
+            velocity_b[k] = 0.9 * velocity_b[k] - learning_rate * grad_b[k]
+            bias[k] += velocity_b[k]
+    return weights, bias
+
+
+def _fit_temperature(scores: List[List[float]], y: List[int]) -> float:
+    """Returns the temperature minimising the negative log-likelihood of held-out scores."""
+    def nll(t: float) -> float:
+        return -sum(math.log(max(_softmax([s / t for s in row])[yi], 1e-12)) for row, yi in zip(scores, y))
+    candidates = [0.25 * 1.1 ** i for i in range(40)]  # 0.25 ~ 10
+    return min(candidates, key=nll)
+
+
+def train(samples: List[Tuple[List[float], str]], holdout: float = 0.25, test: float = 0.2,
+          seed: int = 0) -> Tuple[PreClassifier, List[Tuple[List[float], str]]]:
+    """Trains and calibrates a pre-classifier.
+
+    The samples are split per label into three parts: the weights are fitted
+    on the first, the temperature on the second, and the third is used for
+    neither, so the model can be measured on images it has not seen.
+
+    Args:
+        samples: (features, label) pairs.
+        holdout: Fraction of each label kept for calibration.
+        test: Fraction of each label kept for testing.
+        seed: Seed of the split.
+
+    Returns:
+        The model and the test samples, e.g. for `evaluate`.
+
+    Raises:
+        ValueError: If there are fewer than two labels.
+    """
+    labels = sorted({label for _, label in samples})
+    if len(labels) < 2:
+        raise ValueError("At least two categories are needed to train the pre-classifier.")
+    rng = random.Random(seed)
+    fit_set, calibration_set, test_set = [], [], []
+    for label in labels:
+        group = [s for s in samples if s[1] == label]
+        rng.shuffle(group)
+        # 每个类别至少留一张图片用于拟合权重
+        test_cut = max(1, int(len(group) * test)) if len(group) > 2 else 0
+        calibration_cut = test_cut + (max(1, int(len(group) * holdout)) if len(group) - test_cut > 1 else 0)
+        test_set += group[:test_cut]
+        calibration_set += group[test_cut:calibration_cut]
+        fit_set += group[calibration_cut:]
+
+    columns = list(zip(*(features for features, _ in fit_set)))
+    mean = [sum(c) / len(c) for c in columns]
+    scale = [math.sqrt(sum((v - m) ** 2 for v in c) / len(c)) or 1.0 for c, m in zip(columns, mean)]
+    model = PreClassifier(labels, mean, scale, [], [])
+    x = [model._standardize(features) for features, _ in fit_set]
+    y = [labels.index(label) for _, label in fit_set]
+    model.weights, model.bias = _fit_softmax(x, y, len(labels))
+    if calibration_set:
+        model.temperature = _fit_temperature([model.scores(f) for f, _ in calibration_set],
+                                             [labels.index(label) for _, label in calibration_set])
+    return model, test_set
+
+
+def evaluate(model: PreClassifier, samples: List[Tuple[List[float], str]], threshold: float,
+             bins: int = 10) -> Dict[str, float]:
+    """Measures a model on labelled samples.
+
+    Returns:
+        The overall accuracy, the fraction of samples at or above `threshold`
+        (VLM calls saved), the accuracy of those, and the expected calibration
+        error (mean gap between confidence and accuracy over confidence bins).
+    """
+    if not samples:
+        return {'samples': 0}
+    predictions = [(model.predict_features(features), label) for features, label in samples]
+    correct = [predicted == label for (predicted, _), label in predictions]
+    hits = [ok for ((_, confidence), _), ok in zip(predictions, correct) if confidence >= threshold]
+    calibration_error = 0.0
+    for b in range(bins):
+        in_bin = [(confidence, ok) for ((_, confidence), _), ok in zip(predictions, correct)
+                  if b / bins < confidence <= (b + 1) / bins]
+        if in_bin:
+            gap = sum(c for c, _ in in_bin) / len(in_bin) - sum(ok for _, ok in in_bin) / len(in_bin)
+            calibration_error += abs(gap) * len(in_bin) / len(samples)
+    return {
+        'samples': len(samples),
+        'accuracy': sum(correct) / len(samples),
+        'hit_fraction': len(hits) / len(samples),
+        'hit_accuracy': sum(hits) / len(hits) if hits else 0.0,
+        'calibration_error': calibration_error,
+    }
+
+
+def labelled_images(db_path: Optional[str] = None) -> List[Tuple[str, str]]:
+    """Returns (image path, category) of the ingested images whose record table maps to a category."""
+    from .manifest import DONE_STATUSES, get_manifest
+
+    categories = {table: category for category, table in config['database_tables'].items() if category != 'default'}
+    manifest = get_manifest(db_path)
+    pairs = []
+    for entry in manifest.entries():
+        if entry.status in DONE_STATUSES and entry.record_table in categories and os.path.exists(entry.path):
+            pairs.append((entry.path, categories[entry.record_table]))
+    return pairs
+
+
+# --- Gate used by classify_image ---
+
+def get_preclassifier_config() -> Dict:
+    """Returns the `preclassifier` section of config.yaml with defaults applied."""
+    pre_config = config.get('preclassifier', {})
+    path = pre_config.get('model_path', os.path.join('database', 'preclassifier.json'))
+    return {
+        'enabled': pre_config.get('enabled', True),
+        'model_path': path if os.path.isabs(path) else os.path.join(PROJECT_ROOT, path),
+        'threshold': pre_config.get('threshold', 0.9),
+        'min_samples': pre_config.get('min_samples', 30),
+    }
+
+
+_model: Optional[PreClassifier] = None
+_model_mtime: Optional[float] = None
+_model_lock = threading.Lock()
+_stats = {'hits': 0, 'fallbacks': 0, 'seconds': 0.0}
+
+
+def get_preclassifier() -> Optional[PreClassifier]:
+    """Returns the saved model, reloading it when the file changes; None if disabled or not trained."""
+    global _model, _model_mtime
+    pre_config = get_preclassifier_config()
+    if not pre_config['enabled']:
+        return None
+    try:
+        mtime = os.path.getmtime(pre_config['model_path'])
+    except OSError:
+        return None
+    with _model_lock:
+        if mtime != _model_mtime:
+            try:
+                _model = PreClassifier.load(pre_config['model_path'])
+            except (OSError, ValueError, KeyError) as e:
+                print(f"--- Could not load the pre-classifier: {e} ---")
+                _model = None
+            _model_mtime = mtime
+        return _model
+
+
+def preclassify(image_path: str) -> Optional[str]:
+    """Returns the local prediction for an image if it is confident enough, else None.
+
+    Errors (e.g. an unreadable image) are treated as not confident, so the
+    VLM still gets to classify the image.
+    """
+    model = get_preclassifier()
+    if model is None:
+        return None
+    start = time.perf_counter()
+    with span('preclassify', kind='model') as s:
+        try:
+            label, confidence = model.predict(image_path)
+        except Exception as e:
+            print(f"--- Pre-classifier failed on {image_path}: {e} ---")
+            label, confidence = None, 0.0
+        hit = confidence >= get_preclassifier_config()['threshold']
+        s.set(label=label, confidence=round(confidence, 3), hit=hit)
+    with _model_lock:
+        _stats['seconds'] += time.perf_counter() - start
+        _stats['hits' if hit else 'fallbacks'] += 1
+    return label if hit else None
+
+
+def gate_stats() -> Dict[str, float]:
+    """Returns this process's pre-classifier hits, VLM fallbacks and mean latency in ms."""
+    with _model_lock:
+        calls = _stats['hits'] + _stats['fallbacks']
+        return {'hits': _stats['hits'], 'fallbacks': _stats['fallbacks'],
+                'hit_fraction': _stats['hits'] / calls if calls else 0.0,
+                'mean_ms': 1000 * _stats['seconds'] / calls if calls else 0.0}
+
+
+def reset_gate_stats():
+    """Clears the counters of `gate_stats`, e.g. between benchmark runs."""
+    with _model_lock:
+        _stats.update(hits=0, fallbacks=0, seconds=0.0)
+
+
+def format_gate_stats() -> str:
+    """Formats `gate_stats` as one line; empty if the pre-classifier has not been asked."""
+    stats = gate_stats()
+    if not stats['hits'] + stats['fallbacks']:
+        return ''
+    return (f"{stats['hits']} decided locally, {stats['fallbacks']} sent to the VLM "
+            f"(hit fraction {stats['hit_fraction']:.2f}, mean {stats['mean_ms']:.1f} ms)")
+
+
+# --- CLI ---
+
+def _load_samples(pairs: List[Tuple[str, str]]) -> Tuple[List[Tuple[List[float], str]], float]:
+    samples, start = [], time.perf_counter()
+    for path, label in pairs:
+        try:
+            samples.append((extract_features(path), label))
+        except Exception as e:
+            print(f"--- Skipping {path}: {e} ---")
+    latency_ms = 1000 * (time.perf_counter() - start) / max(len(pairs), 1)
+    return samples, latency_ms
+
+
+def _print_report(title: str, metrics: Dict[str, float], threshold: float, latency_ms: float):
+    print(f"--- {title} ---")
+    if not metrics.get('samples'):
+        print("no labelled images")
+        return
+    print(f"images               {metrics['samples']}")
+    print(f"accuracy             {metrics['accuracy']:.3f}")
+    print(f"{f'hits (>= {threshold:.2f})':<21}{metrics['hit_fraction']:.3f}  (VLM classify calls saved)")
+    print(f"hit accuracy         {metrics['hit_accuracy']:.3f}")
+    print(f"calibration error    {metrics['calibration_error']:.3f}")
+    print(f"latency per image    {latency_ms:.1f} ms")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Train or evaluate the local image pre-classifier.")
+    parser.add_argument('command', choices=['train', 'report'])
+    parser.add_argument('--db', help="database with the ingest manifest; defaults to DB_PATH")
+    parser.add_argument('--threshold', type=float, help="confidence threshold; defaults to preclassifier.threshold")
+    args = parser.parse_args(argv)
+
+    pre_config = get_preclassifier_config()
+    threshold = args.threshold if args.threshold is not None else pre_config['threshold']
+    pairs = labelled_images(args.db)
+    samples, latency_ms = _load_samples(pairs)
+
+    if args.command == 'train':
+        if len(samples) < pre_config['min_samples']:
+            print(f"Only {len(samples)} labelled images, at least {pre_config['min_samples']} are needed.")
+            sys.exit(1)
+        model, test_set = train(samples)
+        model.save(pre_config['model_path'])
+        print(f"--- Saved the pre-classifier to {pre_config['model_path']} "
+              f"(labels {model.labels}, temperature {model.temperature:.2f}) ---")
+        _print_report("Test images (used for neither the weights nor the temperature)",
+                      evaluate(model, test_set, threshold), threshold, latency_ms)
+        return
+
+    model = get_preclassifier()
+    if model is None:
+        print("No pre-classifier has been trained; run `python -m utils.preclassifier train` first.")
+        sys.exit(1)
+    _print_report("Labelled images (including the training images)", evaluate(model, samples, threshold),
+                  threshold, latency_ms)
+
+
+if __name__ == '__main__':
+    main()
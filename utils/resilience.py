@@ -0,0 +1,508 @@
+"""Rate limiting, retries, circuit breaking and hedging of provider calls.
+
+Every request to a model provider ('llm', 'vlm', 'search') goes through the
+`ProviderGuard` of that provider, via `guarded_call` / `aguarded_call`:
+
+- a token bucket limits the request rate. A 429 answer halves the rate (and
+  honours Retry-After); successful calls bring it back step by step;
+- transient failures (429, 5xx, timeouts, dropped connections) are retried
+  with exponential backoff and full jitter, within a time budget per call;
+- after `failure_threshold` consecutive transient failures the circuit opens
+  and calls fail at once with `ProviderUnavailableError`. After
+  `reset_seconds` one probe call decides whether it closes again;
+- with `hedge` enabled, a request still running after the provider's recent
+  p95 latency gets a duplicate, and the first answer wins.
+
+Each attempt holds one of the provider's `provider_slot`s. Counters and
+latency percentiles per provider are returned by `provider_metrics`.
+"""
+import time
+import random
+import asyncio
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from .config_loader import config
+from .batch import provider_slot, async_provider_slot
+from .tracing import record
+
+_DEFAULTS = {
+    'max_attempts': 4,
+    'backoff_base_seconds': 0.5,
+    'backoff_max_seconds': 10.0,
+    'max_elapsed_seconds': 60.0,
+    'failure_threshold': 5,
+    'reset_seconds': 30.0,
+    'hedge': False,
+    'hedge_percentile': 95,
+    'hedge_min_samples': 20,
+    'rate_per_second': 0,  # 0表示不限速
+    'burst': 1,
+}
+_PROVIDER_DEFAULTS = {
+    'llm': {'rate_per_second': 20, 'burst': 20},
+    'vlm': {'rate_per_second': 10, 'burst': 10},
+    'search': {'rate_per_second': 5, 'burst': 5},
+}
+# 这些异常类（或其父类）名表示网络层面的临时故障：openai/httpx/requests/内置异常
+_TRANSIENT_ERRORS = {
+    'TimeoutError', 'ConnectionError', 'APIConnectionError', 'APITimeoutError', 'InternalServerError',
+    'RateLimitError', 'TimeoutException', 'NetworkError', 'RemoteProtocolError', 'Timeout',
+}
+
+
+class ProviderUnavailableError(RuntimeError):
+    """Raised instead of calling a provider whose circuit is open."""
+
+
+def get_resilience_config(provider: str) -> Dict[str, Any]:
+    """Returns the settings of one provider: defaults, the `resilience` section and its `providers` entry."""
+    section = config.get('resilience', {})
+    overrides = section.get('providers', {}).get(provider, {})
+    settings = {**_DEFAULTS, **_PROVIDER_DEFAULTS.get(provider, {})}
+    settings.update({k: v for k, v in section.items() if k in _DEFAULTS})
+    settings.update(overrides)
+    return settings
+
+
+def is_enabled() -> bool:
+    """Returns whether provider calls are guarded (`resilience.enabled`)."""
+    return config.get('resilience', {}).get('enabled', True)
+
+
+def status_code(error: BaseException) -> Optional[int]:
+    """Returns the HTTP status of a provider error, whichever SDK raised it."""
+    code = getattr(error, 'status_code', None)
+    response = getattr(error, 'response', None) or getattr(error, 'resp', None)
+    if code is None and response is not None:
+        code = getattr(response, 'status_code', None) or getattr(response, 'status', None)
+        if code is None and isinstance(response, dict):
+            # DashScope的HTTPError里response是接口返回的字典
+            code = response.get('status_code')
+    try:
+        return int(code) if code is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def is_transient(error: BaseException) -> bool:
+    """Returns whether a failed call is worth retrying: 408, 429, 5xx, timeouts and connection errors."""
+    code = status_code(error)
+    if code is not None:
+        return code in (408, 429) or 500 <= code < 600
+    return any(cls.__name__ in _TRANSIENT_ERRORS for cls in type(error).__mro__)
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """Returns the seconds of a Retry-After header on the error's response, if any."""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    try:
+        return max(0.0, float(headers.get('retry-after')))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """A thread-safe token bucket whose rate adapts to throttling by the provider.
+
+    Args:
+        rate: Tokens per second; 0 or less disables the limit.
+        burst: Bucket size, i.e. how many calls may start at once.
+        min_fraction: The rate never drops below this fraction of `rate`.
+    """
+
+    def __init__(self, rate: float, burst: float, min_fraction: float = 0.1):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.min_rate = rate * min_fraction
+        self.tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self) -> float:
+        """Takes a token and returns how many seconds the caller has to wait before using it."""
+        if self.max_rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            # 令牌可以透支，透支的部分按当前速率排队
+            wait_seconds = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait_seconds, self._paused_until - now)
+
+    def try_take(self) -> bool:
+        """Takes a token only if one is available right now."""
+        if self.max_rate <= 0:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self.tokens < 1 or now < self._paused_until:
+                return False
+            self.tokens -= 1
+            return True
+
+    def throttle(self, pause: Optional[float] = None):
+        """Halves the rate after a 429, and stops handing out tokens for `pause` seconds if given."""
+        if self.max_rate <= 0 and not pause:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if self.max_rate > 0:
+                self._refill(now)
+                self.rate = max(self.min_rate, self.rate / 2)
+            if pause:
+                self._paused_until = max(self._paused_until, now + pause)
+
+    def recover(self):
+        """Raises the rate by a twentieth of its configured value after a successful call."""
+        if self.max_rate <= 0 or self.rate >= self.max_rate:
+            return
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class CircuitBreaker:
+    """Opens after consecutive failures and lets a single probe through once `reset_seconds` have passed.
+
+    Args:
+        failure_threshold: Consecutive failures that open the circuit; 0 disables it.
+        reset_seconds: How long the circuit stays open before a probe.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opens = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Returns whether a call may be made now."""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+                self.state, self._probing = self.HALF_OPEN, False
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def succeeded(self):
+        with self._lock:
+            self.state, self.failures, self._probing = self.CLOSED, 0, False
+
+    def failed(self) -> bool:
+        """Counts a transient failure; returns True if this opened the circuit."""
+        with self._lock:
+            self.failures += 1
+            if not self.failure_threshold:
+                return False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self.state, self._opened_at, self._probing = self.OPEN, time.monotonic(), False
+                self.opens += 1
+                return True
+            return False
+
+
+class LatencyWindow:
+    """The latencies of the most recent calls, for percentiles."""
+
+    def __init__(self, size: int = 200):
+        self._values = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self._values.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def percentile(self, p: float) -> float:
+        with self._lock:
+            values = sorted(self._values)
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+_hedge_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _get_hedge_pool() -> ThreadPoolExecutor:
+    global _hedge_pool
+    with _pool_lock:
+        if _hedge_pool is None:
+            _hedge_pool = ThreadPoolExecutor(max_workers=64, thread_name_prefix='hedge')
+        return _hedge_pool
+
+
+class ProviderGuard:
+    """Rate limit, retries, circuit breaker and hedging of one provider.
+
+    Args:
+        provider: The provider name ('llm', 'vlm' or 'search').
+        settings: See `get_resilience_config`.
+    """
+
+    def __init__(self, provider: str, settings: Dict[str, Any]):
+        self.provider = provider
+        self.settings = settings
+        self.bucket = TokenBucket(settings['rate_per_second'], settings['burst'])
+        self.breaker = CircuitBreaker(settings['failure_threshold'], settings['reset_seconds'])
+        self.attempt_latency = LatencyWindow()
+        self.call_latency = LatencyWindow()
+        self.counters = {name: 0 for name in ('calls', 'succeeded', 'failed', 'retries', 'throttled',
+                                              'rejected', 'hedges', 'hedge_wins')}
+        self.throttle_wait = 0.0
+        self._lock = threading.Lock()
+
+    def _count(self, name: str, amount: int = 1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def _admit(self) -> float:
+        """Checks the circuit and takes a token; returns the seconds to wait for it."""
+        if not self.breaker.allow():
+            self._count('rejected')
+            raise ProviderUnavailableError(
+                f"Provider '{self.provider}' is unavailable after {self.breaker.failures} consecutive failures; "
+                f"retrying in at most {self.settings['reset_seconds']}s.")
+        delay = self.bucket.reserve()
+        with self._lock:
+            self.throttle_wait += delay
+        return delay
+
+    def _hedge_delay(self) -> Optional[float]:
+        """Returns after how many seconds a duplicate is sent, or None if hedging is off or unmeasured."""
+        if not self.settings['hedge'] or len(self.attempt_latency) < self.settings['hedge_min_samples']:
+            return None
+        return self.attempt_latency.percentile(self.settings['hedge_percentile'])
+
+    def _retry_delay(self, error: Exception, attempt: int, deadline: float) -> Optional[float]:
+        """Books a failed attempt; returns the backoff before the next one, or None to give up."""
+        if not is_transient(error):
+            # 服务端正常答复了（例如400），对熔断器来说是成功
+            self.breaker.succeeded()
+            return None
+        pause = retry_after(error)
+        if status_code(error) == 429:
+            self._count('throttled')
+            self.bucket.throttle(pause)
+        if self.breaker.failed():
+            print(f"--- Circuit of provider '{self.provider}' opened after {self.breaker.failures} "
+                  f"consecutive failures: {error} ---")
+            return None
+        if attempt + 1 >= self.settings['max_attempts']:
+            return None
+        # 指数退避加全抖动，避免所有请求同时重试
+        delay = random.uniform(0, min(self.settings['backoff_max_seconds'],
+                                      self.settings['backoff_base_seconds'] * 2 ** attempt))
+        delay = max(delay, pause or 0.0)
+        if time.monotonic() + delay >= deadline:
+            return None
+        print(f"--- Provider '{self.provider}' failed ({error}); retrying in {delay:.1f}s ---")
+        return delay
+
+    def _succeeded(self, start: float):
+        self.breaker.succeeded()
+        self.bucket.recover()
+        self.call_latency.add(time.monotonic() - start)
+        self._count('succeeded')
+
+    def _timed(self, fn: Callable[[], Any]) -> Any:
+        with provider_slot(self.provider):
+            start = time.monotonic()
+            result = fn()
+            self.attempt_latency.add(time.monotonic() - start)
+            return result
+
+    def _hedged(self, fn: Callable[[], Any], hedge_after: float) -> Any:
+        pool = _get_hedge_pool()
+        # 线程池里的尝试沿用调用方的tracing上下文
+        primary = pool.submit(contextvars.copy_context().run, self._timed, fn)
+        if wait([primary], timeout=hedge_after).done or not self.bucket.try_take():
+            return primary.result()
+        self._count('hedges')
+        record(hedges=1)
+        hedge = pool.submit(contextvars.copy_context().run, self._timed, fn)
+        pending, error = {primary, hedge}, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self._count('hedge_wins')
+                    # 另一个请求无法中断，它的结果被丢弃
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def call(self, fn: Callable[[], Any]) -> Any:
+        """Calls `fn`, which makes one request to the provider, with rate limit, retries and hedging.
+
+        Raises:
+            ProviderUnavailableError: If the provider's circuit is open.
+            Exception: The last error of `fn` if it is not transient or the retries are exhausted.
+        """
+        self._count('calls')
+        start = time.monotonic()
+        deadline = start + self.settings['max_elapsed_seconds']
+        attempt = 0
+        while True:
+            time.sleep(self._admit())
+            hedge_after = self._hedge_delay()
+            try:
+                result = self._hedged(fn, hedge_after) if hedge_after is not None else self._timed(fn)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, deadline)
+                if delay is None:
+                    self._count('failed')
+                    raise
+                attempt += 1
+                self._count('retries')
+                record(retries=1)
+                time.sleep(delay)
+                continue
+            self._succeeded(start)
+            return result
+
+    async def _atimed(self, afn: Callable[[], Awaitable[Any]]) -> Any:
+        async with async_provider_slot(self.provider):
+            start = time.monotonic()
+            result = await afn()
+            self.attempt_latency.add(time.monotonic() - start)
+            return result
+
+    async def _ahedged(self, afn: Callable[[], Awaitable[Any]], hedge_after: float) -> Any:
+        tasks = [asyncio.ensure_future(self._atimed(afn))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if done or not self.bucket.try_take():
+                return await tasks[0]
+            self._count('hedges')
+            record(hedges=1)
+            tasks.append(asyncio.ensure_future(self._atimed(afn)))
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is tasks[1]:
+                            self._count('hedge_wins')
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # 落后的请求直接取消
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def acall(self, afn: Callable[[], Awaitable[Any]]) -> Any:
+        """Async counterpart of `call`; `afn` returns a new awaitable for every attempt."""
+        self._count('calls')
+        start = time.monotonic()
+        deadline = start + self.settings['max_elapsed_seconds']
+        attempt = 0
+        while True:
+            await asyncio.sleep(self._admit())
+            hedge_after = self._hedge_delay()
+            try:
+                result = await (self._ahedged(afn, hedge_after) if hedge_after is not None else self._atimed(afn))
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, deadline)
+                if delay is None:
+                    self._count('failed')
+                    raise
+                attempt += 1
+                self._count('retries')
+                record(retries=1)
+                await asyncio.sleep(delay)
+                continue
+            self._succeeded(start)
+            return result
+
+    def metrics(self) -> Dict[str, Any]:
+        """Returns the guard's counters, its circuit state, current rate and call latency percentiles."""
+        with self._lock:
+            metrics: Dict[str, Any] = dict(self.counters)
+            metrics['throttle_wait_seconds'] = round(self.throttle_wait, 3)
+        metrics['circuit'] = self.breaker.state
+        metrics['circuit_opens'] = self.breaker.opens
+        metrics['rate_per_second'] = round(self.bucket.rate, 2)
+        for p in (50, 95, 99):
+            metrics[f'p{p}_ms'] = round(self.call_latency.percentile(p) * 1000, 1)
+        return metrics
+
+
+_guards: Dict[str, ProviderGuard] = {}
+_guards_lock = threading.Lock()
+
+
+def get_guard(provider: str) -> ProviderGuard:
+    """Returns the process-wide guard of a provider."""
+    with _guards_lock:
+        if provider not in _guards:
+            _guards[provider] = ProviderGuard(provider, get_resilience_config(provider))
+        return _guards[provider]
+
+
+def reset_guards():
+    """Drops all guards with their state and metrics; the next calls read config.yaml again."""
+    with _guards_lock:
+        _guards.clear()
+
+
+def guarded_call(provider: str, fn: Callable[[], Any]) -> Any:
+    """Makes one logical request to a provider through its guard, or just in a `provider_slot` if disabled."""
+    if not is_enabled():
+        with provider_slot(provider):
+            return fn()
+    return get_guard(provider).call(fn)
+
+
+async def aguarded_call(provider: str, afn: Callable[[], Awaitable[Any]]) -> Any:
+    """Async counterpart of `guarded_call`."""
+    if not is_enabled():
+        async with async_provider_slot(provider):
+            return await afn()
+    return await get_guard(provider).acall(afn)
+
+
+def provider_metrics() -> Dict[str, Dict[str, Any]]:
+    """Returns the metrics of every provider called so far in this process."""
+    with _guards_lock:
+        guards = dict(_guards)
+    return {provider: guard.metrics() for provider, guard in sorted(guards.items())}
+
+
+def format_provider_metrics() -> str:
+    """Formats `provider_metrics` as one line per provider."""
+    lines = []
+    for provider, m in provider_metrics().items():
+        lines.append(f"{provider}: {m['calls']} calls, {m['failed']} failed, {m['retries']} retries, "
+                     f"{m['throttled']} throttled, {m['hedges']} hedged ({m['hedge_wins']} won), "
+                     f"circuit {m['circuit']}, p50/p95/p99 {m['p50_ms']}/{m['p95_ms']}/{m['p99_ms']} ms")
+    return '\n'.join(lines)
@@ -0,0 +1,397 @@
+"""Cached, deduplicated web search used by the `google_search` tool.
+
+Queries are normalised (Unicode NFKC, case, whitespace and surrounding
+punctuation) into a cache key, so the same paper title seen in different
+screenshots costs one external call. Results are kept in a SQLite cache with a
+TTL, and concurrent identical searches are collapsed into one backend request.
+
+Backends are pluggable: `GoogleBackend` calls the Google Custom Search API and
+`LocalIndexBackend` answers from a local JSON file, which keeps tests and
+benchmarks offline. Further backends can be added with `register_backend`.
+Backends answer with `format_results`, one block of title, snippet and link per
+result, so `best_match` can pick the result that belongs to a paper title.
+"""
+import os
+import re
+import json
+import time
+import asyncio
+import sqlite3
+import threading
+import unicodedata
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .config_loader import PROJECT_ROOT, config
+from .resilience import guarded_call, aguarded_call
+from .tracing import span, record
+
+NO_RESULT = "No good Google Search Result was found"
+_PUNCTUATION = ' \t\r\n"\'“”‘’`.,;:!?()[]{}<>《》「」。，；：！？'
+
+
+def normalize_query(query: str) -> str:
+    """Returns the canonical form of a query used as its cache key."""
+    query = unicodedata.normalize('NFKC', query).lower()
+    query = re.sub(r'\s+', ' ', query)
+    return query.strip(_PUNCTUATION)
+
+
+def format_results(results: List[Dict[str, str]]) -> str:
+    """Formats search results as text, one 'Title/Snippet/Link' block per result."""
+    if not results:
+        return NO_RESULT
+    return '\n\n'.join(
+        f"Title: {' '.join(r.get('title', '').split())}\n"
+        f"Snippet: {' '.join(r.get('snippet', '').split())}\n"
+        f"Link: {r.get('link', '')}"
+        for r in results
+    )
+
+
+def parse_results(text: str) -> List[Dict[str, str]]:
+    """Parses the output of `format_results` back into result dicts; other text gives no results."""
+    results = []
+    for block in text.split('\n\n'):
+        result = {}
+        for line in block.splitlines():
+            name, _, value = line.partition(': ')
+            if name in ('Title', 'Snippet', 'Link'):
+                result[name.lower()] = value.strip()
+        if 'title' in result and 'snippet' in result:
+            results.append(result)
+    return results
+
+
+def _title_tokens(text: str) -> set:
+    # 英文按单词、中文按单字比较
+    return set(re.findall(r'[^\W\d_\u4e00-\u9fff]+|\d+|[\u4e00-\u9fff]', normalize_query(text)))
+
+
+def best_match(title: str, text: str, min_overlap: float = 0.8) -> Optional[Dict[str, str]]:
+    """Returns the search result whose title matches `title`, or None.
+
+    A result matches if its title contains at least `min_overlap` of the
+    words (for Chinese: characters) of `title`; the best match wins.
+
+    Args:
+        title: The title searched for, e.g. a paper title.
+        text: Search results as returned by `format_results`.
+        min_overlap: The fraction of `title`'s words a matching result title must contain.
+    """
+    wanted = _title_tokens(title)
+    if not wanted:
+        return None
+    best, best_overlap = None, min_overlap
+    for result in parse_results(text):
+        overlap = len(wanted & _title_tokens(result['title'])) / len(wanted)
+        if overlap >= best_overlap and result['snippet']:
+            best, best_overlap = result, overlap
+    return best
+
+
+class SearchBackend:
+    """Interface of a search backend.
+
+    Attributes:
+        name: Part of the cache key, so results of different backends never mix.
+    """
+    name = 'base'
+
+    def search(self, query: str) -> str:
+        """Runs a search and returns the results as text."""
+        raise NotImplementedError
+
+    async def asearch(self, query: str) -> str:
+        """Async counterpart of `search`; runs `search` in a worker thread unless overridden."""
+        return await asyncio.to_thread(self.search, query)
+
+
+class GoogleBackend(SearchBackend):
+    """Google Custom Search restricted to paper sites.
+
+    The LangChain wrapper is built once and reused across calls.
+
+    Args:
+        sites: Sites the query is restricted to.
+        top_k: Maximum number of results returned.
+    """
+    name = 'google'
+
+    def __init__(self, sites: Optional[List[str]] = None, top_k: int = 3):
+        self.sites = sites or ['arxiv.org', 'springer.com']
+        self.top_k = top_k
+        self._wrapper = None
+        self._lock = threading.Lock()
+
+    def search(self, query: str) -> str:
+        with self._lock:
+            if self._wrapper is None:
+                from langchain_community.utilities import GoogleSearchAPIWrapper
+                self._wrapper = GoogleSearchAPIWrapper()
+        site_filter = ' OR '.join(f'site:{site}' for site in self.sites)
+        results = self._wrapper.results(f"{query} {site_filter}", self.top_k)
+        # 没有结果时返回 [{"Result": "No good Google Search Result was found"}]
+        return format_results([r for r in results if 'snippet' in r])
+
+
+class LocalIndexBackend(SearchBackend):
+    """Answers searches from a local JSON index, without network access.
+
+    The index file holds a list of objects with 'title', 'snippet' and 'link'
+    keys. Documents are ranked by the number of query words they contain.
+
+    Args:
+        path: The index file; a missing file is an empty index.
+        top_k: Maximum number of results returned.
+    """
+    name = 'local'
+
+    def __init__(self, path: str, top_k: int = 3):
+        self.path = path
+        self.top_k = top_k
+        self.documents: List[Dict[str, str]] = []
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.documents = json.load(f)
+        self._tokens = [set(self._tokenize(f"{d.get('title', '')} {d.get('snippet', '')}")) for d in self.documents]
+
+    @staticmethod
+    def _tokenize(text: str) -> List[str]:
+        return re.findall(r'\w+', normalize_query(text))
+
+    def search(self, query: str) -> str:
+        words = set(self._tokenize(query))
+        scored = [(len(words & tokens), i) for i, tokens in enumerate(self._tokens)]
+        ranked = [i for score, i in sorted(scored, key=lambda x: (-x[0], x[1])) if score > 0][:self.top_k]
+        return format_results([self.documents[i] for i in ranked])
+
+
+class SearchCache:
+    """A SQLite cache of search results with a time-to-live.
+
+    Args:
+        path: Location of the SQLite file.
+        ttl_hours: Results older than this are searched again.
+        enabled: When False every lookup misses and nothing is written.
+    """
+
+    def __init__(self, path: str, ttl_hours: float = 24 * 7, enabled: bool = True):
+        self.path = path
+        self.ttl_seconds = ttl_hours * 3600
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS search_cache (
+                    key TEXT PRIMARY KEY,
+                    query TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns the cached result for `key` if it has not expired."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT result, created_at FROM search_cache WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or time.time() - row[1] > self.ttl_seconds:
+            return None
+        return row[0]
+
+    def put(self, key: str, query: str, result: str):
+        """Stores a result and drops expired entries."""
+        if not self.enabled:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO search_cache (key, query, result, created_at) VALUES (?, ?, ?, ?)",
+                (key, query, result, now)
+            )
+            conn.execute("DELETE FROM search_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+            conn.commit()
+
+    def clear(self):
+        """Removes every cached result."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM search_cache")
+            conn.commit()
+
+
+class SearchService:
+    """Runs searches through a backend with caching and single-flight deduplication.
+
+    Args:
+        backend: The backend answering cache misses.
+        cache: The result cache.
+        wait_timeout_seconds: How long a collapsed search waits for the
+            in-flight one before giving up with a TimeoutError.
+    """
+
+    def __init__(self, backend: SearchBackend, cache: SearchCache, wait_timeout_seconds: float = 120):
+        self.backend = backend
+        self.cache = cache
+        self.wait_timeout_seconds = wait_timeout_seconds
+        self.hits = 0
+        self.misses = 0
+        self.collapsed = 0
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, Future] = {}
+
+    def _begin(self, query: str) -> Tuple[str, str, Optional[str], Optional[Future], bool]:
+        """Looks up the cache and joins or starts the in-flight search of a query.
+
+        Returns:
+            (normalised query, cache key, cached result or None, in-flight future, whether this call searches).
+        """
+        normalized = normalize_query(query)
+        key = f"{self.backend.name}:{normalized}"
+        cached = self.cache.get(key)
+        if cached is not None:
+            with self._lock:
+                self.hits += 1
+            record(cache_hits=1)
+            return normalized, key, cached, None, False
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+                self.misses += 1
+            else:
+                self.collapsed += 1
+        return normalized, key, None, future, leader
+
+    def _finish(self, key: str, normalized: str, future: Future, result: Optional[str] = None,
+                error: Optional[BaseException] = None):
+        try:
+            if error is None:
+                self.cache.put(key, normalized, result)
+                future.set_result(result)
+            else:
+                # 取消（CancelledError）或 KeyboardInterrupt 不能原样交给等待者，改为普通异常
+                if not isinstance(error, Exception):
+                    error = RuntimeError(f"Search for '{normalized}' was interrupted")
+                future.set_exception(error)
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def search(self, query: str) -> str:
+        """Returns the results for `query`, from the cache when possible.
+
+        If the same normalised query is already being searched by another
+        thread, this call waits for that result, at most `wait_timeout_seconds`,
+        instead of searching again. Errors are not cached.
+        """
+        normalized, key, cached, future, leader = self._begin(query)
+        if cached is not None:
+            return cached
+        if not leader:
+            return future.result(timeout=self.wait_timeout_seconds)
+        try:
+            with span('search_backend', kind='model', backend=self.backend.name):
+                result = guarded_call('search', lambda: self.backend.search(normalized))
+        except BaseException as e:
+            self._finish(key, normalized, future, error=e)
+            raise
+        self._finish(key, normalized, future, result)
+        return result
+
+    async def asearch(self, query: str) -> str:
+        """Async counterpart of `search`; identical searches from threads and coroutines share one request."""
+        normalized, key, cached, future, leader = self._begin(query)
+        if cached is not None:
+            return cached
+        if not leader:
+            # shield：等待者被取消时不能连带取消其他调用共享的future
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), self.wait_timeout_seconds)
+        try:
+            with span('search_backend', kind='model', backend=self.backend.name):
+                result = await aguarded_call('search', lambda: self.backend.asearch(normalized))
+        except BaseException as e:
+            self._finish(key, normalized, future, error=e)
+            raise
+        self._finish(key, normalized, future, result)
+        return result
+
+    def stats(self) -> Dict[str, int]:
+        """Returns cache hits, backend calls (misses) and collapsed concurrent searches."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "collapsed": self.collapsed}
+
+
+def _resolve(path: str) -> str:
+    return path if os.path.isabs(path) else os.path.join(PROJECT_ROOT, path)
+
+
+_BACKENDS: Dict[str, Callable[[Dict], SearchBackend]] = {
+    'google': lambda cfg: GoogleBackend(cfg.get('sites'), cfg.get('top_k', 3)),
+    'local': lambda cfg: LocalIndexBackend(
+        _resolve(cfg.get('local_index_path', os.path.join('database', 'search_index.json'))),
+        cfg.get('top_k', 3),
+    ),
+}
+
+
+def register_backend(name: str, factory: Callable[[Dict], SearchBackend]):
+    """Makes a backend selectable with `search.backend` (or SEARCH_BACKEND).
+
+    Args:
+        name: The backend name.
+        factory: Builds the backend from the `search` config section.
+    """
+    global _service
+    _BACKENDS[name] = factory
+    _service = None
+
+
+_service: Optional[SearchService] = None
+_service_lock = threading.Lock()
+
+
+def use_search_service(service: Optional[SearchService]):
+    """Replaces the process-wide search service; None rebuilds it from config.yaml on next use."""
+    global _service
+    with _service_lock:
+        _service = service
+
+
+def get_search_service() -> SearchService:
+    """Returns the process-wide search service configured by the `search` section of config.yaml.
+
+    The environment variable SEARCH_BACKEND overrides the configured backend,
+    e.g. `SEARCH_BACKEND=local` for offline runs.
+    """
+    global _service
+    with _service_lock:
+        if _service is None:
+            search_config = config.get('search', {})
+            backend_name = os.getenv('SEARCH_BACKEND') or search_config.get('backend', 'google')
+            if backend_name not in _BACKENDS:
+                raise ValueError(f"Unsupported search backend: {backend_name}")
+            cache = SearchCache(
+                _resolve(search_config.get('cache_path', os.path.join('database', 'search_cache.db'))),
+                ttl_hours=search_config.get('ttl_hours', 24 * 7),
+                enabled=search_config.get('cache_enabled', True),
+            )
+            _service = SearchService(_BACKENDS[backend_name](search_config), cache,
+                                     wait_timeout_seconds=search_config.get('wait_timeout_seconds', 120))
+        return _service
@@ -1,34 +1,43 @@
-import os
 import json
-import yaml
+import time
+import asyncio
 import sqlite3
-from datetime import datetime
-from typing import Type, Dict, Any
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
 
-from langchain_community.chat_models.tongyi import ChatTongyi
 from langchain_core.messages import HumanMessage
-from pydantic import BaseModel
 from langchain_core.tools import tool
-from langchain_openai import ChatOpenAI
+from pydantic import TypeAdapter
 from .config_loader import get_active_model_config, config
-from langchain_community.tools import GoogleSearchRun
-from langchain_community.utilities import GoogleSearchAPIWrapper
 
 
 
 
 
 
-from utils.models import Activity, Experience, Paper
+from utils.models import TYPE_MODELS
+from utils.config_registry import get_prompts, get_category_prompt
+from utils.vlm_cache import get_vlm_cache
+from utils.image_prep import prepare_image, image_pixels
+from utils.json_stream import JSONObjectStream, parse_json_object
+from utils.preclassifier import preclassify
+from utils.batch import get_batch_config
+from utils.resilience import guarded_call, aguarded_call
+from utils.clients import get_client
+from utils.db_writer import get_db_writer
+from utils.search import get_search_service
+from utils.tracing import span, traced, record, record_usage
+from utils.events import ACTIVITY_TYPE, normalize_record, ensure_activity_schema, query_upcoming_events
+from utils.fulltext import ensure_search_index, search as search_index
 
 # --- Helper Functions ---
 
 def get_vlm():
-    """Initializes and returns the active Vision Language Model (VLM).
+    """Returns the shared client of the active Vision Language Model (VLM).
 
-    This function reads the configuration to determine which VLM is active,
-    retrieves the necessary API key from environment variables, and instantiates
-    the corresponding VLM client.
+    The client is built once per active model configuration by the registry in
+    `utils.clients` and reused across tool calls.
 
     Returns:
         An instance of the configured VLM client (e.g., ChatTongyi).
@@ -37,25 +46,13 @@ def get_vlm():
         ValueError: If the required API key is not found in the environment variables.
         NotImplementedError: If the configured VLM is not supported.
     """
-    vlm_config = get_active_model_config('vlm')
-    api_key_name = vlm_config['api_key_name']
-    api_key = os.getenv(api_key_name)
-
-    if not api_key:
-        raise ValueError(f"API key '{api_key_name}' not found in environment variables.")
-
-    # This part can be extended if you support other VLMs
-    if 'qwen' in vlm_config['model_name']:
-        return ChatTongyi(model_name=vlm_config['model_name'], dashscope_api_key=api_key)
-    else:
-        raise NotImplementedError(f"VLM for '{vlm_config['model_name']}' is not implemented.")
+    return get_client('vlm')
 
 def get_llm():
-    """Initializes and returns the active Large Language Model (LLM).
+    """Returns the shared client of the active Large Language Model (LLM).
 
-    This function reads the configuration to determine which LLM is active,
-    retrieves the necessary API key from environment variables, and instantiates
-    the corresponding LLM client.
+    The client is built once per active model configuration by the registry in
+    `utils.clients` and reused across graph steps.
 
     Returns:
         An instance of the configured LLM client (e.g., ChatOpenAI).
@@ -64,28 +61,14 @@ def get_llm():
         ValueError: If the required API key is not found in the environment variables.
         NotImplementedError: If the configured LLM is not supported.
     """
-    llm_config = get_active_model_config('llm')
-    api_key_name = llm_config['api_key_name']
-    api_key = os.getenv(api_key_name)
-
-    if not api_key:
-        raise ValueError(f"API key '{api_key_name}' not found in environment variables.")
-
-    # This part can be extended to support other LLMs like those from OpenAI, Anthropic, etc.
-    if 'deepseek' in llm_config['model_name']:
-        return ChatOpenAI(
-            model=llm_config['model_name'],
-            openai_api_key=api_key,
-            openai_api_base=llm_config['api_base_url']
-        )
-    else:
-        raise NotImplementedError(f"LLM for '{llm_config['model_name']}' is not implemented.")
+    return get_client('llm')
 
 def parse_json_from_response(response_content: str) -> Dict[str, Any]:
     """Extracts a JSON object from a model's string response.
 
     It handles responses where the JSON is embedded within a markdown code block
-    (e.g., ```json\n{...}\n```) or as a plain string.
+    (e.g., ```json\n{...}\n```), surrounded by prose, or as a plain string; the
+    first text that parses as a JSON object is returned (see `utils.json_stream`).
 
     Args:
         response_content: The raw string response from the language model.
@@ -97,27 +80,233 @@ def parse_json_from_response(response_content: str) -> Dict[str, Any]:
         json.JSONDecodeError: If parsing the JSON fails.
     """
     try:
-        # A common pattern is for the model to return JSON in a markdown block
-        start = response_content.find('```json\n{') + len('```json\n')
-        end = response_content.rfind('}\n```') + 1
-        if start == -1 + len('```json\n'): # Fallback if markdown block is not found
-            start = response_content.find('{')
-            end = response_content.rfind('}') + 1
-        
-        json_str = response_content[start:end]
-        return json.loads(json_str)
-    except (json.JSONDecodeError, IndexError) as e:
+        return parse_json_object(response_content)
+    except json.JSONDecodeError as e:
         print(f"Error parsing JSON: {e}\nResponse: {response_content}")
         raise
 
+def _vlm_message(prompt: str, image_path: str) -> HumanMessage:
+    return HumanMessage(content=[
+        {"type": "text", "text": prompt},  # Explicitly specify type
+        {"type": "image", "image": image_path}  # Proper format for image
+    ])
+
+def _vlm_batch_message(prompt: str, image_paths: List[str]) -> HumanMessage:
+    """Builds one message with several images, each preceded by its 1-based number."""
+    content = [{"type": "text", "text": prompt}]
+    for number, image_path in enumerate(image_paths, 1):
+        content.append({"type": "text", "text": f"图片{number}:"})
+        content.append({"type": "image", "image": image_path})
+    return HumanMessage(content=content)
+
+def _call_vlm(message: HumanMessage, image_bytes: int) -> str:
+    """Sends one message to the VLM and returns the text answer."""
+    vlm = get_vlm()
+    with span('vlm', kind='model'):
+        result = guarded_call('vlm', lambda: vlm.invoke([message]))
+        record(image_bytes=image_bytes)
+        record_usage(result)
+    return _chunk_text(result.content)
+
+async def _acall_vlm(message: HumanMessage, image_bytes: int) -> str:
+    """Async counterpart of `_call_vlm`."""
+    vlm = get_vlm()
+    with span('vlm', kind='model'):
+        result = await aguarded_call('vlm', lambda: vlm.ainvoke([message]))
+        record(image_bytes=image_bytes)
+        record_usage(result)
+    return _chunk_text(result.content)
+
+def _streaming_enabled() -> bool:
+    return config.get('vlm_streaming', {}).get('enabled', True)
+
+def _chunk_text(content) -> str:
+    # 通义的多模态结果是[{'text': ...}]列表，OpenAI兼容接口是字符串
+    if isinstance(content, str):
+        return content
+    return ''.join(part if isinstance(part, str) else part.get('text', '') for part in content)
+
+def _field_validator(model_class):
+    """Returns a callback validating one top-level field of `model_class` of a streamed answer."""
+    def validate(key: str, value: Any, fields: Dict[str, Any]):
+        field = model_class.model_fields.get(key)
+        if field is not None:
+            TypeAdapter(field.annotation).validate_python(value)
+    return validate
+
+def _validate_fused_field(key: str, value: Any, fields: Dict[str, Any]):
+    """Validates the category and then the data of a streamed fused answer."""
+    if key == '类型' and value not in TYPE_MODELS:
+        raise ValueError(f"Unknown image type: {value}")
+    if key == '数据' and fields.get('类型') in TYPE_MODELS:
+        # 字符串、列表或null不能展开为关键字参数，按不合法的字段处理而不是抛出TypeError
+        if not isinstance(value, dict):
+            raise ValueError(f"'数据' must be a JSON object, got {type(value).__name__}")
+        TYPE_MODELS[fields['类型']](**value)
+
+class _StreamRead:
+    """Feeds streamed VLM chunks to a `JSONObjectStream` and validates the fields as they complete."""
+
+    def __init__(self, on_field=None):
+        self.parser = JSONObjectStream()
+        self.on_field = on_field
+        self.message = None
+        self.error: Optional[Exception] = None
+        self.first_field_ms: Optional[float] = None
+        self._start = time.perf_counter()
+        # 当前候选对象已完成的字段；候选对象被放弃时一起丢弃
+        self._fields: Dict[str, Any] = {}
+        self._candidate_start: Optional[int] = None
+
+    def feed(self, chunk) -> bool:
+        """Consumes one chunk; returns True once reading can stop (object closed or a field is invalid).
+
+        Each field is passed to `on_field` as soon as it completes, together
+        with the fields of the same candidate object so far. When the parser
+        gives up on a candidate (e.g. braces in the prose), its fields are
+        forgotten and the next candidate starts from scratch.
+        """
+        self.message = chunk if self.message is None else self.message + chunk
+        completed = self.parser.feed(_chunk_text(chunk.content))
+        if self.parser.candidate_start != self._candidate_start:
+            self._candidate_start, self._fields, self.first_field_ms = self.parser.candidate_start, {}, None
+        for key, value in completed:
+            if self.first_field_ms is None:
+                self.first_field_ms = (time.perf_counter() - self._start) * 1000
+            self._fields[key] = value
+            if self.on_field is not None:
+                try:
+                    self.on_field(key, value, self._fields)
+                except (ValueError, TypeError) as e:  # pydantic的ValidationError也是ValueError
+                    self.error = e
+                    return True
+        return self.parser.done
+
+    def finish(self, current_span) -> str:
+        current_span.set(streaming=True, first_field_ms=self.first_field_ms, closed=self.parser.done,
+                         invalid_field=str(self.error) if self.error else None)
+        if self.message is not None:
+            record_usage(self.message)
+        if self.error is not None:
+            print(f"--- Stopped reading the VLM answer early: {self.error} ---")
+        return self.parser.consumed_text()
+
+def _stream_vlm(message: HumanMessage, image_bytes: int, on_field=None) -> str:
+    """Streams the VLM answer to a JSON prompt and stops reading once the JSON object is complete.
+
+    Fields are passed to `on_field(key, value, fields so far)` as they
+    arrive; if it raises ValueError the stream is also stopped. A failed
+    stream is retried from the start by the provider guard. Time to the
+    first field of the object is recorded on the 'vlm' span. With
+    `vlm_streaming.enabled` false this is `_call_vlm`.
+
+    Returns:
+        The answer text up to the end of the JSON object.
+    """
+    if not _streaming_enabled():
+        return _call_vlm(message, image_bytes)
+    vlm = get_vlm()
+
+    def _read() -> _StreamRead:
+        read = _StreamRead(on_field)
+        stream = vlm.stream([message])
+        try:
+            for chunk in stream:
+                if read.feed(chunk):
+                    break
+        finally:
+            # 关闭生成器即断开连接，JSON之后的多余输出不再生成
+            stream.close()
+        return read
+
+    with span('vlm', kind='model') as current_span:
+        read = guarded_call('vlm', _read)
+        record(image_bytes=image_bytes)
+        return read.finish(current_span)
+
+async def _astream_vlm(message: HumanMessage, image_bytes: int, on_field=None) -> str:
+    """Async counterpart of `_stream_vlm`."""
+    if not _streaming_enabled():
+        return await _acall_vlm(message, image_bytes)
+    vlm = get_vlm()
+
+    async def _aread() -> _StreamRead:
+        read = _StreamRead(on_field)
+        stream = vlm.astream([message])
+        try:
+            async for chunk in stream:
+                if read.feed(chunk):
+                    break
+        finally:
+            await stream.aclose()
+        return read
+
+    with span('vlm', kind='model') as current_span:
+        read = await aguarded_call('vlm', _aread)
+        record(image_bytes=image_bytes)
+        return read.finish(current_span)
+
+def _invoke_vlm_json(prompt: str, image_path: str, on_field=None) -> str:
+    """Sends one prompt and one (preprocessed) image to the VLM with `_stream_vlm`."""
+    # 上传缩小、压缩后的图片，同一张图片只预处理一次
+    prepared = prepare_image(image_path)
+    return _stream_vlm(_vlm_message(prompt, prepared.path), prepared.prepared_bytes, on_field)
+
+async def _ainvoke_vlm_json(prompt: str, image_path: str, on_field=None) -> str:
+    """Async counterpart of `_invoke_vlm_json`; preprocessing runs in a worker thread."""
+    prepared = await asyncio.to_thread(prepare_image, image_path)
+    return await _astream_vlm(_vlm_message(prompt, prepared.path), prepared.prepared_bytes, on_field)
+
+# classify_images_batch的结果，按classify_image的缓存键保存，直到该图片的classify_image取走它。
+# 只保留最近一批：被跳过的图片（重复、已处理、合并调用）的标签到下一批开始时丢弃，VLM缓存里仍有这些标签
+_classified_ahead: Dict[str, str] = {}
+
+def _vlm_cache_key(image_path: str, prompt: str) -> str:
+    return get_vlm_cache().make_key(image_path, get_active_model_config('vlm')['model_name'], prompt)
+
+def _validated_extraction(raw_content: str, model_class, cache_key: str, from_cache: bool) -> Dict[str, Any]:
+    """Parses and validates an extraction answer, caching it only if it is valid."""
+    try:
+        # Attempt to parse the JSON from the raw string response
+        parsed_json = parse_json_from_response(raw_content)
+        # Validate with Pydantic model
+        validated_data = model_class(**parsed_json)
+        if not from_cache:
+            get_vlm_cache().put(cache_key, raw_content)
+        return validated_data.dict()
+    except Exception as e:
+        print(f"Failed to parse or validate JSON: {e}")
+        # Return a dictionary with an error message, or handle as needed
+        return {"error": "Failed to extract structured information", "details": str(e), "raw_output": raw_content}
+
+def _validated_fused(raw_content: str, cache_key: str, from_cache: bool) -> Optional[Dict[str, Any]]:
+    """Parses and validates a fused classify-and-extract answer; None if it is unusable."""
+    try:
+        parsed_json = parse_json_from_response(raw_content)
+        image_type = parsed_json['类型']
+        validated_data = TYPE_MODELS[image_type](**parsed_json['数据'])
+        if not from_cache:
+            get_vlm_cache().put(cache_key, raw_content)
+        return {"image_type": image_type, "data": validated_data.dict()}
+    except Exception as e:
+        # 合并调用的结果不合法时，退回到分类+提取两步调用
+        print(f"Fused classify-and-extract failed ({e}), falling back to two-step extraction.")
+        record(retries=1)
+        return None
+
 # --- Agent Tools ---
+# 每个工具都有同步实现和异步实现（挂在StructuredTool.coroutine上），
+# invoke走同步实现，ainvoke和异步图走异步实现
 
 @tool
+@traced(kind='tool')
 def classify_image(image_path: str) -> str:
     """Analyzes an image to classify its content into a predefined category.
 
     This tool uses a VLM to determine if the image content relates to an 'activity',
     'experience', or 'paper' based on descriptions in a configuration file.
+    When the local pre-classifier (`utils.preclassifier`) is confident enough,
+    its answer is returned without calling the VLM.
 
     Args:
         image_path: The local file path to the image to be classified.
@@ -125,33 +314,212 @@ def classify_image(image_path: str) -> str:
     Returns:
         A string representing the classified category (e.g., '活动', '经验', '论文').
     """
-    base_dir = r'd:\projects\image detector'
-    conf_path = os.path.join(base_dir, 'config', 'categories_config.yaml')
-    with open(conf_path, encoding='utf-8') as f:
-        categories = yaml.safe_load(f)['categories']
+    categories_prompt = get_prompts().classification_prompt
+    # 同一张图片、同一模型和同一prompt的结果直接从缓存读取
+    cache_key = _vlm_cache_key(image_path, categories_prompt)
+    image_type = _classified_ahead.pop(cache_key, None)
+    if image_type is not None:
+        return image_type
+    raw_content = get_vlm_cache().get(cache_key)
+    if raw_content is not None:
+        return parse_json_from_response(raw_content).get('类型', '未知')
+    # 本地预分类器足够确定时不调用VLM
+    image_type = preclassify(image_path)
+    if image_type is not None:
+        return image_type
+
+    raw_content = _invoke_vlm_json(categories_prompt, image_path)
+    print(raw_content)
+    parsed_result = parse_json_from_response(raw_content)
+    get_vlm_cache().put(cache_key, raw_content)
+    return parsed_result.get('类型', '未知')
+
+@traced('classify_image', kind='tool')
+async def _aclassify_image(image_path: str) -> str:
+    """Async implementation of `classify_image`."""
+    categories_prompt = get_prompts().classification_prompt
+    cache_key = await asyncio.to_thread(_vlm_cache_key, image_path, categories_prompt)
+    image_type = _classified_ahead.pop(cache_key, None)
+    if image_type is not None:
+        return image_type
+    raw_content = get_vlm_cache().get(cache_key)
+    if raw_content is not None:
+        return parse_json_from_response(raw_content).get('类型', '未知')
+    image_type = await asyncio.to_thread(preclassify, image_path)
+    if image_type is not None:
+        return image_type
+
+    raw_content = await _ainvoke_vlm_json(categories_prompt, image_path)
+    print(raw_content)
+    parsed_result = parse_json_from_response(raw_content)
+    get_vlm_cache().put(cache_key, raw_content)
+    return parsed_result.get('类型', '未知')
 
-    categories_prompt = """请判断图像内容最符合下面哪种description的需求，选择最符合的类型
+def get_classification_batch_config() -> Dict[str, Any]:
+    """Returns the `classification_batch` settings, with K limited by the active VLM's image count."""
+    batch_config = config.get('classification_batch', {})
+    vlm_config = get_active_model_config('vlm')
+    batch_size = batch_config.get('batch_size', 8)
+    return {
+        'enabled': batch_config.get('enabled', True),
+        'batch_size': max(1, min(batch_size, vlm_config.get('max_images_per_request', batch_size))),
+        'max_pixels': vlm_config.get('max_pixels_per_request'),
+        'max_side': batch_config.get('max_side', 768),
+    }
+
+def _pack(prepared: Dict[int, Any], batch_size: int, max_pixels: Optional[int]) -> List[List[int]]:
+    """Groups images into requests of at most `batch_size` images and `max_pixels` pixels."""
+    chunks, chunk, chunk_pixels = [], [], 0
+    for index, image in prepared.items():
+        pixels = image_pixels(image.path)
+        if chunk and (len(chunk) >= batch_size or (max_pixels and chunk_pixels + pixels > max_pixels)):
+            chunks.append(chunk)
+            chunk, chunk_pixels = [], 0
+        chunk.append(index)
+        chunk_pixels += pixels
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def _batch_labels(raw_content: str, count: int) -> Dict[int, str]:
+    """Returns the usable labels of a batched answer by position in the request.
+
+    Items that are not objects, have no valid image number or an unknown
+    category are left out, as is everything if the answer is not JSON.
     """
-    for cat in categories:
-        categories_prompt += f"\n- {cat['name']}: {', '.join(cat['description'])}"
-    
-    categories_prompt += """\n严格按照下面json格式输出
-    {"分析":"分析属于哪个类型的过程","类型":"类型名称"}
+    try:
+        items = parse_json_from_response(raw_content).get('结果')
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(items, list):
+        return {}
+    labels: Dict[int, str] = {}
+    for position, item in enumerate(items):
+        if not isinstance(item, dict):
+            continue
+        try:
+            index = int(item.get('图片', position + 1)) - 1
+        except (TypeError, ValueError):
+            continue
+        label = item.get('类型')
+        if 0 <= index < count and index not in labels and label in get_prompts().categories:
+            labels[index] = label
+    return labels
+
+def _known_label(image_path: str, cache_key: str) -> Optional[str]:
+    """Returns the label from the classify cache or the pre-classifier, without calling the VLM."""
+    raw_content = get_vlm_cache().get(cache_key)
+    if raw_content is not None:
+        return parse_json_from_response(raw_content).get('类型', '未知')
+    return preclassify(image_path)
+
+def _store_labels(chunk: List[int], raw_content: str, keys: List[str], labels: List[Optional[str]]):
+    """Fills `labels` from a batched answer and hands each label to the image's later `classify_image` call."""
+    for position, label in _batch_labels(raw_content, len(chunk)).items():
+        index = chunk[position]
+        labels[index] = label
+        _classified_ahead[keys[index]] = label
+        # 和classify_image的缓存格式相同，以后的运行也能命中
+        get_vlm_cache().put(keys[index], json.dumps({"类型": label}, ensure_ascii=False))
+
+@traced('classify_images_batch', kind='tool')
+def classify_images_batch(image_paths: List[str], batch_size: Optional[int] = None) -> List[Optional[str]]:
+    """Classifies many images with about one VLM request per `batch_size` images.
+
+    Images whose classification is cached or decided by the pre-classifier
+    are not sent. The others are downscaled to `classification_batch.max_side`
+    and packed into requests of at most K images (`classification_batch.batch_size`,
+    limited by the VLM's `max_images_per_request` and `max_pixels_per_request`);
+    each request carries the category descriptions once and asks for one
+    label per image number. Every label is cached under the key `classify_image`
+    uses, so classifying the same image later costs no VLM call. Images the
+    batched answer does not label validly are classified one by one with
+    `classify_image`. The labels are also handed to the next `classify_image`
+    call of each image directly, so this works with the cache disabled;
+    labels of the previous batch that were never picked up are dropped.
+
+    Args:
+        image_paths: The images to classify.
+        batch_size: Overrides K.
+
+    Returns:
+        The category of each image in input order, or None where even the
+        single-image classification failed.
     """
-    
-    message = HumanMessage(content=[
-        {"text": categories_prompt},
-        {"image": image_path}
-    ])
-    
-    vlm = get_vlm()
-    result = vlm.invoke([message])
-    print(result)
-    print(type(result.content[0]))
-    parsed_result = parse_json_from_response(result.content[0]['text'])
-    return parsed_result.get('类型', '未知')
+    batch_config = get_classification_batch_config()
+    batch_size = batch_size or batch_config['batch_size']
+    prompts = get_prompts()
+    _classified_ahead.clear()
+    keys = [_vlm_cache_key(path, prompts.classification_prompt) for path in image_paths]
+    labels = [_known_label(path, key) for path, key in zip(image_paths, keys)]
+    pending = [i for i, label in enumerate(labels) if label is None]
+    prepared = {i: prepare_image(image_paths[i], max_side=batch_config['max_side']) for i in pending}
+
+    def _classify_chunk(chunk: List[int]):
+        prompt = prompts.batch_classification_prompt.replace('{count}', str(len(chunk)))
+        message = _vlm_batch_message(prompt, [prepared[i].path for i in chunk])
+        try:
+            raw_content = _stream_vlm(message, sum(prepared[i].prepared_bytes for i in chunk))
+        except Exception as e:
+            print(f"--- Batched classification of {len(chunk)} images failed: {e} ---")
+            return
+        _store_labels(chunk, raw_content, keys, labels)
+
+    chunks = _pack(prepared, batch_size, batch_config['max_pixels'])
+    with ThreadPoolExecutor(max_workers=get_batch_config()['provider_limits'].get('vlm', 1)) as pool:
+        # 每个请求在自己的线程里运行，沿用当前的tracing上下文
+        for future in [pool.submit(contextvars.copy_context().run, _classify_chunk, c) for c in chunks]:
+            future.result()
+    if chunks:
+        print(f"--- Classified {len(pending)} images with {len(chunks)} batched VLM requests ---")
+
+    for i in [i for i in pending if labels[i] is None]:
+        record(retries=1)
+        try:
+            labels[i] = classify_image.invoke({"image_path": image_paths[i]})
+        except Exception as e:
+            print(f"--- Could not classify {image_paths[i]}: {e} ---")
+    return labels
+
+@traced('classify_images_batch', kind='tool')
+async def aclassify_images_batch(image_paths: List[str], batch_size: Optional[int] = None) -> List[Optional[str]]:
+    """Async counterpart of `classify_images_batch`; the requests run concurrently on the event loop."""
+    batch_config = get_classification_batch_config()
+    batch_size = batch_size or batch_config['batch_size']
+    prompts = get_prompts()
+    _classified_ahead.clear()
+    keys = await asyncio.to_thread(lambda: [_vlm_cache_key(p, prompts.classification_prompt) for p in image_paths])
+    labels = await asyncio.to_thread(lambda: [_known_label(p, k) for p, k in zip(image_paths, keys)])
+    pending = [i for i, label in enumerate(labels) if label is None]
+    prepared = await asyncio.to_thread(
+        lambda: {i: prepare_image(image_paths[i], max_side=batch_config['max_side']) for i in pending})
+
+    async def _classify_chunk(chunk: List[int]):
+        prompt = prompts.batch_classification_prompt.replace('{count}', str(len(chunk)))
+        message = _vlm_batch_message(prompt, [prepared[i].path for i in chunk])
+        try:
+            raw_content = await _astream_vlm(message, sum(prepared[i].prepared_bytes for i in chunk))
+        except Exception as e:
+            print(f"--- Batched classification of {len(chunk)} images failed: {e} ---")
+            return
+        _store_labels(chunk, raw_content, keys, labels)
+
+    chunks = await asyncio.to_thread(_pack, prepared, batch_size, batch_config['max_pixels'])
+    await asyncio.gather(*(_classify_chunk(chunk) for chunk in chunks))
+    if chunks:
+        print(f"--- Classified {len(pending)} images with {len(chunks)} batched VLM requests ---")
+
+    async def _fallback(i: int):
+        record(retries=1)
+        try:
+            labels[i] = await classify_image.ainvoke({"image_path": image_paths[i]})
+        except Exception as e:
+            print(f"--- Could not classify {image_paths[i]}: {e} ---")
+    await asyncio.gather(*(_fallback(i) for i in pending if labels[i] is None))
+    return labels
 
 @tool
+@traced(kind='tool')
 def extract_info_from_image(image_path: str, image_type: str) -> Dict[str, Any]:
     """Extracts structured information from an image based on its classified type.
 
@@ -171,170 +539,194 @@ def extract_info_from_image(image_path: str, image_type: str) -> Dict[str, Any]:
     Raises:
         ValueError: If the `image_type` is not supported.
     """
-    type_map: Dict[str, Type[BaseModel]] = {
-        '活动': Activity,
-        '经验': Experience,
-        '论文': Paper # Assuming Paper and AcademicResearch can use the same prompt for now
-    }
+    # prompt和schema由config_registry预先编译好，配置文件修改后自动重新加载
+    category = get_category_prompt(image_type)
+
+    # 缓存键包含prompt和schema，修改配置或模型字段后会自动失效
+    cache_key = _vlm_cache_key(image_path, category.fingerprint)
+    raw_content = get_vlm_cache().get(cache_key)
+    from_cache = raw_content is not None
+    if not from_cache:
+        #with_structured_output(model_class)这个函数挺不错的功能，限制输出的数据格式,自动修改prompt,会很消耗token吗
+        raw_content = _invoke_vlm_json(category.prompt, image_path, _field_validator(category.model_class))
+    return _validated_extraction(raw_content, category.model_class, cache_key, from_cache)
+
+@traced('extract_info_from_image', kind='tool')
+async def _aextract_info_from_image(image_path: str, image_type: str) -> Dict[str, Any]:
+    """Async implementation of `extract_info_from_image`."""
+    category = get_category_prompt(image_type)
+    cache_key = await asyncio.to_thread(_vlm_cache_key, image_path, category.fingerprint)
+    raw_content = get_vlm_cache().get(cache_key)
+    from_cache = raw_content is not None
+    if not from_cache:
+        raw_content = await _ainvoke_vlm_json(category.prompt, image_path, _field_validator(category.model_class))
+    return _validated_extraction(raw_content, category.model_class, cache_key, from_cache)
 
-    if image_type not in type_map:
-        raise ValueError(f"Unsupported image type: {image_type}")
-
-    model_class = type_map[image_type]
-    #这个函数挺不错的功能，限制输出的数据格式,自动修改prompt,会很消耗token吗
-    vlm = get_vlm()#.with_structured_output(model_class)
-    print(vlm)
-
-    # Load prompts from the new prompt_config.yaml
-    base_dir = r'd:\projects\image detector'
-    conf_path = os.path.join(base_dir, 'config', 'prompt_config.yaml')
-    with open(conf_path, encoding='utf-8') as f:
-        prompt_config = yaml.safe_load(f)
-    
-    base_prompt = prompt_config.get('base_prompt', '')
-    instruction = ""
-    for p in prompt_config.get('prompts', []):
-        if p['name'] == image_type:
-            instruction = p['instruction']
-            break
-
- #   prompt = f"你是一个从图片中提取结构化信息的专家。请仔细分析提供的图片，并从中提取出关键信息。严格按照要求的 JSON 格式输出，不要包含任何 markdown 标记、额外的解释、注释或任何非 JSON 文本."
-    print(base_prompt+instruction)
-    message = HumanMessage(content=[
-        {"type": "text", "text": base_prompt+instruction},  # Explicitly specify type
-        {"type": "image", "image": image_path}  # Proper format for image
-    ])
 
-    result = vlm.invoke([message])
-    raw_content = result.content[0]['text']
-    try:
-        # Attempt to parse the JSON from the raw string response
-        parsed_json = parse_json_from_response(raw_content)
-        # Validate with Pydantic model
-        validated_data = model_class(**parsed_json)
-        return validated_data.dict()
-    except Exception as e:
-        print(f"Failed to parse or validate JSON: {e}")
-        # Return a dictionary with an error message, or handle as needed
-        return {"error": "Failed to extract structured information", "details": str(e), "raw_output": raw_content}
+@tool
+@traced(kind='tool')
+def classify_and_extract(image_path: str) -> Dict[str, Any]:
+    """Classifies an image and extracts its structured information in a single VLM call.
+
+    The prompt lists every category from `categories_config.yaml` together with
+    the JSON fields of its Pydantic model, so the VLM returns the category and the
+    matching fields in one response. If the answer cannot be validated against the
+    model of the returned category, the tool falls back to calling
+    `classify_image` and `extract_info_from_image` separately.
 
-    #print(result)
-    return result.dict()
+    Args:
+        image_path: The local file path to the image.
 
+    Returns:
+        A dictionary with the category under 'image_type' and the validated
+        information under 'data'.
+    """
+    fused_prompt = get_prompts().fused_prompt
+
+    cache_key = _vlm_cache_key(image_path, fused_prompt)
+    raw_content = get_vlm_cache().get(cache_key)
+    from_cache = raw_content is not None
+    if not from_cache:
+        raw_content = _invoke_vlm_json(fused_prompt, image_path, _validate_fused_field)
+    result = _validated_fused(raw_content, cache_key, from_cache)
+    if result is not None:
+        return result
+
+    image_type = classify_image.invoke({"image_path": image_path})
+    if image_type not in TYPE_MODELS:
+        return {"image_type": image_type, "data": {"error": f"Unsupported image type: {image_type}"}}
+    data = extract_info_from_image.invoke({"image_path": image_path, "image_type": image_type})
+    return {"image_type": image_type, "data": data}
+
+@traced('classify_and_extract', kind='tool')
+async def _aclassify_and_extract(image_path: str) -> Dict[str, Any]:
+    """Async implementation of `classify_and_extract`."""
+    fused_prompt = get_prompts().fused_prompt
+
+    cache_key = await asyncio.to_thread(_vlm_cache_key, image_path, fused_prompt)
+    raw_content = get_vlm_cache().get(cache_key)
+    from_cache = raw_content is not None
+    if not from_cache:
+        raw_content = await _ainvoke_vlm_json(fused_prompt, image_path, _validate_fused_field)
+    result = _validated_fused(raw_content, cache_key, from_cache)
+    if result is not None:
+        return result
+
+    image_type = await classify_image.ainvoke({"image_path": image_path})
+    if image_type not in TYPE_MODELS:
+        return {"image_type": image_type, "data": {"error": f"Unsupported image type: {image_type}"}}
+    data = await extract_info_from_image.ainvoke({"image_path": image_path, "image_type": image_type})
+    return {"image_type": image_type, "data": data}
 
 
 @tool
+@traced(kind='tool')
 def google_search(query: str) -> str:
     """Performs a Google search and returns the results.
 
     This tool is a wrapper around the Google Search API and is useful for
-    finding information on current events or supplementing knowledge.
+    finding information on current events or supplementing knowledge. Searches
+    go through the shared service in `utils.search`, so a repeated query is
+    answered from its cache and concurrent identical queries share one request.
 
     Args:
         query: The search query string.
 
     Returns:
-        A string containing the search results.
+        The search results, one 'Title/Snippet/Link' block per result.
     """
-   
-#
-    search_wrapper = GoogleSearchAPIWrapper()
-    search = GoogleSearchRun(api_wrapper=search_wrapper)
-    search_query = f"{query} site:arxiv.org OR site:springer.com"
-    return search.run(search_query)
+    return get_search_service().search(query)
+
+@traced('google_search', kind='tool')
+async def _agoogle_search(query: str) -> str:
+    """Async implementation of `google_search`."""
+    return await get_search_service().asearch(query)
+
+def _table_for(image_type: str) -> str:
+    return config['database_tables'].get(image_type, config['database_tables']['default'])
 
 @tool
+@traced(kind='tool')
 def save_data_to_db(data: Dict[str, Any], image_type: str) -> str:
     """Saves extracted data to a SQLite database.
 
-    This tool connects to a SQLite database using the path from environment
-    variables. It dynamically determines the table name based on the `image_type`
-    and creates the table if it doesn't exist before inserting the data.
+    The record is handed to the process-wide `DBWriter` for the database at
+    the DB_PATH environment variable, which batches concurrent inserts into one
+    transaction. The table name is determined by the `image_type`; the table is
+    created (or extended with new columns) the first time it is needed, and
+    its full-text index (see `utils.fulltext`) right after.
 
     Args:
         data: A dictionary containing the data to be saved.
         image_type: The category of the data, used to determine the table name.
 
     Returns:
-        A string indicating the success or failure of the operation.
+        A string indicating the success or failure of the operation, including
+        the id of the new row on success.
     """
-    table_name = config['database_tables'].get(image_type, config['database_tables']['default'])
-    db_path = os.getenv("DB_PATH", "database.db")
-    conn = None  # Initialize conn to None
+    table_name = _table_for(image_type)
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-
-        columns_defs = []
-        for key, value in data.items():
-            if isinstance(value, bool): col_type = "INTEGER"  # SQLite uses INTEGER for booleans
-            elif isinstance(value, int): col_type = "INTEGER"
-            elif isinstance(value, float): col_type = "REAL"
-            elif isinstance(value, str):
-                try:
-                    datetime.strptime(value, '%Y-%m-%d')
-                    col_type = "DATE"
-                except ValueError:
-                    col_type = "TEXT"
-            else:
-                col_type = "TEXT" # Default for lists, etc.
-            columns_defs.append(f'"{key}" {col_type}')
-        
-        create_sql = f"""
-            CREATE TABLE IF NOT EXISTS "{table_name}" (
-                "id" INTEGER PRIMARY KEY AUTOINCREMENT,
-                {', '.join(columns_defs)}
-            )
-        """
-        cursor.execute(create_sql)
-        
-        columns = '", "'.join(data.keys())
-        values_placeholder = ', '.join(['?'] * len(data))
-        insert_sql = f'INSERT INTO "{table_name}" ("{columns}") VALUES ({values_placeholder})'
-        
-        # Convert lists to JSON strings for storage
-        values = [json.dumps(v) if isinstance(v, list) else v for v in data.values()]
-
-        cursor.execute(insert_sql, tuple(values))
-        conn.commit()
-        return f"Data successfully saved to table '{table_name}'."
+        # 活动日期额外存一列ISO格式，便于按日期范围走索引查询
+        with span('sqlite_write', kind='io'):
+            row_id = get_db_writer().write(table_name, normalize_record(image_type, data))
+        if image_type == ACTIVITY_TYPE:
+            ensure_activity_schema()
+        # 第一次写入某个表后建立全文索引，之后由触发器同步
+        ensure_search_index(table_name)
+        return f"Data successfully saved to table '{table_name}' (id={row_id})."
     except Exception as e:
-        if conn:
-            conn.rollback()
         return f"Database operation failed: {e}"
-    finally:
-        if conn:
-            conn.close()
 
+@traced('save_data_to_db', kind='tool')
+async def _asave_data_to_db(data: Dict[str, Any], image_type: str) -> str:
+    """Async implementation of `save_data_to_db`; awaits the writer's future instead of blocking a thread."""
+    table_name = _table_for(image_type)
+    try:
+        with span('sqlite_write', kind='io'):
+            row_id = await asyncio.wrap_future(get_db_writer().submit(table_name, normalize_record(image_type, data)))
+        if image_type == ACTIVITY_TYPE:
+            await asyncio.to_thread(ensure_activity_schema)
+        await asyncio.to_thread(ensure_search_index, table_name)
+        return f"Data successfully saved to table '{table_name}' (id={row_id})."
+    except Exception as e:
+        return f"Database operation failed: {e}"
 
-def check_upcoming_events(query: str = "") -> str:
-    """
-    Checks the 'activity' table in the database for events scheduled within the next 10 days and returns a reminder.
+classify_image.coroutine = _aclassify_image
+extract_info_from_image.coroutine = _aextract_info_from_image
+classify_and_extract.coroutine = _aclassify_and_extract
+google_search.coroutine = _agoogle_search
+save_data_to_db.coroutine = _asave_data_to_db
+
+
+def check_upcoming_events(days: int = 10, location: str = "", page: int = 1, page_size: int = 20) -> str:
+    """Checks the activity table for events scheduled within the next `days` days and returns a reminder.
+
+    Args:
+        days: How many days ahead to look.
+        location: Optional text the activity location must contain.
+        page: The 1-based page of results to return.
+        page_size: The number of events per page.
+
+    Returns:
+        A reminder listing the events of the requested page, or a message
+        explaining why no events could be listed.
     """
-    db_path = os.getenv("DB_PATH", "database.db")
-    conn = None # Initialize conn to None
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-
-        # Query for events between today and 10 days from now
-        query = """
-            SELECT activity_name, activity_date 
-            FROM activity_log 
-            WHERE date(activity_date) 
-            BETWEEN date('now') AND date('now', '+10 days')
-        """
-        cursor.execute(query)
-        events = cursor.fetchall()
-
+        page = max(int(page), 1)
+        events, total = query_upcoming_events(days=int(days), location=location or None,
+                                              limit=page_size, offset=(page - 1) * page_size)
         if not events:
-            return "未来10天内没有即将开始的活动。"
+            if total:
+                return f"第{page}页没有活动，共{total}条。"
+            return f"未来{days}天内没有即将开始的活动。"
 
         reminders = []
         for event in events:
-            reminders.append(f"- {event[0]} (日期: {event[1]})")
-        
-        return "提醒：以下活动即将在10天内开始：\n" + "\n".join(reminders)
+            location_text = f", 地点: {event['activity_location']}" if event.get('activity_location') else ""
+            reminders.append(f"- {event['activity_name']} (日期: {event['activity_date_iso']}{location_text})")
+
+        pages = (total + page_size - 1) // page_size
+        return f"提醒：以下活动即将在{days}天内开始（第{page}/{pages}页，共{total}条）：\n" + "\n".join(reminders)
 
     except sqlite3.OperationalError as err:
         # Handle cases where the table might not exist yet
@@ -343,6 +735,42 @@ def check_upcoming_events(query: str = "") -> str:
         return f"数据库查询失败: {err}"
     except Exception as e:
         return f"检查活动时发生未知错误: {e}"
-    finally:
-        if conn:
-            conn.close()
\ No newline at end of file
+
+
+def search_records(query: str, image_type: str = "", page: int = 1, page_size: int = 20) -> str:
+    """Searches the archived records by keywords and returns the ranked matches of one page.
+
+    Args:
+        query: Whitespace-separated keywords; every keyword must occur in a record.
+        image_type: Optional category ('活动', '经验', '论文') to restrict the search to.
+        page: The 1-based page of results to return.
+        page_size: The number of records per page.
+
+    Returns:
+        The matches of the requested page, best first, or a message explaining
+        why nothing could be listed.
+    """
+    try:
+        page = max(int(page), 1)
+        tables = [_table_for(image_type)] if image_type else None
+        records, total = search_index(query, tables=tables, limit=page_size, offset=(page - 1) * page_size)
+        if not records:
+            if total:
+                return f"第{page}页没有记录，共{total}条。"
+            return f"没有找到与“{query}”相关的记录。"
+
+        lines = []
+        for record in records:
+            fields = [v for k, v in record.items()
+                      if k in TYPE_MODELS[record['category']].model_fields and isinstance(v, str) and v]
+            title = fields[0] if fields else f"#{record['id']}"
+            snippet = record['snippet'] or max(fields[1:], key=len, default='')
+            lines.append(f"- [{record['category']}] {title} (id={record['id']})\n  {snippet}")
+
+        pages = (total + page_size - 1) // page_size
+        return f"与“{query}”相关的记录（第{page}/{pages}页，共{total}条）：\n" + "\n".join(lines)
+
+    except sqlite3.OperationalError as err:
+        return f"数据库查询失败: {err}"
+    except Exception as e:
+        return f"搜索记录时发生未知错误: {e}"
@@ -0,0 +1,303 @@
+"""Span-based tracing of graph nodes, tools and model calls.
+
+A span measures the wall time of one node or tool call and collects counters
+recorded while it is open: prompt/completion tokens, uploaded image bytes,
+cache hits and retries. Spans opened inside another span (e.g. a tool inside
+the `vlm_expert` node) are linked to their parent, and all spans of one
+`run_agent` call share a run id. When the run ends its spans are appended to a
+JSONL trace file and a summary table is printed.
+
+Tracing is off unless `tracing.enabled` is set in config.yaml or the
+environment variable TRACE=1 is set. When it is off, `span` returns a shared
+no-op object and `record` returns immediately.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import inspect
+import functools
+import threading
+import contextvars
+from typing import Any, Dict, Iterable, List, Optional
+
+from .config_loader import PROJECT_ROOT, config
+
+COUNTERS = ('prompt_tokens', 'completion_tokens', 'image_bytes', 'cache_hits', 'retries')
+
+_current: contextvars.ContextVar = contextvars.ContextVar('trace_span', default=None)
+_write_lock = threading.Lock()
+
+
+def _configured_path() -> str:
+    path = config.get('tracing', {}).get('path', os.path.join('database', 'traces.jsonl'))
+    return path if os.path.isabs(path) else os.path.join(PROJECT_ROOT, path)
+
+
+_enabled = (config.get('tracing', {}).get('enabled', False)
+            or os.getenv('TRACE', '').lower() in ('1', 'true', 'yes'))
+_trace_path = _configured_path()
+_print_summary = config.get('tracing', {}).get('print_summary', True)
+
+
+def enable(path: Optional[str] = None, print_summary: Optional[bool] = None):
+    """Turns tracing on at runtime, optionally writing to another trace file."""
+    global _enabled, _trace_path, _print_summary
+    _enabled = True
+    if path is not None:
+        _trace_path = path
+    if print_summary is not None:
+        _print_summary = print_summary
+
+
+def disable():
+    """Turns tracing off."""
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    """Returns whether spans are being recorded."""
+    return _enabled
+
+
+class _NullSpan:
+    """Stand-in returned by `span` while tracing is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def add(self, **counters):
+        pass
+
+    def set(self, **attrs):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """One timed operation.
+
+    Args:
+        name: The node or tool name, e.g. 'llm_agent' or 'tool:classify_image'.
+        kind: 'run', 'node', 'tool', 'model' (a provider call) or 'io' (a database write).
+        attrs: Extra attributes written to the trace.
+    """
+
+    def __init__(self, name: str, kind: str = 'node', attrs: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.kind = kind
+        self.attrs = attrs or {}
+        self.counters: Dict[str, float] = {}
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id: Optional[str] = None
+        self.run: Optional['Run'] = None
+        self.error: Optional[str] = None
+        self.started_at = 0.0
+        self.duration = 0.0
+        self._start = 0.0
+        self._token = None
+
+    def __enter__(self):
+        parent = _current.get()
+        if parent is not None:
+            self.parent_id = parent.span_id
+            self.run = parent.run
+        self._token = _current.set(self)
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self._start
+        _current.reset(self._token)
+        if exc is not None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        if self.run is None:
+            _write([self.to_dict()])
+        elif self.run is not self:
+            self.run.records.append(self.to_dict())
+        return False
+
+    def add(self, **counters):
+        """Adds to the span's counters, e.g. `add(cache_hits=1)`."""
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, **attrs):
+        """Sets attributes written with the span."""
+        self.attrs.update(attrs)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'run_id': self.run.span_id if self.run else None,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'kind': self.kind,
+            'start': self.started_at,
+            'duration_ms': round(self.duration * 1000, 3),
+            'counters': self.counters,
+            'attrs': self.attrs,
+            'error': self.error,
+        }
+
+
+class Run(Span):
+    """The root span of one image run; writes the trace and summary when it ends.
+
+    Opened inside another span it behaves like a normal child span.
+    """
+
+    def __init__(self, name: str, attrs: Optional[Dict[str, Any]] = None):
+        super().__init__(name, 'run', attrs)
+        self.records: List[Dict[str, Any]] = []
+
+    def __enter__(self):
+        super().__enter__()
+        if self.run is None:
+            self.run = self
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        super().__exit__(exc_type, exc, tb)
+        if self.run is self:
+            records = self.records + [self.to_dict()]
+            _write(records)
+            if _print_summary:
+                print(format_summary(summarize(records), title=f"Trace summary: {self.name}"))
+        return False
+
+
+def span(name: str, kind: str = 'node', **attrs):
+    """Opens a span, to be used as a context manager.
+
+    Returns a shared no-op object when tracing is disabled.
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return Span(name, kind, attrs)
+
+
+def trace_run(name: str, **attrs):
+    """Opens the root span of a run, to be used as a context manager."""
+    if not _enabled:
+        return _NULL_SPAN
+    return Run(name, attrs)
+
+
+def traced(name: Optional[str] = None, kind: str = 'node'):
+    """Decorator wrapping every call of a function (or coroutine function) in a span."""
+    def decorator(func):
+        span_name = name or func.__name__
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not _enabled:
+                    return await func(*args, **kwargs)
+                with Span(span_name, kind):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with Span(span_name, kind):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record(**counters):
+    """Adds counters to the innermost open span, if any."""
+    if not _enabled:
+        return
+    current = _current.get()
+    if current is not None:
+        current.add(**counters)
+
+
+def record_usage(message: Any):
+    """Records the prompt/completion token usage reported with a model response."""
+    if not _enabled:
+        return
+    usage = getattr(message, 'usage_metadata', None)
+    if usage:
+        record(prompt_tokens=usage.get('input_tokens', 0), completion_tokens=usage.get('output_tokens', 0))
+        return
+    # 部分模型（如通义）只在response_metadata里返回token用量
+    metadata = getattr(message, 'response_metadata', None) or {}
+    usage = metadata.get('token_usage') or metadata.get('usage') or {}
+    prompt = usage.get('input_tokens', usage.get('prompt_tokens', 0)) or 0
+    completion = usage.get('output_tokens', usage.get('completion_tokens', 0)) or 0
+    if prompt or completion:
+        record(prompt_tokens=prompt, completion_tokens=completion)
+
+
+def _write(records: List[Dict[str, Any]]):
+    lines = ''.join(json.dumps(r, ensure_ascii=False, default=str) + '\n' for r in records)
+    with _write_lock:
+        os.makedirs(os.path.dirname(os.path.abspath(_trace_path)), exist_ok=True)
+        with open(_trace_path, 'a', encoding='utf-8') as f:
+            f.write(lines)
+
+
+def summarize(records: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Aggregates span records by name: call count, wall time and counters."""
+    rows: Dict[str, Dict[str, Any]] = {}
+    for r in records:
+        row = rows.setdefault(r['name'], {'name': r['name'], 'kind': r['kind'], 'calls': 0, 'errors': 0,
+                                          'total_ms': 0.0, **{c: 0 for c in COUNTERS}})
+        row['calls'] += 1
+        row['errors'] += 1 if r.get('error') else 0
+        row['total_ms'] += r['duration_ms']
+        for c in COUNTERS:
+            row[c] += r.get('counters', {}).get(c, 0)
+    return sorted(rows.values(), key=lambda row: (row['kind'] != 'run', -row['total_ms']))
+
+
+def format_summary(rows: List[Dict[str, Any]], title: str = "Trace summary") -> str:
+    """Formats `summarize` output as a plain-text table."""
+    header = ['span', 'calls', 'errors', 'total ms', 'avg ms', 'prompt tok', 'compl tok', 'image bytes',
+              'cache hits', 'retries']
+    table = [header]
+    for row in rows:
+        table.append([row['name'], row['calls'], row['errors'], f"{row['total_ms']:.1f}",
+                      f"{row['total_ms'] / row['calls']:.1f}", row['prompt_tokens'], row['completion_tokens'],
+                      row['image_bytes'], row['cache_hits'], row['retries']])
+    widths = [max(len(str(line[i])) for line in table) for i in range(len(header))]
+    lines = [f"--- {title} ---"]
+    for line in table:
+        lines.append('  '.join(str(v).ljust(w) if i == 0 else str(v).rjust(w)
+                               for i, (v, w) in enumerate(zip(line, widths))))
+    return '\n'.join(lines)
+
+
+def load_trace(path: Optional[str] = None) -> Dict[str, List[Dict[str, Any]]]:
+    """Reads a JSONL trace file and groups its records by run id."""
+    runs: Dict[str, List[Dict[str, Any]]] = {}
+    with open(path or _trace_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                r = json.loads(line)
+                runs.setdefault(r['run_id'] or r['span_id'], []).append(r)
+    return runs
+
+
+if __name__ == '__main__':
+    # python -m utils.tracing [trace.jsonl]：打印每个run的汇总表以及所有run的总表
+    runs = load_trace(sys.argv[1] if len(sys.argv) > 1 else None)
+    for run_id, records in runs.items():
+        root = next((r for r in records if r['kind'] == 'run'), records[0])
+        print(format_summary(summarize(records), title=f"{root['name']} ({run_id})"))
+        print()
+    print(format_summary(summarize(r for records in runs.values() for r in records),
+                         title=f"All runs ({len(runs)})"))
@@ -0,0 +1,147 @@
+"""Rule-based checks of tool outputs, used before falling back to LLM reflection.
+
+`validate_tool_output` settles the common cases locally from the Pydantic
+models in `utils.models`: required fields, placeholder values, activity date
+formats and database write status. Only outputs the rules cannot judge are
+left to the LLM reflection in `agent.reflection_node`.
+"""
+import json
+import threading
+import typing
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+from .dates import parse_date
+from .models import TYPE_MODELS
+
+# VLM在信息缺失时常用的占位内容
+PLACEHOLDERS = {'', '无明确内容', '无明确描述', '无', '未知', '暂无', 'none', 'null', 'n/a', 'unknown'}
+
+OK = 'ok'
+SEARCH = 'search'
+RETRY = 'retry'
+UNDECIDED = 'undecided'
+
+_counts: typing.Counter[str] = Counter()
+_counts_lock = threading.Lock()
+
+
+@dataclass
+class Verdict:
+    """The outcome of validating one tool output.
+
+    Attributes:
+        decision: 'ok' (continue), 'search' (look up the missing abstract),
+            'retry' (the output is wrong, the message says why) or 'undecided'
+            (ask the LLM reflection).
+        message: Guidance for the orchestrator LLM when the decision is not 'ok'.
+    """
+    decision: str
+    message: str = ""
+
+
+def is_placeholder(value: Any) -> bool:
+    """Returns True if `value` is empty or a placeholder such as '无明确内容'."""
+    return value is None or (isinstance(value, str) and value.strip().lower() in PLACEHOLDERS)
+
+
+def record_decision(path: str):
+    """Counts one decision path, e.g. 'rule:ok' or 'llm:continue'."""
+    with _counts_lock:
+        _counts[path] += 1
+
+
+def decision_counts() -> Dict[str, int]:
+    """Returns how often each decision path was taken in this process."""
+    with _counts_lock:
+        return dict(_counts)
+
+
+def reset_decision_counts():
+    """Clears the decision counters, e.g. between benchmark scenarios."""
+    with _counts_lock:
+        _counts.clear()
+
+
+def format_decision_counts() -> str:
+    """Formats `decision_counts` as one line, rule decisions first."""
+    counts = decision_counts()
+    paths = sorted(counts, key=lambda path: (not path.startswith('rule:'), path))
+    return ', '.join(f"{path} {counts[path]}" for path in paths)
+
+
+def _is_optional(annotation: Any) -> bool:
+    return type(None) in typing.get_args(annotation)
+
+
+def validate_extraction(data: Dict[str, Any], image_type: str) -> Verdict:
+    """Checks extracted data against the Pydantic model of its category."""
+    if 'error' in data:
+        return Verdict(RETRY, f"Reflection on last action: the extraction failed: {data.get('details', data['error'])}. "
+                              f"Please call extract_info_from_image again for this image.")
+    model_class = TYPE_MODELS.get(image_type)
+    if model_class is None:
+        return Verdict(UNDECIDED)
+
+    missing = [name for name, field in model_class.model_fields.items()
+               if not _is_optional(field.annotation) and is_placeholder(data.get(name))]
+    if image_type == '论文' and missing == ['abstract'] and not is_placeholder(data.get('paper_title')):
+        return Verdict(SEARCH, f"The information extraction for the paper '{data['paper_title']}' was successful, "
+                               f"but the abstract is missing. Please use the google_search tool to find a summary for this paper.")
+    if missing:
+        return Verdict(RETRY, f"Reflection on last action: the extracted data is missing the required fields {missing}. "
+                              f"Please extract the information from the image again.")
+    if image_type == '活动' and parse_date(data['activity_date']) is None:
+        return Verdict(UNDECIDED)
+    if image_type == '经验' and is_placeholder(data.get('experience_content')) and is_placeholder(data.get('reason')):
+        return Verdict(RETRY, "Reflection on last action: neither an experience nor a reason was extracted. "
+                              "Please extract the information from the image again.")
+    return Verdict(OK)
+
+
+def validate_tool_output(tool_name: str, content: str, args: Optional[Dict[str, Any]] = None) -> Verdict:
+    """Validates the output of a tool call without calling any model.
+
+    Args:
+        tool_name: The name of the tool that produced the output.
+        content: The tool message content.
+        args: The arguments the tool was called with.
+
+    Returns:
+        The `Verdict` for the output.
+    """
+    args = args or {}
+    if content.startswith('Error:'):
+        # ToolNode把工具抛出的异常转成 "Error: ..." 文本
+        return Verdict(RETRY, f"Reflection on last action: the tool `{tool_name}` raised {content}. "
+                              f"Please check the arguments and try again.")
+
+    if tool_name == 'classify_image':
+        if content in TYPE_MODELS:
+            return Verdict(OK)
+        return Verdict(RETRY, f"Reflection on last action: '{content}' is not a known category. "
+                              f"The image must be classified as one of {list(TYPE_MODELS)}.")
+
+    if tool_name in ('extract_info_from_image', 'classify_and_extract'):
+        try:
+            result = json.loads(content)
+        except json.JSONDecodeError:
+            return Verdict(UNDECIDED)
+        if tool_name == 'classify_and_extract':
+            return validate_extraction(result.get('data', {}), result.get('image_type', ''))
+        return validate_extraction(result, args.get('image_type', ''))
+
+    if tool_name == 'save_data_to_db':
+        if content.startswith('Data successfully saved'):
+            return Verdict(OK)
+        if content.startswith('Database operation failed'):
+            error = content.split(':', 1)[1].strip()
+            return Verdict(RETRY, f"Reflection on last action: saving the record failed with the database error "
+                                  f"'{error}'. Please check the data and image_type and call save_data_to_db again.")
+        return Verdict(UNDECIDED)
+
+    if tool_name == 'google_search':
+        return Verdict(OK if content.strip() else UNDECIDED)
+
+    return Verdict(UNDECIDED)
@@ -0,0 +1,204 @@
+"""On-disk cache for VLM responses.
+
+Entries are keyed by the SHA-256 of the image bytes together with the model
+name and a fingerprint of the prompt/schema, so re-analysing an unchanged image
+costs a single SQLite lookup instead of a VLM round trip.
+"""
+import os
+import time
+import sqlite3
+import hashlib
+import functools
+import threading
+from typing import Optional, Dict
+
+from .config_loader import PROJECT_ROOT, config
+from .tracing import record
+
+_EVICT_EVERY = 32  # 每写入多少条检查一次淘汰，避免每次都全表统计
+_DIGEST_MEMO_SIZE = 4096  # 长时间运行的监视进程也只保留最近的这些摘要
+
+
+@functools.lru_cache(maxsize=_DIGEST_MEMO_SIZE)
+def _digest(path: str, mtime_ns: int, size: int) -> str:
+    # mtime和大小是缓存键的一部分，文件改动后会重新计算
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_sha256(image_path: str) -> str:
+    """Returns the SHA-256 hex digest of a file's bytes.
+
+    Digests of the most recent `_DIGEST_MEMO_SIZE` files are memoised per
+    (path, mtime, size) so the classify and extract steps of the same run only
+    read the image once.
+
+    Args:
+        image_path: The local file path to hash.
+
+    Returns:
+        The hex digest of the file content.
+    """
+    st = os.stat(image_path)
+    return _digest(os.path.abspath(image_path), st.st_mtime_ns, st.st_size)
+
+
+class VLMCache:
+    """A SQLite-backed, content-addressed cache for raw VLM outputs.
+
+    Args:
+        path: Location of the SQLite file.
+        max_entries: Maximum number of entries kept; least recently used go first.
+        max_bytes: Maximum total size of cached values in bytes.
+        max_age_days: Entries older than this are dropped.
+        enabled: When False every lookup misses and nothing is written.
+    """
+
+    def __init__(self, path: str, max_entries: int = 5000, max_bytes: int = 50 * 1024 * 1024,
+                 max_age_days: float = 30, enabled: bool = True):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_days * 86400
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS vlm_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_vlm_cache_access ON vlm_cache(last_access)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def make_key(image_path: str, model_name: str, prompt: str) -> str:
+        """Builds the cache key for an image, a model and a prompt/schema fingerprint."""
+        prompt_fp = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        return f"{file_sha256(image_path)}:{model_name}:{prompt_fp[:16]}"
+
+    def get(self, key: str, bypass: bool = False) -> Optional[str]:
+        """Returns the cached value for `key`, or None on a miss."""
+        if not self.enabled or bypass:
+            return None
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT value, created_at FROM vlm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.max_age_seconds:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE vlm_cache SET last_access = ? WHERE key = ?", (now, key))
+            conn.commit()
+            self.hits += 1
+        record(cache_hits=1)
+        return row[0]
+
+    def put(self, key: str, value: str, bypass: bool = False):
+        """Stores `value` under `key` and periodically applies eviction."""
+        if not self.enabled or bypass:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO vlm_cache (key, value, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value.encode('utf-8')), now, now)
+            )
+            conn.commit()
+            self._puts += 1
+            if self._puts % _EVICT_EVERY == 1:
+                self._evict(conn, now)
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        conn.execute("DELETE FROM vlm_cache WHERE created_at < ?", (now - self.max_age_seconds,))
+        count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM vlm_cache").fetchone()
+        if count > self.max_entries or total > self.max_bytes:
+            # 按最近访问时间从旧到新删除，直到满足条数和大小限制
+            excess = 0
+            for size, in conn.execute("SELECT size FROM vlm_cache ORDER BY last_access"):
+                if count - excess <= self.max_entries and total <= self.max_bytes:
+                    break
+                excess += 1
+                total -= size
+            conn.execute(
+                "DELETE FROM vlm_cache WHERE key IN (SELECT key FROM vlm_cache ORDER BY last_access LIMIT ?)",
+                (excess,)
+            )
+        conn.commit()
+
+    def evict(self):
+        """Drops expired entries and trims the cache to its size limits."""
+        with self._lock:
+            self._evict(self._connect(), time.time())
+
+    def clear(self):
+        """Removes every cached entry."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM vlm_cache")
+            conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        """Returns hit/miss counters and the current number of entries."""
+        with self._lock:
+            entries = self._connect().execute("SELECT COUNT(*) FROM vlm_cache").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+    def reset_stats(self):
+        """Clears the hit/miss counters, e.g. between benchmark runs."""
+        with self._lock:
+            self.hits = self.misses = 0
+
+
+_cache: Optional[VLMCache] = None
+
+
+def get_vlm_cache() -> VLMCache:
+    """Returns the process-wide VLM cache configured by the `vlm_cache` section of config.yaml.
+
+    Setting the environment variable `VLM_CACHE_BYPASS=1` disables the cache
+    without editing the configuration.
+    """
+    global _cache
+    if _cache is None:
+        cache_config = config.get('vlm_cache', {})
+        path = cache_config.get('path', os.path.join('database', 'vlm_cache.db'))
+        if not os.path.isabs(path):
+            path = os.path.join(PROJECT_ROOT, path)
+        bypass = os.getenv('VLM_CACHE_BYPASS', '').lower() in ('1', 'true', 'yes')
+        _cache = VLMCache(
+            path,
+            max_entries=cache_config.get('max_entries', 5000),
+            max_bytes=cache_config.get('max_bytes', 50 * 1024 * 1024),
+            max_age_days=cache_config.get('max_age_days', 30),
+            enabled=cache_config.get('enabled', True) and not bypass,
+        )
+    return _cache
+
+
+def format_cache_stats() -> str:
+    """Formats the process-wide cache's `stats` as one line; empty if it has not been looked up."""
+    if _cache is None or not _cache.hits + _cache.misses:
+        return ''
+    stats = _cache.stats()
+    return (f"{stats['hits']} hits, {stats['misses']} misses "
+            f"(hit rate {stats['hits'] / (stats['hits'] + stats['misses']):.2f}), {stats['entries']} entries")
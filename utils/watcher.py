@@ -0,0 +1,147 @@
+"""Watches the images directory for new files.
+
+On Linux the directory is watched with inotify (through ctypes, so no extra
+dependency is needed) and only reacts to completely written or moved-in files.
+Everywhere else, or if inotify is unavailable, the directory is polled.
+"""
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+from typing import Iterator, List, Optional
+
+from .batch import IMAGE_EXTENSIONS, list_images
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def _is_image(name: str) -> bool:
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+class _Inotify:
+    """A minimal inotify watch on one directory."""
+
+    def __init__(self, directory: str):
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError("libc not found")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, "inotify_add_watch failed")
+
+    def read(self, timeout: Optional[float]) -> List[str]:
+        """Returns the names of files written or moved in, waiting up to `timeout` seconds."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        names = []
+        offset = 0
+        while offset < len(buffer):
+            _, _, _, length = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size
+            name = buffer[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if name:
+                names.append(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _watch_inotify(image_dir: str, debounce: float, idle_timeout: Optional[float]) -> Iterator[List[str]]:
+    watch = _Inotify(image_dir)
+    try:
+        while True:
+            names = watch.read(idle_timeout)
+            if not names:
+                yield []
+                continue
+            # 一次拷贝多张图片时会连续触发事件，等安静下来再合并成一批
+            while True:
+                more = watch.read(debounce)
+                if not more:
+                    break
+                names.extend(more)
+            paths = []
+            for name in dict.fromkeys(names):
+                path = os.path.join(image_dir, name)
+                if _is_image(name) and os.path.isfile(path):
+                    paths.append(path)
+            if paths:
+                yield sorted(paths)
+    finally:
+        watch.close()
+
+
+def _watch_polling(image_dir: str, poll_interval: float, idle_timeout: Optional[float]) -> Iterator[List[str]]:
+    def snapshot():
+        result = {}
+        for path in list_images(image_dir):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            result[path] = (st.st_size, st.st_mtime_ns)
+        return result
+
+    previous = snapshot()
+    pending = {}
+    last_yield = time.monotonic()
+    while True:
+        time.sleep(poll_interval)
+        current = snapshot()
+        changed = [path for path, sig in current.items() if previous.get(path) != sig]
+        # 文件可能还在写入：只有连续两次轮询大小和时间都不变才交出去
+        ready = [path for path in pending if current.get(path) == pending[path]]
+        pending = {path: current[path] for path in changed}
+        previous = current
+        if ready or (idle_timeout is not None and time.monotonic() - last_yield >= idle_timeout):
+            last_yield = time.monotonic()
+            yield sorted(ready)
+
+
+def watch_images(image_dir: str, poll_interval: float = 5.0, debounce: float = 1.0,
+                 idle_timeout: Optional[float] = None) -> Iterator[List[str]]:
+    """Yields batches of image paths as they appear or change in a directory.
+
+    Runs forever; stop it with KeyboardInterrupt.
+
+    Args:
+        image_dir: The directory to watch.
+        poll_interval: Seconds between directory scans when polling.
+        debounce: Seconds of inotify silence before a batch is yielded.
+        idle_timeout: If set, an empty batch is yielded after this many
+            seconds without new images, so the caller can do periodic work.
+
+    Yields:
+        Lists of new or rewritten image paths.
+    """
+    try:
+        watcher = _watch_inotify(image_dir, debounce, idle_timeout)
+        batch = next(watcher)
+    except (OSError, AttributeError) as e:
+        print(f"--- inotify unavailable ({e}), polling {image_dir} every {poll_interval}s ---")
+        yield from _watch_polling(image_dir, poll_interval, idle_timeout)
+        return
+    yield batch
+    yield from watcher
@@ -0,0 +1,130 @@
+import os
+import sys
+import time
+import argparse
+import traceback
+import multiprocessing
+from dotenv import load_dotenv
+
+load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '.env'))
+from utils.job_queue import get_job_queue, get_job_queue_config, worker_id, Heartbeat
+
+def work(stop_when_empty=False, stop_event=None):
+    """Processes leased jobs of the ingest queue until stopped.
+
+    Each job is run with `ingest_image`, which resumes from the image's
+    checkpoint if an earlier attempt crashed, while a `Heartbeat` keeps its
+    lease alive. Jobs whose run saved a record are acked with it; failed
+    ones, including runs that saved no record, are handed back for a retry
+    or dead-lettered. A job interrupted with Ctrl+C is released without
+    counting the attempt.
+
+    Args:
+        stop_when_empty: Return once no job is available instead of polling.
+        stop_event: A `multiprocessing.Event` that stops the loop between jobs.
+    """
+    # agent和模型客户端导入很慢，每个工作进程导入一次
+    from ingest import ingest_image, NoRecordSavedError
+
+    queue = get_job_queue()
+    owner = worker_id()
+    poll_interval = get_job_queue_config()['poll_interval_seconds']
+    print(f"--- Worker {owner} started ---")
+    while stop_event is None or not stop_event.is_set():
+        job = queue.lease(owner)
+        if job is None:
+            if stop_when_empty:
+                break
+            time.sleep(poll_interval)
+            continue
+        print(f"--- Worker {owner} leased job {job.id}: {job.image_path} (attempt {job.attempts}) ---")
+        start = time.time()
+        try:
+            with Heartbeat(queue, job):
+                result = ingest_image(job.image_path)
+        except KeyboardInterrupt:
+            queue.release(job)
+            print(f"--- Worker {owner} released job {job.id} ---")
+            break
+        except NoRecordSavedError as e:
+            # 运行结束但没有保存记录，不能ack为完成，交回队列重试
+            queue.fail(job, str(e))
+            print(f"--- Job {job.id} saved no record after {time.time() - start:.1f}s ---")
+            continue
+        except Exception as e:
+            traceback.print_exc()
+            queue.fail(job, f"{type(e).__name__}: {e}")
+            print(f"--- Job {job.id} failed after {time.time() - start:.1f}s: {e} ---")
+            continue
+        queue.ack(job, {'status': result.status, 'record_table': result.record_table,
+                        'record_id': result.record_id, 'duplicate_of': result.duplicate_of})
+        print(f"--- Job {job.id} finished in {time.time() - start:.1f}s ---")
+    print(f"--- Worker {owner} stopped ---")
+
+def _work_process(stop_when_empty, stop_event):
+    try:
+        work(stop_when_empty, stop_event)
+    except KeyboardInterrupt:
+        pass
+
+def run_workers(processes, stop_when_empty=False):
+    """Runs `work` in `processes` spawned processes and restarts the ones that crash.
+
+    Processes are started with the 'spawn' method, so each one builds its
+    own model clients, database writers and checkpointer. A crashed process's
+    job is leased again once its lease expires. Ctrl+C stops all processes
+    after their current job.
+    """
+    context = multiprocessing.get_context('spawn')
+    stop_event = context.Event()
+
+    def _start():
+        process = context.Process(target=_work_process, args=(stop_when_empty, stop_event), daemon=False)
+        process.start()
+        return process
+
+    workers = [_start() for _ in range(processes)]
+    try:
+        while any(p.is_alive() for p in workers):
+            for i, process in enumerate(workers):
+                process.join(timeout=1)
+                # 异常退出（例如被OOM杀掉）的进程重新启动，正常退出的表示队列已空
+                if process.exitcode not in (None, 0) and not stop_event.is_set():
+                    print(f"--- Worker process {process.pid} exited with code {process.exitcode}, restarting ---")
+                    workers[i] = _start()
+    except KeyboardInterrupt:
+        print("--- Stopping workers after their current job ---")
+        stop_event.set()
+        for process in workers:
+            process.join()
+
+def main():
+    """Starts ingest workers, or reports on the job queue.
+
+    Jobs are added with `python main.py --enqueue` or the 'Enqueue Images'
+    button of the Gradio app. Workers on several machines can share one
+    queue as long as they use the same database file and image paths.
+    """
+    parser = argparse.ArgumentParser(description="Process the images of the ingest job queue.")
+    parser.add_argument('-n', '--processes', type=int, default=get_job_queue_config()['workers'],
+                        help="number of worker processes")
+    parser.add_argument('--once', action='store_true', help="exit once the queue is empty")
+    parser.add_argument('--status', action='store_true', help="print the number of jobs per status and the dead letters")
+    parser.add_argument('--requeue-dead', action='store_true', help="put the dead-lettered jobs back in the queue")
+    args = parser.parse_args()
+
+    queue = get_job_queue()
+    if args.requeue_dead:
+        print(f"--- Requeued {queue.requeue_dead()} dead-lettered jobs ---")
+    if args.status or args.requeue_dead:
+        print(queue.stats())
+        for job in queue.dead_letters():
+            print(f"dead job {job['id']}: {job['image_path']} ({job['attempts']} attempts): {job['last_error']}")
+        return
+    if args.processes <= 1:
+        work(stop_when_empty=args.once)
+    else:
+        run_workers(args.processes, stop_when_empty=args.once)
+
+if __name__ == "__main__":
+    sys.exit(main())